@@ -9,94 +9,648 @@
 #define MSEC_PER_DEG 20     // the servo is rated for 17 ms/deg unloaded, 20 seems ok
                             //  when testing with stuff mounted on it
 
+// binary replies are fixed size frames of a sync byte, a frame type, pan and
+// tilt as int16, the reading as uint16 (all little endian) and a checksum
+// that is the low byte of the sum of every byte after the sync byte
+#define FRAME_SYNC 0xA5
+#define FRAME_SIZE 9
+#define FRAME_READING 'R'
+#define FRAME_READY 'K'
+#define FRAME_ERROR 'E'
+#define FRAME_STATS 'Q'     // pan, tilt and reading hold min, median, spread
+
+// READSENSOR|n|mode|tolerance takes up to n samples (at most MAX_SAMPLES) and
+// replies with one chosen by mode, plus the min, median and spread of the
+// samples. it stops early once MIN_SAMPLES samples are within tolerance of
+// each other
+#define MAX_SAMPLES 32
+#define MIN_SAMPLES 3
+#define SAMPLE_MIN 0
+#define SAMPLE_MEDIAN 1
+#define SAMPLE_MEAN 2
+
+// measured settle times can be uploaded as a profile of (step size, wait)
+// points for each axis, and moves wait for the time interpolated from it
+#define PAN_AXIS 0
+#define TILT_AXIS 1
+#define PROFILE_POINTS 16
+
+// the link starts at BAUD_DEFAULT. BAUD|rate switches to another rate on
+// trial: the host checks the link with ECHO commands and confirms the rate
+// with BAUDOK, and if that doesn't happen within BAUD_TIMEOUT msec the
+// scanner goes back to the rate it was using
+#define BAUD_DEFAULT 115200
+#define BAUD_TIMEOUT 1000
+
+// nothing waits with delay(). loop() keeps reading input, decoding each line
+// into a queue of up to COMMAND_QUEUE commands, while the command at the
+// front of it works through its states: waiting for the servos to settle,
+// then sampling the sensor. so the next command is ready to start the moment
+// the current one is finished, and lines longer than COMMAND_SIZE characters
+// are answered as unknown commands
+#define COMMAND_QUEUE 4
+#define COMMAND_SIZE 64
+#define MAX_ARGS 7
+#define ECHO_SIZE 32        // longest ECHO payload kept, past that it's cut off
+
+#define CMD_UNKNOWN 0
+#define CMD_READSENSOR 1
+#define CMD_POINT 2
+#define CMD_SCAN 3
+#define CMD_PAN 4
+#define CMD_TILT 5
+#define CMD_SETTLE 6
+#define CMD_BINARY 7
+#define CMD_BAUD 8
+#define CMD_BAUDOK 9
+#define CMD_ECHO 10
+#define CMD_PING 11
+#define CMD_DELAY 12
+
+#define ARGS_NONE 0         // just the name
+#define ARGS_REQUIRED 1     // the name, a | and the arguments
+#define ARGS_OPTIONAL 2     // either
+
+#define STATE_IDLE 0        // waiting for a command
+#define STATE_WAITING 1     // waiting for the servos to settle (or a DELAY)
+#define STATE_SAMPLING 2    // collecting sensor samples
+
+struct CommandName {
+    const char *name;
+    byte type;
+    byte args;
+};
+
+const CommandName COMMAND_NAMES[] = {
+    {"READSENSOR", CMD_READSENSOR, ARGS_OPTIONAL},
+    {"POINT", CMD_POINT, ARGS_REQUIRED},
+    {"SCAN", CMD_SCAN, ARGS_REQUIRED},
+    {"PAN", CMD_PAN, ARGS_REQUIRED},
+    {"TILT", CMD_TILT, ARGS_REQUIRED},
+    {"SETTLE", CMD_SETTLE, ARGS_REQUIRED},
+    {"BINARY", CMD_BINARY, ARGS_REQUIRED},
+    {"BAUD", CMD_BAUD, ARGS_REQUIRED},
+    {"BAUDOK", CMD_BAUDOK, ARGS_NONE},
+    {"ECHO", CMD_ECHO, ARGS_REQUIRED},
+    {"PING", CMD_PING, ARGS_NONE},
+    {"DELAY", CMD_DELAY, ARGS_REQUIRED},
+};
+#define COMMAND_NAME_COUNT (sizeof(COMMAND_NAMES) / sizeof(COMMAND_NAMES[0]))
+
+// a decoded command. given is how many arguments came after the |, or 0 if
+// there wasn't one
+struct Command {
+    byte type;
+    byte given;
+    long args[MAX_ARGS];
+    char text[ECHO_SIZE];   // the payload of an ECHO
+};
+
 // initialize servo objects globally so they can be passed around easily
 Servo pan_servo;
-Servo tilt_servo; 
+Servo tilt_servo;
 
 // keep track of the current facing
 int pan_deg;
 int tilt_deg;
 
-String command = "";
+// the line being received, and whether it got too long to keep
+char line[COMMAND_SIZE + 1];
+int line_len = 0;
+bool line_overflow = false;
+
+// decoded commands waiting their turn, oldest first
+Command queue[COMMAND_QUEUE];
+byte queue_head = 0;
+byte queue_len = 0;
+
+// the command being worked on, what it's doing and since when
+Command current;
+byte state = STATE_IDLE;
+unsigned long wait_start;
+unsigned long wait_ms;
+bool sample_after_wait;
+
+// whether replies are sent as binary frames instead of lines of text
+bool binary_mode = false;
+
+// settle profile for each axis, sorted by step size. an empty profile means
+// waiting MSEC_PER_DEG for every degree moved
+int profile_deg[2][PROFILE_POINTS];
+int profile_ms[2][PROFILE_POINTS];
+int profile_len[2] = {0, 0};
+
+// the current link speed, the one to go back to if it isn't confirmed (0
+// when it has been), and when it was switched to
+long baud_rate = BAUD_DEFAULT;
+long baud_previous = 0;
+unsigned long baud_switched;
+
+// the ADC converts the sensor pin over and over on its own, and each result
+// is dropped here by its interrupt along with a count of conversions so far
+volatile int adc_value;
+volatile unsigned int adc_sequence = 0;
+
+// the reading being sampled: how to take it, the samples so far (kept
+// sorted) and the last conversion used
+int sample_target;
+int sample_mode;
+int sample_tolerance;
+bool sample_stats;
+int samples[MAX_SAMPLES];
+int sample_count;
+long sample_total;
+unsigned int sample_sequence;
+
+// statistics of the samples behind the last reading
+int sample_low;
+int sample_median;
+int sample_spread;
+
+// where the scan in progress is, see start_scan
+int scan_pan;
+int scan_index;
+int scan_tilt_last;
+bool scan_upward;
 
 void setup() {
-    Serial.begin(115200);
+    Serial.begin(BAUD_DEFAULT);
     pan_servo.attach(PAN_PIN);
     tilt_servo.attach(TILT_PIN);
     pan_deg = 0;
     tilt_deg = 0;
+    start_adc();
     Serial.println("ready");
 }
 
 void loop() {
-    // constantly read serial input buffer
-    if (Serial.available()) {
+    // go back to the old link speed if the host never confirmed the new one
+    if (baud_previous != 0 && millis() - baud_switched > BAUD_TIMEOUT) {
+        set_baud(baud_previous);
+        baud_previous = 0;
+    }
+    // input is read whatever else is going on, so the next command is
+    // decoded while this one waits on the servos
+    read_input();
+    if (state == STATE_IDLE) {
+        if (queue_len > 0) {
+            current = queue[queue_head];
+            queue_head = (queue_head + 1) % COMMAND_QUEUE;
+            queue_len--;
+            start_command();
+        }
+    } else if (state == STATE_WAITING) {
+        if (millis() - wait_start >= wait_ms) {
+            if (sample_after_wait) {
+                start_sampling();
+            } else {
+                finish_command();
+            }
+        }
+    } else if (state == STATE_SAMPLING) {
+        if (take_sample()) {
+            finish_reading();
+        }
+    }
+}
+
+void read_input() {
+// move whatever has arrived into the line buffer, decoding each finished
+//  line onto the command queue. while the queue is full the rest waits in
+//  the serial receive buffer
+    while (queue_len < COMMAND_QUEUE && Serial.available()) {
         char ch = Serial.read();
-        // carriage return means a command has finished sending, so parse it and
-        // reset the string
+        // carriage return means a command has finished sending
         if (ch == '\r') {
-            parse_command();
-            command = "";
-        } else {    // otherwise continue building the string
-            command += ch;
+            line[line_overflow ? 0 : line_len] = '\0';
+            decode(line, queue[(queue_head + queue_len) % COMMAND_QUEUE]);
+            queue_len++;
+            line_len = 0;
+            line_overflow = false;
+        } else if (line_len < COMMAND_SIZE) {
+            line[line_len++] = ch;
+        } else {
+            line_overflow = true;
         }
     }
 }
 
-void parse_command() {
-    if (command.equals("READSENSOR")) { // send back a sensor reading
-        // take whatever number of readings and use the minimum to account for noise
-        int readings[SENSOR_SAMPLES];
-        for(int i = 0; i < SENSOR_SAMPLES; i++) {
-            readings[i] = analogRead(SENSOR_PIN);
+void decode(char *text, Command &command) {
+// work out which command a line is and parse its arguments. the line is cut
+//  in two at the first |, and anything that doesn't match a known command
+//  (including a missing or extra |) is CMD_UNKNOWN
+    char *args = strchr(text, '|');
+    if (args != NULL) {
+        *args++ = '\0';
+    }
+    command.type = CMD_UNKNOWN;
+    command.given = 0;
+    for (unsigned int i = 0; i < COMMAND_NAME_COUNT; i++) {
+        if (strcmp(text, COMMAND_NAMES[i].name) == 0) {
+            byte expected = COMMAND_NAMES[i].args;
+            if (expected == ARGS_OPTIONAL
+                    || (expected == ARGS_REQUIRED) == (args != NULL)) {
+                command.type = COMMAND_NAMES[i].type;
+            }
+            break;
         }
-        Serial.print("X");Serial.println(pan_deg);
-        Serial.print("Y");Serial.println(tilt_deg);
-        Serial.print("Z");Serial.println(arr_min(readings, SENSOR_SAMPLES));
-    } else if (command.startsWith("PAN|")) {    // pan to a specified angle
-        // extract the location from the command
-        String arg = command.substring(4);
-        arg.trim();
-        int new_deg = arg.toInt();
-
-        // pan to the location
-        move_servo(pan_servo, new_deg, abs(pan_deg-new_deg)*MSEC_PER_DEG);
-        pan_deg = new_deg;
-    } else if (command.startsWith("TILT|")) {   // tilt to a specified angle
-        // extract the location from the command
-        String arg = command.substring(5);
-        arg.trim();
-        int new_deg = arg.toInt();
-
-        // pan to the location
-        move_servo(tilt_servo, new_deg, abs(tilt_deg-new_deg)*MSEC_PER_DEG);
-        tilt_deg = new_deg;
-    } else if (command.startsWith("DELAY|")) {  // this one is mostly for
-                                                // debugging purposes
-        // extract the amount of delay from the command
-        String arg = command.substring(6);
-        arg.trim();
-        delay(arg.toInt());
-    } else {    // communicate if a bad command is received
-        Serial.println("unknown command!");
-    }
-    // send ready when finished so the controller knows when it
-    // can send another instruction
-    Serial.println("ready");
+    }
+    if (args == NULL || command.type == CMD_UNKNOWN) {
+        return;
+    }
+    if (command.type == CMD_ECHO) {
+        strncpy(command.text, args, ECHO_SIZE - 1);
+        command.text[ECHO_SIZE - 1] = '\0';
+    } else {
+        command.given = parse_args(args, command.args, MAX_ARGS);
+    }
+}
+
+int parse_args(char *args, long out[], int count) {
+// split a string of |-separated integer arguments into an array, returning
+//  how many were actually given. missing arguments are set to 0
+    int given = 0;
+    for (int i = 0; i < count; i++) {
+        out[i] = 0;
+    }
+    while (args != NULL && given < count) {
+        out[given++] = atol(args);
+        args = strchr(args, '|');
+        if (args != NULL) {
+            args++;
+        }
+    }
+    return given;
+}
+
+void start_command() {
+// start on the command just taken off the queue. quick ones are answered
+//  straight away, the rest set up a wait or sampling for loop() to finish
+    long *args = current.args;
+    switch (current.type) {
+    case CMD_READSENSOR:    // send back a sensor reading, optionally choosing
+                            // how to sample and sending the statistics
+        if (current.given > 0) {
+            prepare_sampling(args[0], args[1], args[2], true);
+        } else {
+            prepare_sampling(SENSOR_SAMPLES, SAMPLE_MIN, 0, false);
+        }
+        start_sampling();
+        return;
+    case CMD_POINT:         // move to a point and read it
+        // arguments are both angles, and optionally how to sample like
+        // READSENSOR|n|mode|tolerance
+        if (current.given > 2) {
+            prepare_sampling(args[2], args[3], args[4], true);
+        } else {
+            prepare_sampling(SENSOR_SAMPLES, SAMPLE_MIN, 0, false);
+        }
+        wait_for(move_to(args[0], args[1]), true);
+        return;
+    case CMD_SCAN:          // run a whole scan
+        start_scan();
+        return;
+    case CMD_PAN:           // pan to a specified angle
+        // optionally wait a given time instead of the settle time (used to
+        // measure settle times)
+        wait_for(current.given > 1 ? args[1]
+                    : settle_time(PAN_AXIS, args[0]-pan_deg), false);
+        pan_deg = args[0];
+        pan_servo.write(pan_deg);
+        return;
+    case CMD_TILT:          // tilt to a specified angle
+        wait_for(current.given > 1 ? args[1]
+                    : settle_time(TILT_AXIS, args[0]-tilt_deg), false);
+        tilt_deg = args[0];
+        tilt_servo.write(tilt_deg);
+        return;
+    case CMD_SETTLE:        // set a settle profile point
+        // arguments are the axis (0 for pan, 1 for tilt), the step size in
+        // degrees and the time to wait after a step that size. a step size
+        // of 0 clears the axis's profile
+        set_profile_point(args[0] == TILT_AXIS ? TILT_AXIS : PAN_AXIS,
+                            args[1], args[2]);
+        break;
+    case CMD_BINARY:        // switch reply format
+        // the reply to this command still uses the old format so the host
+        // can tell whether the switch was understood
+        send_ready();
+        binary_mode = args[0] != 0;
+        return;
+    case CMD_BAUD:          // try another link speed
+        // answered at the old rate, then everything after that is at the
+        // new one until it's confirmed or times out
+        send_ready();
+        if (args[0] > 0) {
+            if (baud_previous == 0) {
+                baud_previous = baud_rate;
+            }
+            set_baud(args[0]);
+            baud_switched = millis();
+        }
+        return;
+    case CMD_BAUDOK:        // keep the new link speed
+        baud_previous = 0;
+        break;
+    case CMD_ECHO:          // send the argument back
+        // with a checksum of what was received, so the host can check both
+        // directions of the link. only used in text mode
+        if (!binary_mode) {
+            unsigned int checksum = 0;
+            for (int i = 0; current.text[i] != '\0'; i++) {
+                checksum += (byte)current.text[i];
+            }
+            Serial.print(current.text);Serial.print("|");Serial.println(checksum);
+        }
+        break;
+    case CMD_PING:          // let the host sync up
+        // always answered in text, and puts replies back into text so the
+        // host knows what to expect no matter what happened before
+        binary_mode = false;
+        Serial.println("pong");
+        break;
+    case CMD_DELAY:         // this one is mostly for debugging purposes
+        wait_for(args[0], false);
+        return;
+    default:                // communicate if a bad command is received
+        if (binary_mode) {
+            send_frame(FRAME_ERROR, pan_deg, tilt_deg, 0);
+        } else {
+            Serial.println("unknown command!");
+        }
+    }
+    finish_command();
+}
+
+void finish_command() {
+// send ready when finished so the controller knows when it can send another
+//  instruction, and move on to the next one
+    send_ready();
+    state = STATE_IDLE;
+}
+
+void wait_for(long ms, bool then_sample) {
+// wait some amount of time in msec (to allow the servos to finish moving),
+//  then either sample the sensor or finish the command
+    wait_start = millis();
+    wait_ms = max(ms, 0L);
+    sample_after_wait = then_sample;
+    state = STATE_WAITING;
 }
 
-void move_servo(Servo serv, long angle, int wait) {
-// move a servo to a specific angle, then wait for some amount of time in
-//  msec (to allow the servo to finish moving)
-    serv.write(angle);
-    delay(wait);
+int move_to(int pan, int tilt) {
+// start both servos moving at once, returning how long to wait for the
+//  longer move
+    int wait = max(settle_time(PAN_AXIS, pan-pan_deg),
+                    settle_time(TILT_AXIS, tilt-tilt_deg));
+    pan_servo.write(pan);
+    tilt_servo.write(tilt);
+    pan_deg = pan;
+    tilt_deg = tilt;
+    return wait;
 }
 
-int arr_min(int arr[], int len) {
-// get the minimum value of an array
-    int res = arr[0];
-    for(int i = 1; i < len; ++i) {
-        res = min(res, arr[i]);
+void start_scan() {
+// scan a grid of points without waiting on the host between them, streaming
+//  each reading back as a line of the form S<pan>,<tilt>,<reading> (or a
+//  reading frame in binary mode). arguments are pan start, pan end, pan
+//  step, tilt start, tilt end, tilt step and extra settle time in msec. ends
+//  are exclusive and steps must be positive. tilt sweeps up one column and
+//  down the next so it never has to jump back
+    long *args = current.args;
+    if (args[2] <= 0 || args[5] <= 0) {
+        finish_command();
+        return;
     }
-    return res;
-}
\ No newline at end of file
+    prepare_sampling(SENSOR_SAMPLES, SAMPLE_MIN, 0, false);
+    scan_pan = args[0];
+    scan_index = 0;
+    scan_upward = true;
+    // the last tilt angle actually visited, for sweeping back down
+    scan_tilt_last = args[3] + ((args[4] - args[3] - 1) / args[5]) * args[5];
+    next_scan_point();
+}
+
+void next_scan_point() {
+// move to the scan's next point, or finish the scan after the last one
+    int tilt_start = current.args[3];
+    int tilt_end = current.args[4];
+    int tilt_step = current.args[5];
+    if (tilt_start + scan_index * tilt_step >= tilt_end) {
+        // this column is done, so go the other way along the next one
+        if (tilt_start >= tilt_end) {
+            finish_command();
+            return;
+        }
+        scan_index = 0;
+        scan_upward = !scan_upward;
+        scan_pan += current.args[2];
+    }
+    if (scan_pan >= current.args[1]) {
+        finish_command();
+        return;
+    }
+    int tilt = scan_upward ? tilt_start + scan_index * tilt_step
+                            : scan_tilt_last - scan_index * tilt_step;
+    wait_for(move_to(scan_pan, tilt) + current.args[6], true);
+}
+
+void set_baud(long rate) {
+// change the link speed once everything already sent has gone out. anything
+//  half received is garbage at the new speed, so it's dropped
+    Serial.flush();
+    Serial.end();
+    Serial.begin(rate);
+    baud_rate = rate;
+    line_len = 0;
+    line_overflow = false;
+}
+
+void send_ready() {
+// tell the host the last command is finished
+    if (binary_mode) {
+        send_frame(FRAME_READY, pan_deg, tilt_deg, 0);
+    } else {
+        Serial.println("ready");
+    }
+}
+
+void send_frame(char type, int pan, int tilt, unsigned int reading) {
+// send a single binary frame, see the FRAME_ defines for the layout
+    byte frame[FRAME_SIZE];
+    frame[0] = FRAME_SYNC;
+    frame[1] = type;
+    frame[2] = lowByte(pan);
+    frame[3] = highByte(pan);
+    frame[4] = lowByte(tilt);
+    frame[5] = highByte(tilt);
+    frame[6] = lowByte(reading);
+    frame[7] = highByte(reading);
+    byte checksum = 0;
+    for (int i = 1; i < FRAME_SIZE - 1; i++) {
+        checksum += frame[i];
+    }
+    frame[FRAME_SIZE - 1] = checksum;
+    Serial.write(frame, FRAME_SIZE);
+}
+
+int settle_time(int axis, int delta) {
+// how long to wait after moving an axis by some number of degrees. the time
+//  is interpolated between the points of the axis's settle profile, and past
+//  the last point each extra degree takes MSEC_PER_DEG
+    delta = abs(delta);
+    if (delta == 0) {
+        return 0;
+    }
+    long prev_deg = 0;
+    long prev_ms = 0;
+    for (int i = 0; i < profile_len[axis]; i++) {
+        if (delta <= profile_deg[axis][i]) {
+            return prev_ms + (profile_ms[axis][i] - prev_ms) * (delta - prev_deg)
+                                / (profile_deg[axis][i] - prev_deg);
+        }
+        prev_deg = profile_deg[axis][i];
+        prev_ms = profile_ms[axis][i];
+    }
+    return prev_ms + (delta - prev_deg) * MSEC_PER_DEG;
+}
+
+void set_profile_point(int axis, int deg, int ms) {
+// add a point to an axis's settle profile, keeping it sorted by step size
+    if (deg <= 0) {
+        profile_len[axis] = 0;
+        return;
+    }
+    int i = 0;
+    while (i < profile_len[axis] && profile_deg[axis][i] < deg) {
+        i++;
+    }
+    if (i < profile_len[axis] && profile_deg[axis][i] == deg) {
+        profile_ms[axis][i] = ms;   // replace the time for this step size
+        return;
+    }
+    if (profile_len[axis] == PROFILE_POINTS) {
+        return;     // no room left
+    }
+    for (int j = profile_len[axis]; j > i; j--) {
+        profile_deg[axis][j] = profile_deg[axis][j-1];
+        profile_ms[axis][j] = profile_ms[axis][j-1];
+    }
+    profile_deg[axis][i] = deg;
+    profile_ms[axis][i] = ms;
+    profile_len[axis]++;
+}
+
+void start_adc() {
+// run the ADC in free running mode on the sensor pin, so there's always a
+//  fresh conversion on the way. at a 128 prescaler each one takes 13 ADC
+//  clocks, about 104 us, the same as analogRead (which can't be used
+//  alongside this)
+    ADMUX = _BV(REFS0) | ((SENSOR_PIN - A0) & 0x07);    // AVcc reference
+    ADCSRB = 0;     // free running
+    ADCSRA = _BV(ADEN) | _BV(ADSC) | _BV(ADATE) | _BV(ADIE)
+                | _BV(ADPS2) | _BV(ADPS1) | _BV(ADPS0);
+}
+
+ISR(ADC_vect) {
+    adc_value = ADC;
+    adc_sequence++;
+}
+
+void prepare_sampling(int count, int mode, int tolerance, bool stats) {
+// set how the next reading is taken. up to count samples are combined by
+//  mode (the minimum accounts for noise best), and with a tolerance it
+//  stops as soon as enough samples agree
+    if (count <= 0) {
+        count = SENSOR_SAMPLES;
+    }
+    sample_target = min(count, MAX_SAMPLES);
+    sample_mode = mode;
+    sample_tolerance = tolerance;
+    sample_stats = stats;
+}
+
+void start_sampling() {
+    sample_count = 0;
+    sample_total = 0;
+    // the conversion already running may have started before the servos
+    // settled, so the first sample is the one after it
+    noInterrupts();
+    sample_sequence = adc_sequence + 1;
+    interrupts();
+    state = STATE_SAMPLING;
+}
+
+bool take_sample() {
+// add the newest conversion to the samples if there's been one since the
+//  last sample, keeping them sorted so the statistics are easy to get at.
+//  returns whether the reading is finished
+    noInterrupts();
+    unsigned int sequence = adc_sequence;
+    int reading = adc_value;
+    interrupts();
+    if ((int)(sequence - sample_sequence) <= 0) {
+        return false;
+    }
+    sample_sequence = sequence;
+    sample_total += reading;
+    int i = sample_count;
+    while (i > 0 && samples[i-1] > reading) {
+        samples[i] = samples[i-1];
+        i--;
+    }
+    samples[i] = reading;
+    sample_count++;
+    return sample_count >= sample_target
+            || (sample_tolerance > 0 && sample_count >= MIN_SAMPLES
+                && samples[sample_count-1] - samples[0] <= sample_tolerance);
+}
+
+void finish_reading() {
+// combine the samples into a reading and send it, then carry on with the
+//  scan or finish the command
+    int taken = sample_count;
+    sample_low = samples[0];
+    sample_median = (samples[(taken-1)/2] + samples[taken/2]) / 2;
+    sample_spread = samples[taken-1] - samples[0];
+    int reading = sample_low;
+    if (sample_mode == SAMPLE_MEDIAN) {
+        reading = sample_median;
+    } else if (sample_mode == SAMPLE_MEAN) {
+        reading = (sample_total + taken/2) / taken;
+    }
+    if (current.type == CMD_SCAN) {
+        if (binary_mode) {
+            send_frame(FRAME_READING, pan_deg, tilt_deg, reading);
+        } else {
+            Serial.print("S");Serial.print(pan_deg);
+            Serial.print(",");Serial.print(tilt_deg);
+            Serial.print(",");Serial.println(reading);
+        }
+        scan_index++;
+        next_scan_point();
+        return;
+    }
+    send_reading(reading);
+    finish_command();
+}
+
+void send_reading(int reading) {
+// send a reading along with the current facing, and optionally the
+//  statistics of its samples
+    if (binary_mode) {
+        if (sample_stats) {
+            send_frame(FRAME_STATS, sample_low, sample_median, sample_spread);
+        }
+        send_frame(FRAME_READING, pan_deg, tilt_deg, reading);
+        return;
+    }
+    Serial.print("X");Serial.println(pan_deg);
+    Serial.print("Y");Serial.println(tilt_deg);
+    Serial.print("Z");Serial.println(reading);
+    if (sample_stats) {
+        Serial.print("Q");Serial.print(sample_low);
+        Serial.print(",");Serial.print(sample_median);
+        Serial.print(",");Serial.println(sample_spread);
+    }
+}
@@ -0,0 +1,289 @@
+from collections import deque
+from pathlib import Path
+import csv
+import json
+import time
+
+class Histogram:
+    '''
+    Durations counted in buckets that double in size, from a microsecond up
+    to about half an hour. Adding one is a couple of integer operations, and
+    the percentiles it gives are within a factor of two, which is plenty to
+    tell a 2 ms reply from a 20 ms one or a 1 s timeout.
+    '''
+    BUCKETS = 32
+
+    def __init__(self) -> None:
+        # bucket i counts durations from 2**(i-1) up to 2**i microseconds
+        self.counts = [0]*Histogram.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        seconds = max(seconds, 0.0)
+        bucket = int(seconds*1e6).bit_length()
+        self.counts[min(bucket, Histogram.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction: float) -> float:
+        '''
+        Estimates a percentile as the top of the bucket it falls in.
+
+        Args:
+            fraction (float): 0.5 for the median, 0.99 for the 99th
+                percentile and so on
+
+        Returns:
+            float: the duration in seconds.
+        '''
+        if not self.count:
+            return 0.0
+        target = fraction*self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min((1 << bucket)/1e6, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        '''
+        Returns:
+            dict: the count, and the total, mean, median, 90th and 99th
+                percentile and max durations in ms.
+        '''
+        return {'count': self.count,
+                'total_ms': self.total*1000,
+                'mean_ms': self.total*1000/self.count if self.count else 0.0,
+                'p50_ms': self.percentile(0.5)*1000,
+                'p90_ms': self.percentile(0.9)*1000,
+                'p99_ms': self.percentile(0.99)*1000,
+                'max_ms': self.max*1000}
+
+
+class CommandTiming:
+    '''
+    Where the time goes while talking to the scanner. Attach it with
+    Scanner.instrument, and every command gets timestamped when it's sent,
+    when the first byte of its reply arrives and when its 'ready' arrives.
+    Arrival times come from the serial reader thread, so they're when the
+    bytes actually came in rather than when they were looked at.
+
+    Each command's time is split into phases, with a histogram of each for
+    every type of command:
+
+        window      the host waiting for room in the scanner's input buffer
+                    before sending it
+        queued      sent, but the scanner still working on earlier commands
+        first_byte  from when the scanner could start on it to the first
+                    byte of its reply, which is mostly servo waits and
+                    sampling (or serial turnaround for quick commands)
+        reply       from the first byte of the reply to its 'ready'
+        total       from sending it to its 'ready'
+
+    Time spent waiting on reads that timed out is counted separately, as is
+    the time the scanner sat idle with nothing to do.
+
+        timing = s.instrument()
+        collect_data.scan(s)
+        timing.print_breakdown()
+        timing.save('scan_timing')
+    '''
+    PHASES = ('window', 'queued', 'first_byte', 'reply', 'total')
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.histograms = {}        # (command type, phase) -> Histogram
+        self.command_bytes = {}     # command type -> [sent, received]
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.timeouts = 0
+        self.timeout_seconds = 0.0
+        self.busy_seconds = 0.0     # scanner time spent on commands
+        self._arrivals = deque()    # (bytes received so far, arrival time)
+        self._last_ready = 0.0
+
+    # serial side, called by SerialDevice
+
+    def sent(self, count: int) -> None:
+        self.bytes_sent += count
+
+    def received(self, count: int, now: float) -> None:
+        # called from the reader thread with the receive buffer locked
+        self.bytes_received += count
+        self._arrivals.append((self.bytes_received, now))
+
+    def arrival(self, size: int, buffered: int) -> tuple:
+        '''
+        Works out when the bytes just taken out of the receive buffer
+        arrived. Called with the receive buffer locked.
+
+        Args:
+            size (int): how many bytes were just taken
+            buffered (int): how many are still in the buffer after them
+
+        Returns:
+            tuple: (float: arrival of the first byte, float: arrival of the
+                last byte, int: size), or None if they arrived before
+                timing started.
+        '''
+        end = self.bytes_received - buffered
+        start = end - size
+        arrivals = self._arrivals
+        # bytes that were already buffered when timing started come before 0
+        if start < 0 or not arrivals:
+            return None
+        # forget chunks that were used up before these bytes
+        while arrivals[0][0] <= start:
+            arrivals.popleft()
+        first = arrivals[0][1]
+        last = next(now for received, now in arrivals if received >= end)
+        return first, last, size
+
+    def timed_out(self, seconds: float) -> None:
+        self.timeouts += 1
+        self.timeout_seconds += seconds
+
+    # scanner side, called by Scanner
+
+    def command(self, kind: str, submitted: float, written: float,
+                first: float, ready: float, sent: int, received: int) -> None:
+        '''
+        Records an answered command.
+
+        Args:
+            kind (str): the command type, like 'POINT'
+            submitted (float): when it was handed to Scanner.submit
+            written (float): when it was sent
+            first (float): when the first byte of its reply arrived
+            ready (float): when the last byte of its 'ready' arrived
+            sent (int): bytes sent for it
+            received (int): bytes received for it
+        '''
+        # the scanner starts on a command once it's arrived and the one
+        # before it is finished
+        start = max(written, self._last_ready)
+        self._last_ready = ready
+        self.busy_seconds += max(ready - start, 0.0)
+        for phase, seconds in zip(CommandTiming.PHASES,
+                                    (written - submitted, start - written,
+                                        first - start, ready - first,
+                                        ready - written)):
+            histogram = self.histograms.get((kind, phase))
+            if histogram is None:
+                histogram = self.histograms[kind, phase] = Histogram()
+            histogram.add(seconds)
+        counts = self.command_bytes.setdefault(kind, [0, 0])
+        counts[0] += sent
+        counts[1] += received
+
+    # reports
+
+    def report(self) -> dict:
+        '''
+        Returns:
+            dict: totals, and a summary of each phase of each type of
+                command, see Histogram.summary. suitable for json.
+        '''
+        elapsed = time.perf_counter() - self.start
+        commands = {}
+        for (kind, phase), histogram in sorted(self.histograms.items()):
+            entry = commands.setdefault(kind, {
+                        'bytes_sent': self.command_bytes[kind][0],
+                        'bytes_received': self.command_bytes[kind][1]})
+            entry[phase] = histogram.summary()
+        return {'elapsed_s': elapsed,
+                'scanner_busy_s': self.busy_seconds,
+                'scanner_idle_s': max(elapsed - self.busy_seconds, 0.0),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'read_timeouts': self.timeouts,
+                'read_timeout_s': self.timeout_seconds,
+                'commands': commands}
+
+    def save_json(self, path) -> None:
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+
+    def save_csv(self, path) -> None:
+        '''
+        Saves a row for every phase of every type of command.
+        '''
+        columns = ['command', 'phase', 'count', 'total_ms', 'mean_ms',
+                    'p50_ms', 'p90_ms', 'p99_ms', 'max_ms']
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file, lineterminator='\n')
+            writer.writerow(columns)
+            for (kind, phase), histogram in sorted(self.histograms.items()):
+                summary = histogram.summary()
+                writer.writerow([kind, phase] +
+                                [round(summary[column], 3)
+                                    for column in columns[2:]])
+
+    def folded(self) -> str:
+        '''
+        The breakdown as folded stacks, one 'frame;frame;frame microseconds'
+        line each, which flame graph tools (flamegraph.pl, speedscope,
+        inferno) can draw directly.
+
+        Returns:
+            str: the folded stacks.
+        '''
+        # only the scanner's side, which adds up to the whole time. the host
+        # waiting (for room to send, or on reads that time out) happens
+        # at the same time as it
+        stacks = [('scan;idle', self.report()['scanner_idle_s'])]
+        for (kind, phase), histogram in sorted(self.histograms.items()):
+            if phase in ('first_byte', 'reply'):
+                stacks.append(('scan;{};{}'.format(kind, phase),
+                                histogram.total))
+        return ''.join('{} {}\n'.format(stack, int(seconds*1e6))
+                        for stack, seconds in stacks if seconds > 0)
+
+    def save_folded(self, path) -> None:
+        Path(path).write_text(self.folded())
+
+    def save(self, prefix) -> list:
+        '''
+        Saves the report as <prefix>.json, <prefix>.csv and <prefix>.folded.
+
+        Returns:
+            list: the paths saved.
+        '''
+        paths = [Path('{}.{}'.format(prefix, suffix))
+                    for suffix in ('json', 'csv', 'folded')]
+        self.save_json(paths[0])
+        self.save_csv(paths[1])
+        self.save_folded(paths[2])
+        return paths
+
+    def print_breakdown(self, width=40) -> None:
+        '''
+        Prints where the scan's time went, with a bar for each part.
+        '''
+        report = self.report()
+        elapsed = max(report['elapsed_s'], 1e-9)
+        rows = [('scanner idle', report['scanner_idle_s'])]
+        for kind in report['commands']:
+            for phase in ('first_byte', 'reply'):
+                rows.append(('{} {}'.format(kind, phase),
+                                self.histograms[kind, phase].total))
+        print('{:.2f} s, {} bytes sent, {} bytes received, {} reads timed '
+                'out after {:.1f} ms'.format(elapsed, report['bytes_sent'],
+                report['bytes_received'], self.timeouts,
+                self.timeout_seconds*1000))
+        for name, seconds in rows:
+            share = seconds / elapsed
+            print('{:<24} {:>9.1f} ms {:>5.1f}% {}'.format(name, seconds*1000,
+                    share*100, '#'*int(round(min(share, 1)*width))))
+        print('{:<12} {:>7} {:>9} {:>9} {:>9}'.format('command', 'count',
+                'p50 ms', 'p99 ms', 'max ms'))
+        for kind, entry in report['commands'].items():
+            total = entry['total']
+            print('{:<12} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}'.format(kind,
+                    total['count'], total['p50_ms'], total['p99_ms'],
+                    total['max_ms']))
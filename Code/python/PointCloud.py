@@ -0,0 +1,262 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+class PointCloud:
+    '''
+    A set of 3D points (and optionally their normals) with the cleanup steps
+    a scan usually needs. Each step returns a new PointCloud, so they can be
+    chained:
+
+        cloud = (PointCloud.from_range_image(image)
+                    .voxel_downsample(0.5)
+                    .remove_statistical_outliers()
+                    .estimate_normals())
+
+    Everything works on whole arrays, and the KD tree is only built once per
+    cloud, so this is fine for merged scans with millions of points.
+
+    Args:
+        xyz (np.ndarray): (n, 3) point coordinates in cm
+        normals (np.ndarray): (n, 3) unit normals, if they're known
+    '''
+    # how many points to estimate normals for at once, to keep memory down
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, xyz, normals=None) -> None:
+        self.xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        self.normals = None if normals is None else \
+                        np.asarray(normals, dtype=float).reshape(-1, 3)
+        self._tree = None
+
+    @classmethod
+    def from_range_image(cls, image) -> 'PointCloud':
+        '''
+        Makes a point cloud out of the valid points of a range image.
+
+        Args:
+            image (RangeImage): the scan
+
+        Returns:
+            PointCloud: the scan's points.
+        '''
+        return cls(np.stack(image.points(), axis=1))
+
+    def __len__(self) -> int:
+        return len(self.xyz)
+
+    def points(self) -> tuple:
+        '''
+        Gets the coordinates of the points, the same way RangeImage.points
+        does, so either can be plotted.
+
+        Returns:
+            tuple: 1D arrays of x, y and z in cm.
+        '''
+        return tuple(self.xyz.T)
+
+    @property
+    def tree(self) -> cKDTree:
+        # built on first use and kept, since most steps need it
+        if self._tree is None:
+            self._tree = cKDTree(self.xyz)
+        return self._tree
+
+    def _select(self, keep) -> 'PointCloud':
+        return PointCloud(self.xyz[keep],
+                            None if self.normals is None else self.normals[keep])
+
+    def voxel_downsample(self, size: float) -> 'PointCloud':
+        '''
+        Replaces all the points in each cube of a grid with their average,
+        which evens out the density (points bunch up close to the scanner)
+        and shrinks big clouds. Each point's cube is hashed to a single
+        integer, so grouping them is one sort.
+
+        Args:
+            size (float): the side length of the cubes in cm
+
+        Returns:
+            PointCloud: one point for each cube that had any.
+        '''
+        if len(self) == 0:
+            return self
+        cells = np.floor(self.xyz / size).astype(np.int64)
+        cells -= cells.min(axis=0)
+        # pack the three cube indices into one key
+        extent = cells.max(axis=0) + 1
+        keys = (cells[:, 0]*extent[1] + cells[:, 1])*extent[2] + cells[:, 2]
+        _, groups, counts = np.unique(keys, return_inverse=True,
+                                        return_counts=True)
+
+        def average(values):
+            return np.stack([np.bincount(groups, values[:, axis])
+                                for axis in range(3)], axis=1) / counts[:, None]
+
+        normals = None
+        if self.normals is not None:
+            normals = average(self.normals)
+            lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+            normals = normals / np.where(lengths > 0, lengths, 1)
+        return PointCloud(average(self.xyz), normals)
+
+    def remove_statistical_outliers(self, neighbours=16, std_ratio=2.0) \
+            -> 'PointCloud':
+        '''
+        Removes points that are unusually far from their nearest neighbours,
+        like single bad readings floating in front of or behind a surface.
+
+        Args:
+            neighbours (int): how many neighbours to measure the distance to
+            std_ratio (float): how many standard deviations above the average
+                a point's mean neighbour distance can be before it's removed
+
+        Returns:
+            PointCloud: the points that aren't outliers.
+        '''
+        if len(self) <= neighbours:
+            return self
+        # the nearest point to each point is itself, so skip it
+        distances, _ = self.tree.query(self.xyz, neighbours + 1, workers=-1)
+        mean = distances[:, 1:].mean(axis=1)
+        return self._select(mean <= mean.mean() + std_ratio*mean.std())
+
+    def remove_radius_outliers(self, radius: float, min_neighbours=4) \
+            -> 'PointCloud':
+        '''
+        Removes points with too few neighbours close by, like stray readings
+        from the background.
+
+        Args:
+            radius (float): how close a neighbour has to be in cm
+            min_neighbours (int): how many neighbours a point needs to stay
+
+        Returns:
+            PointCloud: the points with enough neighbours.
+        '''
+        counts = self.tree.query_ball_point(self.xyz, radius, workers=-1,
+                                            return_length=True)
+        # the counts include the point itself
+        return self._select(counts > min_neighbours)
+
+    def estimate_normals(self, neighbours=16, viewpoint=(0, 0, 0)) \
+            -> 'PointCloud':
+        '''
+        Works out the surface normal at each point from the plane that best
+        fits its neighbours (the direction they spread out least in). Normals
+        are flipped to face the viewpoint, which is where the scanner was.
+
+        Args:
+            neighbours (int): how many neighbours to fit the plane to
+            viewpoint: the (x, y, z) the normals should face
+
+        Returns:
+            PointCloud: the same points, with normals.
+        '''
+        neighbours = min(neighbours, len(self))
+        normals = np.empty_like(self.xyz)
+        for start in range(0, len(self), PointCloud.CHUNK_SIZE):
+            chunk = self.xyz[start:start + PointCloud.CHUNK_SIZE]
+            _, index = self.tree.query(chunk, neighbours, workers=-1)
+            local = self.xyz[index.reshape(len(chunk), neighbours)]
+            local = local - local.mean(axis=1, keepdims=True)
+            covariance = np.einsum('nki,nkj->nij', local, local)
+            # eigenvalues come out in ascending order
+            normals[start:start + len(chunk)] = np.linalg.eigh(covariance)[1][:, :, 0]
+        facing = np.einsum('ij,ij->i', normals, np.asarray(viewpoint) - self.xyz)
+        normals[facing < 0] *= -1
+        cloud = PointCloud(self.xyz, normals)
+        cloud._tree = self._tree
+        return cloud
+
+    def index(self, axis=0) -> 'AxisIndex':
+        '''
+        Sorts the points along an axis so ranges of it can be looked up
+        quickly, see AxisIndex.
+
+        Args:
+            axis (int): 0, 1 or 2 for x, y or z
+
+        Returns:
+            AxisIndex: the sorted points.
+        '''
+        return AxisIndex(self, axis)
+
+
+class AxisIndex:
+    '''
+    The points of a cloud sorted along one axis, so any range along it can
+    be found with a binary search instead of checking every point. The
+    points in a range are a slice of the sorted points, so nothing is copied
+    and the original cloud is never changed.
+
+    Args:
+        cloud (PointCloud): the points to index
+        axis (int): 0, 1 or 2 to sort along x, y or z
+    '''
+    def __init__(self, cloud: PointCloud, axis=0) -> None:
+        self.axis = axis
+        # where each sorted point was in the cloud, for sorting anything
+        # else that goes with the points
+        self.order = np.argsort(cloud.xyz[:, axis], kind='stable')
+        self.xyz = cloud.xyz[self.order]
+        self._keys = self.xyz[:, axis]
+
+    def __len__(self) -> int:
+        return len(self.xyz)
+
+    def _slice(self, low, high) -> slice:
+        start = 0 if low is None else \
+                np.searchsorted(self._keys, low, side='right')
+        stop = len(self) if high is None else \
+                np.searchsorted(self._keys, high, side='left')
+        return slice(start, max(start, stop))
+
+    def range(self, low=None, high=None) -> PointCloud:
+        '''
+        Gets the points between two values along the indexed axis.
+
+        Args:
+            low: the lower limit, exclusive. None for no limit
+            high: the upper limit, exclusive. None for no limit
+
+        Returns:
+            PointCloud: a view of the points in the range.
+        '''
+        return PointCloud(self.xyz[self._slice(low, high)])
+
+    def select(self, low, high):
+        '''
+        Finds the points inside a box. The indexed axis narrows the points
+        down first, so only those get checked against the other limits.
+
+        Args:
+            low: (x, y, z) lower limits, exclusive. any can be None
+            high: (x, y, z) upper limits, exclusive. any can be None
+
+        Returns:
+            a slice, or an array of indices, picking the points in the box
+            out of the sorted points.
+        '''
+        rows = self._slice(low[self.axis], high[self.axis])
+        candidates = self.xyz[rows]
+        keep = np.ones(len(candidates), dtype=bool)
+        for axis in range(3):
+            if axis == self.axis:
+                continue
+            if low[axis] is not None:
+                keep &= candidates[:, axis] > low[axis]
+            if high[axis] is not None:
+                keep &= candidates[:, axis] < high[axis]
+        if keep.all():
+            return rows
+        return rows.start + np.flatnonzero(keep)
+
+    def box(self, low, high) -> PointCloud:
+        '''
+        Gets the points inside a box, see select.
+
+        Returns:
+            PointCloud: the points in the box. a view of the sorted points
+                when only the indexed axis is limited.
+        '''
+        return PointCloud(self.xyz[self.select(low, high)])
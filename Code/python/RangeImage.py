@@ -0,0 +1,292 @@
+import warnings
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import helpers
+from scan_io import ScanFile
+
+class RangeImage:
+    '''
+    A scan as a dense 2D grid of distances, with one row per tilt step and
+    one column per pan step, like a picture taken by the scanner. Grid points
+    the scan didn't visit (or that were thrown out) are marked invalid in
+    valid and hold nan in depth.
+
+    Rows, columns and windows are numpy views, so slicing doesn't copy the
+    scan. Filters return a new RangeImage and leave this one alone, and the
+    cartesian coordinates are only worked out once.
+
+    Args:
+        depth (np.ndarray): distance in cm at each (tilt, pan) grid point
+        pan_start: the pan angle of the first column
+        tilt_start: the tilt angle of the first row
+        pan_step: the pan angle between columns
+        tilt_step: the tilt angle between rows
+        valid (np.ndarray): which grid points hold a distance. by default any
+            that aren't nan
+        pan_center: the pan angle facing the middle of the scan
+        tilt_center: the tilt angle facing the middle of the scan
+    '''
+    def __init__(self, depth, pan_start, tilt_start, pan_step=1, tilt_step=1,
+                    valid=None, pan_center=90, tilt_center=82) -> None:
+        depth = np.asarray(depth, dtype=float)
+        if valid is None:
+            valid = ~np.isnan(depth)
+        self.valid = np.asarray(valid, dtype=bool)
+        self.depth = np.where(self.valid, depth, np.nan)
+        self.pan_start = pan_start
+        self.tilt_start = tilt_start
+        self.pan_step = pan_step
+        self.tilt_step = tilt_step
+        self.pan_center = pan_center
+        self.tilt_center = tilt_center
+        self._cartesian = None
+
+    @classmethod
+    def from_points(cls, pan, tilt, depth, pan_center=90,
+                    tilt_center=82) -> 'RangeImage':
+        '''
+        Builds a range image from a list of scan points. The grid spacing is
+        the smallest step between the angles, so scans that skipped points
+        (like adaptive scans) just leave those grid points invalid.
+
+        Args:
+            pan: pan angle of each point
+            tilt: tilt angle of each point
+            depth: distance in cm at each point
+            pan_center: the pan angle facing the middle of the scan
+            tilt_center: the tilt angle facing the middle of the scan
+
+        Returns:
+            RangeImage: the scan as a grid.
+        '''
+        pan = np.asarray(pan, dtype=float)
+        tilt = np.asarray(tilt, dtype=float)
+        pan_start, pan_step = RangeImage._grid(pan)
+        tilt_start, tilt_step = RangeImage._grid(tilt)
+        cols = np.rint((pan - pan_start) / pan_step).astype(int)
+        rows = np.rint((tilt - tilt_start) / tilt_step).astype(int)
+        grid = np.full((rows.max() + 1, cols.max() + 1), np.nan)
+        grid[rows, cols] = depth
+        return cls(grid, pan_start, tilt_start, pan_step, tilt_step,
+                    pan_center=pan_center, tilt_center=tilt_center)
+
+    @classmethod
+    def from_scan(cls, scan, lut, pan_center=90, tilt_center=82) \
+            -> 'RangeImage':
+        '''
+        Builds a range image from a scan, converting its readings to distances.
+
+        Args:
+            scan: the scan, either a DataFrame with pan, tilt and raw (or
+                voltage) columns, or a ScanFile, whose memmapped columns are
+                used as they are
+            lut (np.ndarray): distance for each raw reading, from
+                helpers.distance_lut
+            pan_center: the pan angle facing the middle of the scan
+            tilt_center: the tilt angle facing the middle of the scan
+
+        Returns:
+            RangeImage: the scan as a grid.
+        '''
+        if isinstance(scan, ScanFile):
+            pan, tilt, raw = scan.pan, scan.tilt, scan.raw
+        else:
+            pan, tilt, raw = scan['pan'], scan['tilt'], helpers.raw_codes(scan)
+        return cls.from_points(pan, tilt, lut[raw], pan_center, tilt_center)
+
+    @staticmethod
+    def _grid(angles) -> tuple:
+        # the first angle and the smallest step between angles
+        unique = np.unique(angles)
+        steps = np.diff(unique)
+        return unique[0], (steps.min() if len(steps) else 1)
+
+    @property
+    def shape(self) -> tuple:
+        return self.depth.shape
+
+    @property
+    def pans(self) -> np.ndarray:
+        return self.pan_start + self.pan_step*np.arange(self.shape[1])
+
+    @property
+    def tilts(self) -> np.ndarray:
+        return self.tilt_start + self.tilt_step*np.arange(self.shape[0])
+
+    def _like(self, depth, valid) -> 'RangeImage':
+        # a new image on the same grid as this one
+        return RangeImage(depth, self.pan_start, self.tilt_start, self.pan_step,
+                            self.tilt_step, valid, self.pan_center,
+                            self.tilt_center)
+
+    def _col(self, pan) -> int:
+        return int(round((pan - self.pan_start) / self.pan_step))
+
+    def _row(self, tilt) -> int:
+        return int(round((tilt - self.tilt_start) / self.tilt_step))
+
+    def row(self, tilt) -> 'RangeImage':
+        '''
+        Gets one horizontal line of the scan.
+
+        Args:
+            tilt: the tilt angle of the line
+
+        Returns:
+            RangeImage: a single row image that views this one.
+        '''
+        return self.window(self.pans[0], self.pans[-1], tilt, tilt)
+
+    def column(self, pan) -> 'RangeImage':
+        '''
+        Gets one vertical line of the scan.
+
+        Args:
+            pan: the pan angle of the line
+
+        Returns:
+            RangeImage: a single column image that views this one.
+        '''
+        return self.window(pan, pan, self.tilts[0], self.tilts[-1])
+
+    def window(self, pan_min, pan_max, tilt_min, tilt_max) -> 'RangeImage':
+        '''
+        Gets the part of the scan between two pan angles and two tilt angles,
+        inclusive.
+
+        Returns:
+            RangeImage: an image that views this one.
+        '''
+        cols = slice(max(self._col(pan_min), 0), max(self._col(pan_max) + 1, 0))
+        rows = slice(max(self._row(tilt_min), 0),
+                        max(self._row(tilt_max) + 1, 0))
+        # skip the constructor so the arrays are shared instead of copied
+        image = object.__new__(RangeImage)
+        image.__dict__.update(self.__dict__)
+        image.depth = self.depth[rows, cols]
+        image.valid = self.valid[rows, cols]
+        image.pan_start = self.pan_start + cols.start*self.pan_step
+        image.tilt_start = self.tilt_start + rows.start*self.tilt_step
+        if self._cartesian is not None:
+            image._cartesian = tuple(axis[rows, cols]
+                                        for axis in self._cartesian)
+        return image
+
+    def _neighbourhoods(self, size: int) -> np.ndarray:
+        # every size x size neighbourhood, with nan past the edges
+        pad = size // 2
+        padded = np.pad(self.depth, pad, constant_values=np.nan)
+        return sliding_window_view(padded, (size, size))
+
+    def median_filter(self, size=3) -> 'RangeImage':
+        '''
+        Replaces each distance with the median of the valid distances around
+        it, which gets rid of single bad readings without blurring edges much.
+
+        Args:
+            size (int): the width of the neighbourhood, an odd number
+
+        Returns:
+            RangeImage: the filtered image. invalid points stay invalid.
+        '''
+        with warnings.catch_warnings():
+            # neighbourhoods with no valid points are fine, they're invalid
+            warnings.simplefilter('ignore', RuntimeWarning)
+            medians = np.nanmedian(self._neighbourhoods(size), axis=(2, 3))
+        return self._like(medians, self.valid)
+
+    def bilateral_filter(self, size=5, sigma_space=1.0, sigma_range=2.0) \
+            -> 'RangeImage':
+        '''
+        Smooths the distances while keeping edges sharp: each distance is
+        averaged with its neighbours, weighted by how close they are on the
+        grid and how close their distances are to its own.
+
+        Args:
+            size (int): the width of the neighbourhood, an odd number
+            sigma_space (float): how quickly the weight falls off with grid
+                distance, in grid points
+            sigma_range (float): how quickly the weight falls off with
+                difference in distance, in cm
+
+        Returns:
+            RangeImage: the filtered image. invalid points stay invalid.
+        '''
+        windows = self._neighbourhoods(size)
+        offsets = np.arange(size) - size // 2
+        space = np.exp(-(offsets[:, None]**2 + offsets[None, :]**2)
+                        / (2*sigma_space**2))
+        difference = windows - self.depth[:, :, None, None]
+        weights = space * np.exp(-difference**2 / (2*sigma_range**2))
+        weights = np.where(np.isnan(weights), 0, weights)
+        total = np.sum(weights*np.nan_to_num(windows), axis=(2, 3))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            smoothed = total / np.sum(weights, axis=(2, 3))
+        return self._like(smoothed, self.valid)
+
+    def within(self, min_dist=None, max_dist=None) -> 'RangeImage':
+        '''
+        Marks points outside a range of depths (the x coordinate, straight
+        out from the scanner) as invalid.
+
+        Args:
+            min_dist: the smallest x in cm to keep, exclusive
+            max_dist: the largest x in cm to keep, exclusive
+
+        Returns:
+            RangeImage: an image with only the points in range valid.
+        '''
+        return self.box((min_dist, None, None), (max_dist, None, None))
+
+    def box(self, low, high) -> 'RangeImage':
+        '''
+        Marks points outside a box as invalid, like AxisIndex.box does for a
+        point cloud.
+
+        Args:
+            low: (x, y, z) lower limits in cm, exclusive. any can be None
+            high: (x, y, z) upper limits in cm, exclusive. any can be None
+
+        Returns:
+            RangeImage: an image with only the points in the box valid.
+        '''
+        valid = self.valid.copy()
+        with np.errstate(invalid='ignore'):
+            for axis, lower, upper in zip(self.cartesian(), low, high):
+                if lower is not None:
+                    valid &= axis > lower
+                if upper is not None:
+                    valid &= axis < upper
+        image = self._like(self.depth, valid)
+        image._cartesian = tuple(np.where(valid, axis, np.nan)
+                                    for axis in self._cartesian)
+        return image
+
+    def cartesian(self) -> tuple:
+        '''
+        Converts the whole grid to cartesian coordinates, with the center
+        angles facing along x. The result is kept, so this only does the work
+        the first time.
+
+        Returns:
+            tuple: x, y and z grids in cm, nan where the image is invalid.
+        '''
+        if self._cartesian is None:
+            pans, tilts = np.meshgrid(self.pans, self.tilts)
+            xs, ys, zs = helpers.sph2cart(np.deg2rad(self.pan_center - pans),
+                                            np.deg2rad(tilts - self.tilt_center),
+                                            self.depth)
+            # flip the y axis, not really sure why this is necessary but the
+            # scan is backwards if this isn't done
+            ys *= -1
+            self._cartesian = (xs, ys, zs)
+        return self._cartesian
+
+    def points(self) -> tuple:
+        '''
+        Gets the cartesian coordinates of the valid points.
+
+        Returns:
+            tuple: 1D arrays of x, y and z in cm.
+        '''
+        return tuple(axis[self.valid] for axis in self.cartesian())
@@ -1,86 +1,618 @@
+from collections import deque
+import random
+import string
+import time
+import numpy as np
+import serial
 from SerialDevice import SerialDevice
+from CommandTiming import CommandTiming
 import helpers
+import scan_paths
+
+class Command:
+    '''
+    A command that has been sent to the scanner, along with whatever the
+    scanner has replied to it so far. Commands are answered strictly in the
+    order they were sent, so each line received belongs to the oldest
+    command that hasn't seen its 'ready' yet.
+
+    In binary mode, readings are stored as (pan, tilt, reading) tuples
+    instead of lines of text, and sample statistics as the same Q line the
+    text protocol uses.
+    '''
+    def __init__(self, scanner, text: str, parse=None) -> None:
+        self.scanner = scanner
+        self.text = text
+        # bytes the command occupies in the arduino's input buffer,
+        # including the carriage return that terminates it
+        self.size = len(text) + 1 if text is not None else 0
+        self.parse = parse
+        self.lines = []
+        self.done = False
+        self._result = None
+        # timestamps and bytes received, kept while the scanner is timed
+        self.submitted = None
+        self.written = None
+        self.first = None
+        self.received = 0
+
+    def _finish(self) -> None:
+        '''
+        Marks the command as answered and parses whatever was received.
+        '''
+        if self.parse is not None:
+            self._result = self.parse(self.lines)
+        self.done = True
+
+    def result(self):
+        '''
+        Waits until the scanner has answered this command (and every command
+        sent before it), then returns the parsed reply.
+
+        Returns:
+            the parsed reply, or None if the command has no reply to parse.
+        '''
+        while not self.done:
+            self.scanner._pump()
+        return self._result
+
 
 class Scanner:
-    def __init__(self, max_angle=170) -> None:
-        self.dev = SerialDevice()
-        self._ready = False
+    # the arduino uno's hardware serial receive buffer. commands sent while
+    # the scanner is busy wait in here, so the total size of everything in
+    # flight can't be allowed to overflow it
+    RX_BUFFER_SIZE = 64
+    # ways the scanner can combine the samples behind a reading
+    SAMPLE_MODES = ('min', 'median', 'mean')
+    # faster link speeds to try, which a 16 MHz arduino can all hit exactly
+    BAUD_RATES = (250000, 500000, 1000000, 2000000)
+    # seconds the scanner waits for a new speed to be confirmed before going
+    # back, must match BAUD_TIMEOUT in communication.ino
+    BAUD_TIMEOUT = 1.0
+
+    def __init__(self, max_angle=170, window=8, binary=True, dev=None,
+                    fast_baud=True) -> None:
+        # connect interactively unless we're handed a device to use
+        self.dev = dev if dev is not None else SerialDevice()
         self.max_angle = max_angle
+        self.window = window        # max number of commands in flight
         self.pan_angle = None
         self.tilt_angle = None
+        self.settle_profile = None  # the profile uploaded, if any
+        self._pending = deque()
+        self._in_flight = 0         # bytes of unanswered commands
+        self.timing = None          # see instrument
         print('syncing with scanner...')
+        self.sync()
+        if fast_baud:
+            baud = self.negotiate_baud()
+            if baud != self.dev.baud:
+                print('switched to baud rate {}'.format(baud))
         # zero the scanner on connection so it knows where it's pointing
         self.zero()
+        if binary and not self.set_binary(True):
+            print('scanner doesn\'t support binary replies, using text')
 
     @property
     def ready(self) -> bool:
-        return self._ready
-    
-    def _read_until_ready(self) -> list:
+        return not self._pending
+
+    def instrument(self, timing: CommandTiming = None) -> CommandTiming:
+        '''
+        Starts timing every command sent from here on, see CommandTiming.
+        Timing costs a few clock reads per command and line received.
+
+        Args:
+            timing (CommandTiming): where to record the times, or None to
+                start a new one
+
+        Returns:
+            CommandTiming: the times recorded. its report covers everything
+                since it was attached.
+        '''
+        self.flush()
+        self.timing = timing if timing is not None else CommandTiming()
+        self.dev.timing = self.timing
+        return self.timing
+
+    def stop_timing(self) -> CommandTiming:
+        '''
+        Stops timing commands.
+
+        Returns:
+            CommandTiming: the times recorded, or None if nothing was timed.
+        '''
+        self.flush()
+        timing = self.timing
+        self.timing = self.dev.timing = None
+        return timing
+
+    def _received(self, command: Command) -> None:
+        # note when a line or frame for a timed command arrived
+        arrival = self.dev.last_received
+        if command.written is None or arrival is None:
+            return
+        if command.first is None:
+            command.first = arrival[0]
+        command.received += arrival[2]
+
+    def _answered(self, command: Command) -> None:
+        # record a timed command once its 'ready' has arrived
+        self._received(command)
+        if command.written is None or self.dev.last_received is None:
+            return
+        self.timing.command(command.text.split('|', 1)[0], command.submitted,
+                            command.written, command.first,
+                            self.dev.last_received[1], command.size,
+                            command.received)
+
+    def _pump(self) -> None:
+        '''
+        Reads one line (or frame, in binary mode) from the scanner and hands
+        it to the oldest command still waiting for a reply. A 'ready'
+        completes that command.
+        '''
+        if self.dev.binary:
+            self._pump_frame()
+            return
+        line = self.dev.read().strip()
+        # don't bother with empty strings, and drop anything that arrives
+        # when nothing was asked for (like the 'ready' sent on startup)
+        if line == '' or not self._pending:
+            return
+        command = self._pending[0]
+        if line == 'ready':
+            self._pending.popleft()
+            self._in_flight -= command.size
+            if self.timing is not None:
+                self._answered(command)
+            command._finish()
+        else:
+            if self.timing is not None:
+                self._received(command)
+            command.lines.append(line)
+
+    def _pump_frame(self) -> None:
+        '''
+        Reads one binary frame from the scanner and hands it to the oldest
+        command still waiting for a reply, the same way _pump does for text.
+        '''
+        frame = self.dev.read_frame()
+        if frame is None or not self._pending:
+            return
+        kind, pan, tilt, reading = frame
+        command = self._pending[0]
+        if kind == SerialDevice.FRAME_READY:
+            self._pending.popleft()
+            self._in_flight -= command.size
+            if self.timing is not None:
+                self._answered(command)
+            command._finish()
+            return
+        if self.timing is not None:
+            self._received(command)
+        if kind == SerialDevice.FRAME_READING:
+            command.lines.append((pan, tilt, reading))
+        elif kind == SerialDevice.FRAME_STATS:
+            # min, median and spread ride in the pan, tilt and reading fields
+            command.lines.append('Q{},{},{}'.format(pan, tilt, reading))
+        elif kind == SerialDevice.FRAME_ERROR:
+            command.lines.append('unknown command!')
+
+    def _completed(self) -> Command:
+        '''
+        Makes a command that was never sent but counts as answered, for
+        requests that get rejected before reaching the scanner.
+        '''
+        command = Command(self, None)
+        command.done = True
+        return command
+
+    def submit(self, text: str, parse=None) -> Command:
+        '''
+        Sends a command without waiting for it to be answered. If the window
+        is full, or the command wouldn't fit in the scanner's input buffer,
+        replies are read until there's room.
+
+        Args:
+            text (str): the command to send.
+            parse: optional function turning the lines received before
+                'ready' into a result.
+
+        Returns:
+            Command: the command, which can be waited on with result().
+        '''
+        command = Command(self, text, parse)
+        if self.timing is not None:
+            command.submitted = time.perf_counter()
+        while self._full(command.size):
+            self._pump()
+        self.dev.write(text)
+        if self.timing is not None:
+            command.written = time.perf_counter()
+        self._pending.append(command)
+        self._in_flight += command.size
+        return command
+
+    def _full(self, size: int) -> bool:
+        # whether a command of this many bytes has to wait to be sent
+        return bool(self._pending) and (len(self._pending) >= self.window or
+                    self._in_flight + size > Scanner.RX_BUFFER_SIZE)
+
+    def flush(self) -> None:
+        '''
+        Waits until every command sent so far has been answered.
+        '''
+        while self._pending:
+            self._pump()
+
+    def sync(self, attempts: int = 5) -> None:
+        '''
+        Pings the scanner until it answers, throwing away anything it sent
+        before that (like the 'ready' it sends on startup, which would
+        otherwise be taken as the reply to the first command). The scanner
+        goes back to text replies when pinged.
+
+        Args:
+            attempts (int): how many pings to send before giving up.
+        '''
+        self._pending.clear()
+        self._in_flight = 0
+        self.dev.binary = False
+        for attempt in range(attempts):
+            self.dev.write('PING')
+            # the arduino ignores anything sent while it's starting up, so
+            # ping again if nothing comes back before the timeout, or as soon
+            # as it says it's ready
+            line = self.dev.read().strip()
+            while line not in ('', 'pong', 'ready'):
+                line = self.dev.read().strip()
+            if line == 'pong':
+                while line != 'ready':
+                    line = self.dev.read().strip()
+                # an earlier ping might still be answered if it wasn't lost,
+                # which would look like the reply to the next command
+                if attempt > 0:
+                    while self.dev.read(timeout=0.1) != '':
+                        pass
+                return
+        raise ConnectionError('the scanner isn\'t responding!')
+
+    def negotiate_baud(self, rates=BAUD_RATES, echoes=16) -> int:
+        '''
+        Moves the link to the fastest baud rate that works, trying each rate
+        from slowest to fastest by switching both ends over and checking a
+        burst of echoed messages against their checksums. A rate that works
+        is confirmed so the scanner keeps it. Once one doesn't, both ends go
+        back to the last good rate (the scanner does that by itself when it
+        isn't confirmed) and faster ones aren't tried. A rate the host's serial
+        adapter won't take is skipped the same way, but faster ones are still
+        tried, since adapters often only support some rates.
+
+        Args:
+            rates: the baud rates to try
+            echoes (int): how many messages to check each rate with
+
+        Returns:
+            int: the baud rate in use.
+        '''
+        binary = self.dev.binary
+        self.sync()
+        best = self.dev.ser.baudrate
+        for rate in sorted(rates):
+            if rate <= best:
+                continue
+            command = self.submit('BAUD|{}'.format(rate))
+            command.result()
+            if 'unknown command!' in command.lines:
+                break       # older firmware, stay at the speed it has
+            switched = time.perf_counter()
+            try:
+                self.dev.set_baud(rate)
+                rejected = False
+            except (ValueError, serial.SerialException):
+                rejected = True
+            if not rejected and \
+                    self._check_link(echoes, switched + Scanner.BAUD_TIMEOUT/2):
+                self.submit('BAUDOK').result()
+                best = rate
+                continue
+            # go back and wait for the scanner to give up on the new speed
+            self.dev.set_baud(best)
+            time.sleep(max(switched + Scanner.BAUD_TIMEOUT + 0.1 -
+                            time.perf_counter(), 0))
+            self.dev.discard()
+            self.sync()
+            if not rejected:
+                break
+        if binary:
+            self.set_binary(True)
+        return best
+
+    def _check_link(self, echoes: int, deadline: float) -> bool:
+        '''
+        Checks the link by having the scanner echo random messages along
+        with a checksum of what it received.
+
+        Args:
+            echoes (int): how many messages to send
+            deadline (float): perf_counter time to give up at
+
+        Returns:
+            bool: True if every message came back intact in time.
+        '''
+        try:
+            self.sync(attempts=1)
+        except ConnectionError:
+            return False
+        characters = string.ascii_letters + string.digits
+        payloads = [''.join(random.choices(characters, k=24))
+                    for _ in range(echoes)]
+        # a reply mangled on the way might never finish its command, so
+        # only wait until the deadline
+        commands = []
+        for payload in payloads:
+            text = 'ECHO|' + payload
+            while self._full(len(text) + 1):
+                if time.perf_counter() >= deadline:
+                    return False
+                self._pump()
+            commands.append(self.submit(text))
+        while self._pending and time.perf_counter() < deadline:
+            self._pump()
+        for payload, command in zip(payloads, commands):
+            expected = '{}|{}'.format(payload, sum(payload.encode()) & 0xFFFF)
+            if not command.done or command.lines != [expected]:
+                return False
+        return True
+
+    def set_binary(self, enabled: bool) -> bool:
+        '''
+        Asks the scanner to switch between binary frames and lines of text for
+        its replies. The scanner answers in the old format, then switches.
+
+        Args:
+            enabled (bool): True for binary frames, False for text.
+
+        Returns:
+            bool: True if the scanner understood the request.
+        '''
+        self.flush()
+        command = self.submit('BINARY|{}'.format(int(enabled)))
+        command.result()
+        if 'unknown command!' in command.lines:
+            return False
+        self.dev.binary = enabled
+        return True
+
+    def queue_delay(self, time: int) -> Command:
+        '''
+        Instructs the scanner to wait for a specific amount of time without
+        waiting for it to finish.
+
+        Args:
+            time (int): The amount of time to wait in milliseconds.
+
+        Returns:
+            Command: the pending command.
+        '''
+        return self.submit('DELAY|{}'.format(time))
+
+    def queue_pan(self, angle: int, wait: int = None) -> Command:
+        '''
+        Instructs the scanner to pan to an angle without waiting for it to
+        finish.
+
+        Args:
+            angle (int): the angle to pan to.
+            wait (int): how long the scanner should wait for the move in
+                milliseconds. by default it uses its settle profile.
+
+        Returns:
+            Command: the pending command.
+        '''
+        # don't send a command if the angle is invalid
+        if angle < 0 or angle > self.max_angle:
+            return self._completed()
+        self.pan_angle = angle      # keep track of the new angle
+        if wait is not None:
+            return self.submit('PAN|{}|{}'.format(angle, wait))
+        return self.submit('PAN|{}'.format(angle))
+
+    def queue_tilt(self, angle: int, wait: int = None) -> Command:
+        '''
+        Instructs the scanner to tilt to an angle without waiting for it to
+        finish.
+
+        Args:
+            angle (int): the angle to tilt to.
+            wait (int): how long the scanner should wait for the move in
+                milliseconds. by default it uses its settle profile.
+
+        Returns:
+            Command: the pending command.
+        '''
+        # don't send a command if the angle is invalid
+        if angle < 0 or angle > self.max_angle:
+            return self._completed()
+        self.tilt_angle = angle     # keep track of the new angle
+        if wait is not None:
+            return self.submit('TILT|{}|{}'.format(angle, wait))
+        return self.submit('TILT|{}'.format(angle))
+
+    @staticmethod
+    def _sampling(samples: int, mode: str, tolerance: int) -> str:
+        '''
+        Builds the |n|mode|tolerance arguments that choose how the scanner
+        samples the sensor, or an empty string to sample the default way.
+        '''
+        if samples is None and mode is None and tolerance is None:
+            return ''
+        if mode is not None and mode not in Scanner.SAMPLE_MODES:
+            raise ValueError('mode must be one of {}'.format(
+                                Scanner.SAMPLE_MODES))
+        return '|{}|{}|{}'.format(samples or 0,
+                    Scanner.SAMPLE_MODES.index(mode) if mode is not None else 0,
+                    tolerance or 0)
+
+    def queue_read_sensor(self, raw: bool = False, samples: int = None,
+                            mode: str = None, tolerance: int = None) -> Command:
+        '''
+        Instructs the scanner to send a sensor reading without waiting for it.
+        The result of the returned command is the same tuple read_sensor
+        returns.
+
+        Args:
+            raw (bool): give the raw sensor reading (0-1023) as an int
+                instead of converting it to a voltage.
+            samples, mode, tolerance: how to sample the sensor, see
+                read_sensor.
+
+        Returns:
+            Command: the pending command.
+        '''
+        return self.submit('READSENSOR' + Scanner._sampling(samples, mode,
+                                                            tolerance),
+                    Scanner._parse_raw_reading if raw else Scanner._parse_reading)
+
+    def upload_settle_profile(self, profile: dict) -> bool:
+        '''
+        Sends a settle profile to the scanner, replacing the fixed time per
+        degree it waits after each move. See scan_paths.settle_time.
+
+        Args:
+            profile (dict): maps 'pan' and 'tilt' to lists of (step size in
+                degrees, wait in msec)
+
+        Returns:
+            bool: True if the scanner understood the profile.
+        '''
+        commands = []
+        for axis, name in enumerate(scan_paths.AXES):
+            # clear the old profile first
+            commands.append(self.submit('SETTLE|{}|0|0'.format(axis)))
+            for deg, ms in profile.get(name, []):
+                commands.append(self.submit('SETTLE|{}|{}|{}'.format(
+                                            axis, deg, ms)))
+        for command in commands:
+            command.result()
+            if 'unknown command!' in command.lines:
+                return False
+        self.settle_profile = profile
+        return True
+
+    def queue_move_and_read(self, pan: int, tilt: int, raw: bool = False,
+                            samples: int = None, mode: str = None,
+                            tolerance: int = None) -> Command:
+        '''
+        Instructs the scanner to move both servos to a point and send a
+        sensor reading from there, all in one command, without waiting for
+        it. The result of the returned command is the same tuple
+        read_sensor returns.
+
+        Args:
+            pan (int): the angle to pan to.
+            tilt (int): the angle to tilt to.
+            raw (bool): give the raw sensor reading (0-1023) as an int
+                instead of converting it to a voltage.
+            samples, mode, tolerance: how to sample the sensor, see
+                read_sensor.
+
+        Returns:
+            Command: the pending command.
+        '''
+        # don't send a command if either angle is invalid
+        if not (0 <= pan <= self.max_angle and 0 <= tilt <= self.max_angle):
+            return self._completed()
+        self.pan_angle = pan        # keep track of the new angles
+        self.tilt_angle = tilt
+        return self.submit('POINT|{}|{}'.format(pan, tilt) +
+                            Scanner._sampling(samples, mode, tolerance),
+                    Scanner._parse_raw_reading if raw else Scanner._parse_reading)
+
+    @staticmethod
+    def _parse_raw_reading(received: list) -> tuple:
+        '''
+        Cleans the lines sent in reply to a sensor reading without converting
+        the reading to a voltage.
+
+        Args:
+            received (list): the lines (or binary readings) received
+                before 'ready'
+
+        Returns:
+            tuple: (int: pan angle, int: tilt angle, int: raw sensor reading),
+                followed by (int: min, int: median, int: spread) of the
+                samples if the scanner sent them
+        '''
+        readings = [data for data in received if isinstance(data, tuple)]
+        lines = [data.strip() for data in received if isinstance(data, str)]
+        if readings:
+            reading = readings[-1]
+        else:
+            reading = tuple(int(line[1:]) for line in lines if \
+                line[:1] in ('X', 'Y', 'Z'))
+        stats = [line for line in lines if line[:1] == 'Q']
+        if stats:
+            reading += tuple(int(value) for value in stats[-1][1:].split(','))
+        return reading
+
+    @staticmethod
+    def _parse_reading(received: list) -> tuple:
         '''
-        Reads data from the scanner until it is ready for a new instruction.
-        Any data read is returned as a list of lines.
+        Cleans the lines sent in reply to a sensor reading. See read_sensor
+        for the expected form.
+
+        Args:
+            received (list): the lines (or binary readings) received
+                before 'ready'
 
         Returns:
-            list: the lines of data received before 'ready'
+            tuple: (float: pan angle, float: tilt angle, float: sensor reading),
+                followed by (float: min, float: median, float: spread) of the
+                samples if the scanner sent them
         '''
-        data = []
-        # loop if not ready or data waiting in input buffer
-        while not self._ready or self.dev.ser.in_waiting:
-            # read data from the input buffer, add it to the list if it
-            # isn't 'ready'
-            line = self.dev.read()
-            if line.strip() == 'ready':
-                self._ready = True
-            # don't add empty strings to the list
-            elif line.strip() != '':
-                data.append(line)
-        return data
+        pan, tilt, *values = Scanner._parse_raw_reading(received)
+        return (float(pan), float(tilt)) + tuple(
+                    float(helpers.raw_to_voltage(value)) for value in values)
 
     def delay(self, time: int) -> None:
         '''
         Instructs the scanner to wait for a specific amount of time,
         then waits for a ready signal.
-        
+
         Intended to be used to mitigate the scanner shaking and
         messing up the readings.
 
         Args:
             time (int): The amount of time to wait in milliseconds.
         '''
-        self.dev.write('DELAY|{}'.format(time))
-        self._ready = False
-        self._read_until_ready()
+        self.queue_delay(time).result()
 
-    def pan(self, angle: int) -> None:
+    def pan(self, angle: int, wait: int = None) -> None:
         '''
         Instructs the scanner to pan to an angle, then waits for a ready signal.
 
         Args:
             angle (int): the angle to pan to.
+            wait (int): how long the scanner should wait for the move in
+                milliseconds. by default it uses its settle profile.
         '''
-        # don't send a command if the angle is invalid
-        if angle >= 0 and angle <= self.max_angle:
-            self.dev.write('PAN|{}'.format(angle))
-            self._ready = False
-            self.pan_angle = angle      # keep track of the new angle
-            self._read_until_ready()
+        self.queue_pan(angle, wait).result()
 
-    def tilt(self, angle: int) -> None:
+    def tilt(self, angle: int, wait: int = None) -> None:
         '''
         Instructs the scanner to tilt to an angle, then waits for a ready signal.
 
         Args:
             angle (int): the angle to tilt to.
+            wait (int): how long the scanner should wait for the move in
+                milliseconds. by default it uses its settle profile.
         '''
-        # don't send a command if the angle is invalid
-        if angle >= 0 and angle <= self.max_angle:
-            self.dev.write('TILT|{}'.format(angle))
-            self._ready = False
-            self.tilt_angle = angle     # keep track of the new angle
-            self._read_until_ready()
+        self.queue_tilt(angle, wait).result()
 
-    def read_sensor(self) -> tuple:
+    def read_sensor(self, raw: bool = False, samples: int = None,
+                    mode: str = None, tolerance: int = None) -> tuple:
         '''
         Instructs the scanner to send a sensor reading then waits for the
         reading and a ready signal. The data is then cleaned and returned as a tuple.
@@ -92,18 +624,112 @@ class Scanner:
         Y35
         Z445
 
+        In binary mode the same values arrive as a single reading frame.
+
+        By default the reading is the minimum of 10 samples. Giving any of
+        samples, mode or tolerance changes that, and the scanner also sends
+        the min, median and spread (max - min) of the samples on a fourth line
+        like Q440,445,9, so noisy points can be spotted.
+
+        Args:
+            raw (bool): give the raw sensor reading (0-1023) as an int
+                instead of converting it to a voltage.
+            samples (int): the most samples to take, up to 32
+            mode (str): how to combine the samples: 'min', 'median' or 'mean'
+            tolerance (int): stop sampling once 3 or more samples are within
+                this many raw units of each other. 0 always takes them all
+
+        Returns:
+            tuple: (float: pan angle, float: tilt angle, float: sensor reading),
+                followed by (float: min, float: median, float: spread) when
+                samples, mode or tolerance are given
+        '''
+        return self.queue_read_sensor(raw, samples, mode, tolerance).result()
+
+    def move_and_read(self, pan: int, tilt: int, raw: bool = False,
+                        samples: int = None, mode: str = None,
+                        tolerance: int = None) -> tuple:
+        '''
+        Instructs the scanner to move to a point and take a sensor reading
+        there, then waits for the reading and a ready signal. Both servos move
+        at the same time, and the whole thing costs one round trip instead of
+        one for each of pan, tilt and read_sensor.
+
+        Args:
+            pan (int): the angle to pan to.
+            tilt (int): the angle to tilt to.
+            raw (bool): give the raw sensor reading (0-1023) as an int
+                instead of converting it to a voltage.
+            samples, mode, tolerance: how to sample the sensor, see
+                read_sensor.
+
+        Returns:
+            tuple: (float: pan angle, float: tilt angle, float: sensor reading),
+                or None if either angle is invalid. See read_sensor for the
+                sample statistics that can follow
+        '''
+        return self.queue_move_and_read(pan, tilt, raw, samples, mode,
+                                        tolerance).result()
+
+    def stream_scan(self, pans: range, tilts: range, settle: int = 0):
+        '''
+        Instructs the scanner to run a whole scan by itself and yields each
+        reading as it arrives. The scanner doesn't wait for the host between
+        points, so the only round trip is the one for the scan as a whole.
+
+        Points arrive in the order the scanner visits them, which sweeps tilt
+        up one column and back down the next.
+
+        Args:
+            pans (range): the pan angles to scan, with a positive step.
+            tilts (range): the tilt angles to scan, with a positive step.
+            settle (int): extra time to wait at each point in milliseconds.
+
+        Yields:
+            tuple: (int: pan angle, int: tilt angle, int: raw sensor reading)
+        '''
+        command = self.submit('SCAN|{}|{}|{}|{}|{}|{}|{}'.format(
+            pans.start, pans.stop, pans.step,
+            tilts.start, tilts.stop, tilts.step, settle))
+        while True:
+            while command.lines:
+                line = command.lines.pop(0)
+                if isinstance(line, tuple):     # binary reading
+                    self.pan_angle, self.tilt_angle = line[0], line[1]
+                    yield line
+                elif line[0] == 'S':
+                    pan, tilt, reading = (int(val) for val in line[1:].split(','))
+                    self.pan_angle = pan
+                    self.tilt_angle = tilt
+                    yield pan, tilt, reading
+            if command.done:
+                return
+            self._pump()
+
+    def scan_array(self, pans: range, tilts: range, settle: int = 0,
+                    progress=None) -> np.ndarray:
+        '''
+        Runs a streamed scan (see stream_scan) and collects the readings
+        straight into an array.
+
+        Args:
+            pans (range): the pan angles to scan, with a positive step.
+            tilts (range): the tilt angles to scan, with a positive step.
+            settle (int): extra time to wait at each point in milliseconds.
+            progress: optional progress bar (like tqdm) to update as
+                readings arrive.
+
         Returns:
-            tuple: (float: pan angle, float: tilt angle, float: sensor reading)
+            np.ndarray: one (pan, tilt, raw sensor reading) row per point, in
+                the order they were scanned.
         '''
-        self.dev.write('READSENSOR')    # send the instruction
-        self._ready = False
-        received = self._read_until_ready()
-        # format the received data according to the expected form shown in
-        # the method docstring
-        cleaned_data = [int(data.strip()[1:]) for data in received if \
-            data.strip()[0] in ('X', 'Y', 'Z')]
-        cleaned_data[2] = helpers.map(cleaned_data[2], 0, 1023, 0, 5)
-        return tuple(float(val) for val in cleaned_data)
+        data = np.empty((len(pans)*len(tilts), 3), dtype=np.int16)
+        count = 0
+        for count, point in enumerate(self.stream_scan(pans, tilts, settle), 1):
+            data[count-1] = point
+            if progress is not None:
+                progress.update()
+        return data[:count]
 
     def zero(self) -> None:
         '''
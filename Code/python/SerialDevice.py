@@ -1,8 +1,128 @@
 from helpers import yesno_confirm
+import simulator
+from pathlib import Path
+import json
+import struct
+import threading
+import time
 import serial
 import serial.tools.list_ports as list_ports
 from serial.tools.list_ports_common import ListPortInfo
 
+NEWLINE = ord('\n')
+# the last port connected to, so the next connection doesn't have to ask
+CONNECTION_PROFILE = Path.home() / '.pantilt' / 'connection.json'
+
+
+class RingBuffer:
+    '''
+    fixed size circular byte buffer. bytes are written at one end and read
+    from the other without ever moving the data that's already stored.
+    not thread safe on its own, SerialDevice guards it with a lock.
+    '''
+    def __init__(self, size: int) -> None:
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0     # index of the oldest byte
+        self._len = 0       # number of bytes stored
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getitem__(self, index: int) -> int:
+        return self._buf[(self._start + index) % len(self._buf)]
+
+    @property
+    def free(self) -> int:
+        return len(self._buf) - self._len
+
+    def write(self, data) -> int:
+        '''
+        store as much of some data as there is room for.
+
+        Args:
+            data: a bytes-like object to store
+
+        Returns:
+            int: the number of bytes stored.
+        '''
+        size = len(self._buf)
+        count = min(len(data), self.free)
+        end = (self._start + self._len) % size
+        first = min(count, size - end)
+        self._view[end:end+first] = data[:first]
+        self._view[:count-first] = data[first:count]
+        self._len += count
+        return count
+
+    def find(self, value: int, start: int = 0) -> int:
+        '''
+        find the first occurrence of a byte value.
+
+        Args:
+            value (int): the byte to look for
+            start (int): how far from the oldest byte to start looking
+
+        Returns:
+            int: the position of the byte counting from the oldest byte
+                stored, or -1 if it wasn't found.
+        '''
+        size = len(self._buf)
+        # the stored bytes are at most two contiguous pieces, the one up to
+        # the end of the buffer and the one that wrapped around to the front
+        first_end = min(self._start + self._len, size)
+        if self._start + start < first_end:
+            index = self._buf.find(value, self._start + start, first_end)
+            if index >= 0:
+                return index - self._start
+            start = first_end - self._start
+        wrapped = self._start + self._len - size
+        if wrapped > 0:
+            index = self._buf.find(value, self._start + start - size, wrapped)
+            if index >= 0:
+                return index + size - self._start
+        return -1
+
+    def peek_into(self, view, count: int) -> None:
+        '''
+        copy the oldest bytes into another buffer without removing them.
+
+        Args:
+            view: a writable bytes-like object at least count bytes long
+            count (int): the number of bytes to copy
+        '''
+        size = len(self._buf)
+        first = min(count, size - self._start)
+        view[:first] = self._view[self._start:self._start+first]
+        view[first:count] = self._view[:count-first]
+
+    def skip(self, count: int) -> None:
+        '''
+        remove the oldest bytes.
+
+        Args:
+            count (int): the number of bytes to remove
+        '''
+        count = min(count, self._len)
+        self._start = (self._start + count) % len(self._buf)
+        self._len -= count
+
+    def read(self, count: int) -> bytes:
+        '''
+        remove and return the oldest bytes.
+
+        Args:
+            count (int): the number of bytes to read
+
+        Returns:
+            bytes: the data read.
+        '''
+        count = min(count, self._len)
+        data = bytearray(count)
+        self.peek_into(data, count)
+        self.skip(count)
+        return bytes(data)
+
 
 class SerialDevice:
     STANDARD_BAUDS = (50, 75, 110, 134, 150, 200, 300, 600,
@@ -17,13 +137,67 @@ class SerialDevice:
                     (0x2A03, 0x0043), (0x2341, 0x0243),
                     (0x0403, 0x6001), (0x1A86, 0x7523))
 
-    def __init__(self, port = None, baud = 115200) -> None:
-        self.ser = serial.Serial(timeout = 1)
+    # binary replies are a sync byte, a frame type, pan and tilt as int16, the
+    # sensor reading as uint16 and a checksum, see communication.ino
+    FRAME = struct.Struct('<BBhhHB')
+    FRAME_SYNC = 0xA5
+    FRAME_READING = ord('R')
+    FRAME_READY = ord('K')
+    FRAME_ERROR = ord('E')
+    FRAME_STATS = ord('Q')
+
+    RX_BUFFER_SIZE = 65536
+
+    def __init__(self, port = None, baud = 115200, interactive = True,
+                    remember = True) -> None:
+        # sim:// ports are handled by the simulator instead of pyserial
+        if simulator.is_simulated(port):
+            self.ser = simulator.SimulatedSerial(timeout = 1)
+        else:
+            self.ser = serial.Serial(timeout = 1)
+        self.interactive = interactive  # whether to ask before doing things
         self.connected = False
+        self.binary = False     # whether replies are binary frames
+        # a CommandTiming to report to, see Scanner.instrument, and when the
+        # last line or frame read arrived while it's attached
+        self.timing = None
+        self.last_received = None
+        # everything received is drained into a ring buffer by a reader
+        # thread, and readers wait on the condition until what they want
+        # has arrived
+        self._rx = RingBuffer(SerialDevice.RX_BUFFER_SIZE)
+        self._rx_changed = threading.Condition()
+        self._reading = False
+        self._reader_thread = None
+        # reusable buffer that binary frames are copied into for parsing
+        self._frame = bytearray(SerialDevice.FRAME.size)
+        self._frame_view = memoryview(self._frame)
         self.port = port
-        self.baud = self.confirm_baud(baud)
-        self.ser.baudrate = self.baud
+        self.baud = baud
 
+        # reconnect to the last port used without asking anything, if it's
+        # still plugged in
+        if not port and remember:
+            remembered = self.remembered_port()
+            if remembered is not None:
+                port, self.baud = remembered
+                print('connecting to {} at baud rate {} like last time'.format(
+                        port.device, self.baud))
+                self._open(port)
+                if not self.connected:
+                    port, self.baud = None, baud
+        if not self.connected:
+            self._choose_port(port, interactive)
+        if self.connected and remember:
+            self.remember_port()
+
+    def _choose_port(self, port, interactive: bool) -> None:
+        '''
+        connect to a port, asking about the baud rate and the port first if
+        interactive.
+        '''
+        if interactive:
+            self.baud = self.confirm_baud(self.baud)
         # try to autoselect a port if no port was specified
         if not port:
             arduino_ports = self.autodetect_ports()
@@ -33,8 +207,11 @@ class SerialDevice:
                     print_port_info(port)
                     self.connect(port)
             if not self.connected:
+                if not interactive:
+                    raise ConnectionError('no arduino found, a port has '+\
+                                            'to be given')
                 print('no recognized ports found. manually select one:')
-                
+
                 self.connect(self.manual_select_port())
         else:
             self.connect(port)
@@ -43,7 +220,7 @@ class SerialDevice:
         '''
         close the serial connection when the object is deleted
         '''
-        self.ser.close()
+        self.close()
 
     def autodetect_ports(self) -> list:
         '''
@@ -89,23 +266,93 @@ class SerialDevice:
         confirm connection to a serial port, and connect (or don't).
 
         Args:
-            port (ListPortInfo): the port to possibly be connected to.
+            port (ListPortInfo): the port to possibly be connected to, or
+                the name of one.
         '''
-        if yesno_confirm('connect with baud rate {}?'.format(self.baud)):
-            self.port = port
-            try:
-                self.ser.port = self.port.device
-                self.ser.baudrate = self.baud
-                self.ser.open()
-                self.connected = True
-                print('opened port {}'.format(port.name))
-            except:
-                print(('can\'t connect to port {}! is '+\
-                    'the port already in use?').format(self.port.device))
-                pass
+        if isinstance(port, str):
+            port = ListPortInfo(port, skip_link_detection=True)
+        if not self.interactive or \
+                yesno_confirm('connect with baud rate {}?'.format(self.baud)):
+            self._open(port)
         else:
             print('not connecting to port {}.'.format(port.name))
 
+    def _open(self, port: ListPortInfo) -> None:
+        '''
+        open a port and start reading from it, without asking.
+        '''
+        self.port = port
+        try:
+            self.ser.port = self.port.device
+            self.ser.baudrate = self.baud
+            self.ser.open()
+            self.connected = True
+            self._reading = True
+            self._reader_thread = threading.Thread(target=self._reader,
+                                                    daemon=True)
+            self._reader_thread.start()
+            print('opened port {}'.format(port.name))
+        except:
+            print(('can\'t connect to port {}! is '+\
+                'the port already in use?').format(self.port.device))
+            pass
+
+    def remembered_port(self) -> tuple:
+        '''
+        look for the port that was connected to last time. it's recognized by
+        its USB IDs and serial number rather than its name, since the name
+        can change when it's plugged back in. boards without a serial number
+        have to be on the same port as before.
+
+        Returns:
+            tuple: (ListPortInfo: the port, int: the baud rate used), or None
+                if it isn't plugged in or nothing was remembered.
+        '''
+        try:
+            with open(CONNECTION_PROFILE) as file:
+                profile = json.load(file)
+        except (OSError, ValueError):
+            return None
+        for port in list_ports.comports():
+            if (port.vid, port.pid, port.serial_number) != \
+                    (profile.get('vid'), profile.get('pid'),
+                        profile.get('serial_number')):
+                continue
+            if port.serial_number is None and \
+                    port.device != profile.get('device'):
+                continue
+            return port, int(profile.get('baud', self.baud))
+        return None
+
+    def remember_port(self) -> None:
+        '''
+        save the connected port and baud rate, so the next connection can
+        go straight to them. only USB ports can be recognized again, so
+        anything else (like the simulator) isn't saved.
+        '''
+        matches = [port for port in list_ports.comports()
+                    if port.device == self.port.device and port.vid is not None]
+        if not matches:
+            return
+        port = matches[0]
+        # a profile that can't be written just means asking again next time
+        try:
+            CONNECTION_PROFILE.parent.mkdir(parents=True, exist_ok=True)
+            with open(CONNECTION_PROFILE, 'w') as file:
+                json.dump({'device': port.device, 'vid': port.vid,
+                            'pid': port.pid,
+                            'serial_number': port.serial_number,
+                            'baud': self.baud}, file)
+        except OSError:
+            pass
+
+    @staticmethod
+    def forget_port() -> None:
+        '''
+        delete the saved connection, so the next one asks again.
+        '''
+        CONNECTION_PROFILE.unlink(missing_ok=True)
+
     def confirm_baud(self, baud: int) -> int:
         '''
         ask the user if they want to change the baud rate,
@@ -147,18 +394,134 @@ class SerialDevice:
         else:
             return baud
 
-    def read(self) -> str:
+    def _reader(self) -> None:
+        '''
+        drain the serial port into the receive buffer for as long as the port
+        is open. runs on its own thread, started by connect.
+        '''
+        chunk = bytearray(4096)
+        view = memoryview(chunk)
+        while self._reading:
+            try:
+                # block until at least one byte arrives, then take
+                # everything else that's already waiting along with it
+                received = self.ser.readinto(
+                        view[:max(1, min(self.ser.in_waiting, len(chunk)))])
+            except (serial.SerialException, OSError):
+                break
+            if not received:
+                continue
+            now = time.perf_counter()
+            with self._rx_changed:
+                offset = 0
+                while offset < received and self._reading:
+                    # wait for the consumer if the buffer is full
+                    self._rx_changed.wait_for(
+                            lambda: self._rx.free > 0 or not self._reading)
+                    stored = self._rx.write(view[offset:received])
+                    offset += stored
+                    if self.timing is not None:
+                        self.timing.received(stored, now)
+                    self._rx_changed.notify_all()
+
+    def close(self) -> None:
+        '''
+        stop the reader thread and close the serial port.
+        '''
+        self._reading = False
+        with self._rx_changed:
+            self._rx_changed.notify_all()
+        self.ser.close()
+        if self._reader_thread is not None:
+            self._reader_thread.join()
+            self._reader_thread = None
+        self.connected = False
+
+    def read(self, timeout: float = None) -> str:
         '''
-        read the serial input buffer
+        read a line from the serial input buffer
+
+        Args:
+            timeout (float): how long to wait for a line in seconds, the
+                port's timeout by default
 
         Returns:
-            str: the contents of the serial input buffer
+            str: the next line received, or an empty string if no complete
+                line arrived before the timeout
         '''
         line = ''
         if self.connected:
-            line = self.ser.readline().decode()
+            timing = self.timing
+            with self._rx_changed:
+                start = time.perf_counter()
+                if self._rx_changed.wait_for(
+                        lambda: self._rx.find(NEWLINE) >= 0,
+                        self.ser.timeout if timeout is None else timeout):
+                    size = self._rx.find(NEWLINE) + 1
+                    line = self._rx.read(size).decode(errors='replace')
+                    if timing is not None:
+                        self.last_received = timing.arrival(size, len(self._rx))
+                    self._rx_changed.notify_all()
+                elif timing is not None:
+                    timing.timed_out(time.perf_counter() - start)
         return line
 
+    def read_frame(self) -> tuple:
+        '''
+        read one binary frame from the serial input buffer. anything that
+        doesn't form a frame with a valid checksum is skipped.
+
+        Returns:
+            tuple: (int: frame type, int: pan, int: tilt, int: reading), or
+                None if no complete frame arrived before the timeout
+        '''
+        if not self.connected:
+            return None
+        size = SerialDevice.FRAME.size
+        timing = self.timing
+        with self._rx_changed:
+            start = time.perf_counter()
+            while True:
+                # throw away anything before the next sync byte
+                sync = self._rx.find(SerialDevice.FRAME_SYNC)
+                self._rx.skip(sync if sync >= 0 else len(self._rx))
+                self._rx_changed.notify_all()
+                if len(self._rx) < size:
+                    if not self._rx_changed.wait_for(
+                            lambda: len(self._rx) >= size, self.ser.timeout):
+                        if timing is not None:
+                            timing.timed_out(time.perf_counter() - start)
+                        return None
+                    continue
+                self._rx.peek_into(self._frame_view, size)
+                if sum(self._frame_view[1:size-1]) & 0xFF == self._frame[size-1]:
+                    self._rx.skip(size)
+                    if timing is not None:
+                        self.last_received = timing.arrival(size, len(self._rx))
+                    self._rx_changed.notify_all()
+                    return SerialDevice.FRAME.unpack_from(self._frame)[1:5]
+                # bad checksum, so that wasn't really a sync byte
+                self._rx.skip(1)
+
+    def set_baud(self, baud: int) -> None:
+        '''
+        change the speed of the open port, to follow the scanner when it
+        changes speed (see Scanner.negotiate_baud). the baud rate connected
+        at, which is the one remembered for next time, doesn't change.
+
+        Args:
+            baud (int): the new baud rate
+        '''
+        self.ser.baudrate = baud
+
+    def discard(self) -> None:
+        '''
+        throw away everything received that hasn't been read yet.
+        '''
+        with self._rx_changed:
+            self._rx.skip(len(self._rx))
+            self._rx_changed.notify_all()
+
     def write(self, string: str) -> None:
         '''
         send something over the serial port.
@@ -167,7 +530,10 @@ class SerialDevice:
             string (str): data to send over the serial port.
         '''
         if self.connected:
-            self.ser.write('{}\r'.format(string).encode())
+            data = '{}\r'.format(string).encode()
+            self.ser.write(data)
+            if self.timing is not None:
+                self.timing.sent(len(data))
 
 
 def print_port_info(port: ListPortInfo) -> None:
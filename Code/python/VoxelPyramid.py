@@ -0,0 +1,67 @@
+from PointCloud import PointCloud
+import numpy as np
+from matplotlib import colormaps
+
+class VoxelPyramid:
+    '''
+    A point cloud at several levels of detail, for drawing big clouds. Each
+    level merges the points of the one below it into voxels twice as big,
+    until only a few are left. Drawing a view picks the most detailed level
+    that fits a point budget inside the part of the cloud being looked at,
+    so zooming in brings back detail without ever drawing everything.
+
+    The levels, their indexes and the colour of every point (by distance
+    from the scanner) are all worked out once, up front.
+
+    Args:
+        cloud (PointCloud): the points
+        min_points (int): stop adding levels once one has this few points
+        colormap (str): the matplotlib colormap to colour distance with
+    '''
+    def __init__(self, cloud: PointCloud, min_points=1000,
+                    colormap='plasma') -> None:
+        xyz = cloud.xyz
+        self.low = xyz.min(axis=0) if len(xyz) else np.zeros(3)
+        self.high = xyz.max(axis=0) if len(xyz) else np.zeros(3)
+        extent = max(float(np.max(self.high - self.low)), 1e-9)
+        self._colormap = colormaps[colormap]
+        # levels from the full cloud down to the coarsest
+        self.levels = [self._level(cloud)]
+        size = extent / 1024
+        while len(self.levels[-1][0]) > min_points and size < extent:
+            coarser = PointCloud(self.levels[-1][0].xyz).voxel_downsample(size)
+            size *= 2
+            # tiny voxels might not merge anything yet
+            if len(coarser) < 0.8*len(self.levels[-1][0]):
+                self.levels.append(self._level(coarser))
+
+    def _level(self, cloud: PointCloud) -> tuple:
+        index = cloud.index()
+        # colour by x, which is the distance straight out from the scanner
+        span = max(self.high[0] - self.low[0], 1e-9)
+        colors = self._colormap((index.xyz[:, 0] - self.low[0]) / span)
+        return index, colors.astype(np.float32)
+
+    def view(self, low, high, budget=20000) -> tuple:
+        '''
+        Gets the points to draw for part of the cloud.
+
+        Args:
+            low: (x, y, z) lower limits of the view. any can be None
+            high: (x, y, z) upper limits of the view. any can be None
+            budget (int): the most points to draw
+
+        Returns:
+            tuple: (np.ndarray: (n, 3) points, np.ndarray: (n, 4) their
+                colours) from the most detailed level that fits the budget.
+        '''
+        chosen = None
+        # work from coarse to fine and stop once a level is over budget
+        for index, colors in reversed(self.levels):
+            rows = index.select(low, high)
+            count = rows.stop - rows.start if isinstance(rows, slice) \
+                    else len(rows)
+            if count > budget and chosen is not None:
+                break
+            chosen = index.xyz[rows], colors[rows]
+        return chosen
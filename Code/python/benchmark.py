@@ -0,0 +1,178 @@
+'''
+scan throughput benchmarks, run against the simulated scanner so they don't
+need the hardware. every run is saved as json so later runs can be compared
+to it.
+
+usage: python benchmark.py [--time-scale 0.05] [--modes blocking stream ...]
+'''
+from SerialDevice import SerialDevice
+from Scanner import Scanner
+import collect_data
+
+from pathlib import Path
+from datetime import datetime
+import argparse
+import json
+import statistics
+import time
+
+RESULTS_DIR = Path(__file__).parent / 'benchmark_results'
+
+
+def blocking_scan(s):
+    # the original scan loop: one command at a time, waiting on each
+    pans, tilts = collect_data.scan_grid()
+    s.delay(1000)
+    for pan_pos in pans:
+        s.pan(pan_pos)
+        for tilt_pos in tilts:
+            s.tilt(tilt_pos)
+            s.read_sensor()
+
+
+SCAN_MODES = {
+    'blocking': blocking_scan,
+    'raster': lambda s: collect_data.scan(s, 'raster'),
+    'serpentine': lambda s: collect_data.scan(s, 'serpentine'),
+    'stream': collect_data.stream_scan,
+    'adaptive': collect_data.adaptive_scan,
+}
+
+# commands to time round trips of, each sent on its own and waited on
+LATENCY_COMMANDS = {
+    'READSENSOR': lambda s: s.read_sensor(),
+    'POINT': lambda s: s.move_and_read(s.pan_angle, s.tilt_angle),
+    'DELAY': lambda s: s.delay(0),
+}
+
+
+def connect(args, binary: bool) -> Scanner:
+    port = 'sim://{}?time_scale={}&seed={}'.format(args.scene, args.time_scale,
+                                                    args.seed)
+    dev = SerialDevice(port, interactive=False)
+    return Scanner(dev=dev, binary=binary)
+
+
+def summarize(times: list) -> dict:
+    '''
+    summarize a list of durations in seconds as milliseconds.
+    '''
+    ordered = sorted(times)
+    return {
+        'count': len(times),
+        'mean_ms': statistics.mean(times)*1000,
+        'p50_ms': ordered[len(ordered)//2]*1000,
+        'p95_ms': ordered[min(len(ordered)-1, int(len(ordered)*0.95))]*1000,
+        'max_ms': ordered[-1]*1000,
+    }
+
+
+def measure_latency(s, repeats: int) -> dict:
+    results = {}
+    for name, run in LATENCY_COMMANDS.items():
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run(s)
+            times.append(time.perf_counter() - start)
+        results[name] = summarize(times)
+    return results
+
+
+def measure_scan(s, mode: str) -> dict:
+    pans, tilts = collect_data.scan_grid()
+    start = time.perf_counter()
+    data = SCAN_MODES[mode](s)
+    total = time.perf_counter() - start
+    # adaptive scans don't visit every point of the grid
+    points = len(data) if data is not None else len(pans)*len(tilts)
+    return {'points': points, 'total_s': total, 'points_per_s': points/total}
+
+
+def run(args) -> dict:
+    results = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'config': vars(args).copy(),
+        'latency': {},
+        'scans': {},
+    }
+    for protocol in args.protocols:
+        s = connect(args, protocol == 'binary')
+        results['latency'][protocol] = measure_latency(s, args.repeats)
+        for mode in args.modes:
+            print('running {} scan ({})'.format(mode, protocol))
+            results['scans']['{}/{}'.format(mode, protocol)] = \
+                measure_scan(s, mode)
+        results['overruns'] = s.dev.ser.overruns
+        s.dev.close()
+    return results
+
+
+def report(results: dict, previous: dict = None) -> None:
+    print()
+    print('command latency (ms):')
+    for protocol, commands in results['latency'].items():
+        for name, stats in commands.items():
+            print('  {:<8} {:<10} mean {:7.2f}  p50 {:7.2f}  p95 {:7.2f}  '
+                    'max {:7.2f}'.format(protocol, name, stats['mean_ms'],
+                    stats['p50_ms'], stats['p95_ms'], stats['max_ms']))
+    print('scans (time scale {}):'.format(results['config']['time_scale']))
+    for name, stats in results['scans'].items():
+        line = '  {:<20} {:8.2f} s  {:8.1f} points/s'.format(name,
+                stats['total_s'], stats['points_per_s'])
+        if previous is not None and name in previous.get('scans', {}):
+            line += '  ({:+.1f}% vs {})'.format(
+                (stats['points_per_s']/previous['scans'][name]['points_per_s']
+                    - 1)*100, previous['time'])
+        print(line)
+    if results.get('overruns'):
+        print('warning: {} bytes were lost to receive buffer overruns'
+                .format(results['overruns']))
+
+
+def latest_results() -> dict:
+    '''
+    load the most recently saved benchmark results, if there are any.
+    '''
+    saved = sorted(RESULTS_DIR.glob('*.json'))
+    if not saved:
+        return None
+    with open(saved[-1]) as file:
+        return json.load(file)
+
+
+def save(results: dict) -> Path:
+    RESULTS_DIR.mkdir(exist_ok=True)
+    path = RESULTS_DIR / '{}.json'.format(
+                datetime.now().strftime('%Y%m%d-%H%M%S'))
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark scan throughput '
+                                        'against the simulated scanner')
+    parser.add_argument('--modes', nargs='+', choices=SCAN_MODES,
+                        default=list(SCAN_MODES))
+    parser.add_argument('--protocols', nargs='+', choices=('text', 'binary'),
+                        default=['text', 'binary'])
+    parser.add_argument('--time-scale', type=float, default=0.05,
+                        help='multiplier for simulated servo and delay times')
+    parser.add_argument('--scene', default='o_data.csv',
+                        help='scan csv the simulated sensor sees')
+    parser.add_argument('--repeats', type=int, default=200,
+                        help='round trips to time for each command')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+
+    previous = latest_results()
+    results = run(args)
+    report(results, previous)
+    if not args.no_save:
+        print('results saved to {}'.format(save(results)))
+
+
+if __name__ == '__main__':
+    main()
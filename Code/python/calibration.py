@@ -1,10 +1,15 @@
 from Scanner import Scanner
 import helpers
+from SerialDevice import SerialDevice
 from pathlib import Path
+import argparse
 import numpy as np
 import pandas as pd
 import scipy.optimize
 import matplotlib.pyplot as plt
+import math
+import sys
+import time
 
 
 def collect_data():
@@ -42,29 +47,42 @@ def collect_data():
     helpers.save_csv(data)
 
 
-def plot_data():
-    data = helpers.load_csv()
+def plot_data(path=None, output=None):
+    # plot calibration data and its fit, saving the plot to output if it's
+    # given instead of showing it
+    if path is None:
+        path = helpers.choose_file()
+    data = pd.read_csv(path)
     data.plot('Distance', 'Voltage', color='red')
     fit_dist = np.linspace(20, 150, 100)
-    params = helpers.fit_data(data, 'Distance', 'Voltage')
+    params = helpers.calibration_fit(path, 'Distance', 'Voltage')
     fit_volt = helpers.exp_function(fit_dist, *params)
     plt.plot(fit_dist, fit_volt, linestyle='dotted', color='blue')
     plt.legend(['Calibration Data', 'Fitted Curve'])
     plt.xlabel('Distance (cm)')
     plt.ylabel('Voltage (V)')
-    plt.show()
+    show(output)
 
 
-def verify_calibration():
-    print('select a calibration dataset')
-    calib_data = helpers.load_csv()
-    print('select a dataset to compare to the calibration dataset '+\
-            '(generate using calibrate function)')
-    test_data = helpers.load_csv()
-    # fit calibration data to exponential function
-    fit_params = helpers.fit_data(calib_data, 'Voltage', 'Distance')
+def verify_calibration(calib_path=None, test_path=None, output=None):
+    if calib_path is None:
+        print('select a calibration dataset')
+        calib_path = helpers.choose_file()
+    if test_path is None:
+        print('select a dataset to compare to the calibration dataset '+\
+                '(generate using calibrate function)')
+    test_data = helpers.load_csv(test_path)
+    # fit calibration data to exponential function (or reuse an earlier fit)
+    params = helpers.calibration_fit(calib_path)
 
-    predicted_dists = helpers.exp_function(test_data['Voltage'], *fit_params)
+    if 'raw' in test_data:
+        # raw readings can be looked up in the distance table
+        predicted_dists = helpers.distance_lut(params)[
+                            test_data['raw'].to_numpy(dtype=np.uint16)]
+    else:
+        # test voltages are averages of several readings, so they usually
+        # fall between raw readings and need the fit itself
+        predicted_dists = helpers.exp_function(test_data['Voltage'], *params)
     # print(predicted_dists)
     actual_dists = test_data['Distance']
     # error = (np.abs(actual_dists-predicted_dists)/predicted_dists)*100
@@ -74,7 +92,106 @@ def verify_calibration():
     plt.xlabel('Actual Distance (cm)')
     plt.ylabel('Actual Distance-Predicted Distance (cm)')
     # plt.title('Scanner error post-calibration')
-    plt.show()
+    show(output)
+
+
+def show(output=None):
+    # show the current plot, or save it to a file without showing it
+    if output is None:
+        plt.show()
+    else:
+        plt.savefig(output)
+        plt.close()
+
+
+def time_settle(s, axis, origin, target, tolerance, timeout):
+    '''
+    move one axis from origin to target without waiting, then keep reading
+    the sensor until the readings stop changing.
+
+    Args:
+        s (Scanner): the scanner
+        axis (str): 'pan' or 'tilt'
+        origin (int): the angle to start from
+        target (int): the angle to move to
+        tolerance (int): how far readings can be from the final reading (in
+            raw units) and still count as settled
+        timeout (float): how long to keep reading for, in msec
+
+    Returns:
+        float: msec from the move until the readings settled, or None if the
+            reading didn't change, so the move can't be timed here.
+    '''
+    move = s.pan if axis == 'pan' else s.tilt
+    move(origin)
+    s.delay(500)    # make sure the servo has stopped
+    before = s.read_sensor(raw=True)[2]
+    move(target, wait=0)
+    start = time.perf_counter()
+    times, readings = [], []
+    while not times or times[-1] < timeout:
+        readings.append(s.read_sensor(raw=True)[2])
+        times.append((time.perf_counter() - start)*1000)
+    # the last quarter of the readings is after the servo has long stopped
+    final = np.median(readings[-max(1, len(readings)//4):])
+    if abs(final - before) <= tolerance:
+        return None
+    unsettled = [t for t, reading in zip(times, readings)
+                    if abs(reading - final) > tolerance]
+    return unsettled[-1] if unsettled else 0
+
+
+def measure_settle_profile(steps=(1, 2, 5, 10, 20, 40), repeats=3,
+                            tolerance=3, margin=1.2, timeout=1000, s=None,
+                            output=None):
+    '''
+    measure how long each servo takes to settle after steps of different
+    sizes, by timing how long the sensor readings keep changing after a move.
+    the scanner should face a surface at an angle to it, so that every
+    degree it moves changes the distance it sees. the slowest time for each
+    step size, with some margin, is saved as a settle profile that can be
+    uploaded with Scanner.upload_settle_profile.
+
+    Args:
+        steps: the step sizes to measure, in degrees
+        repeats (int): how many times to time each step in each direction
+        tolerance (int): raw reading noise to ignore
+        margin (float): multiplier for the measured times
+        timeout (float): how long to watch each move for, in msec
+        s (Scanner): the scanner to use, or None to connect to one. a
+            scanner that's passed in should already be pointed at the surface
+        output: where to save the profile, or None to ask
+    '''
+    if s is None:
+        s = Scanner()
+        print('centering scanner...')
+        s.center()
+        input('point the scanner at a surface angled away from it both '+\
+                'horizontally and vertically, then press enter')
+    origin = {'pan': int(s.pan_angle), 'tilt': int(s.tilt_angle)}
+    rows = []
+    for axis in ('pan', 'tilt'):
+        for step in steps:
+            times = []
+            for direction in (1, -1):
+                for _ in range(repeats):
+                    settle = time_settle(s, axis, origin[axis],
+                                    origin[axis] + direction*step,
+                                    tolerance, timeout)
+                    if settle is not None:
+                        times.append(settle)
+            if not times:
+                print('the reading didn\'t change after a {} degree {}, '
+                        'skipping it'.format(step, axis))
+                continue
+            settle = math.ceil(max(times)*margin)
+            print('{} {} degrees: {} ms'.format(axis, step, settle))
+            rows.append((axis, step, settle))
+        # go back to where the axis started for the next one
+        (s.pan if axis == 'pan' else s.tilt)(origin[axis])
+
+    data = pd.DataFrame(rows, columns=['Axis', 'Step', 'Settle'])
+    helpers.save_csv(data, output)
 
 
 def main():
@@ -84,6 +201,7 @@ def main():
         print('0: collect calibration data')
         print('1: plot calibration data')
         print('2: verify calibration')
+        print('3: measure servo settle times')
         mode = input('select a calibration function, or "DONE" to exit: ').strip()
         if mode.upper() == 'DONE':
             done = True
@@ -97,7 +215,55 @@ def main():
                 plot_data()
             elif mode == 2:
                 verify_calibration()
+            elif mode == 3:
+                measure_settle_profile()
+
+
+def cli(argv=None):
+    # everything but collecting data can run without prompts, collecting it
+    # needs someone to measure the distances
+    parser = argparse.ArgumentParser(description='calibration functions '
+                                        'that run without any prompts')
+    commands = parser.add_subparsers(dest='command', required=True)
+    fit = commands.add_parser('fit', help='fit calibration data and print '
+                                '(and cache) the constants')
+    fit.add_argument('calibration')
+    plot = commands.add_parser('plot', help='plot calibration data')
+    plot.add_argument('calibration')
+    plot.add_argument('--output', help='save the plot here instead of '
+                        'showing it')
+    verify = commands.add_parser('verify', help='compare test data to a '
+                                    'calibration')
+    verify.add_argument('calibration')
+    verify.add_argument('test')
+    verify.add_argument('--output', help='save the plot here instead of '
+                        'showing it')
+    settle = commands.add_parser('settle', help='measure servo settle '
+                                    'times. the scanner should already face '
+                                    'a surface angled away from it')
+    settle.add_argument('--port', required=True)
+    settle.add_argument('--output', required=True,
+                        help='csv to save the settle profile to')
+    settle.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    if args.command == 'fit':
+        print(' '.join(str(param) for param in
+                        helpers.calibration_fit(args.calibration)))
+    elif args.command == 'plot':
+        plot_data(args.calibration, args.output)
+    elif args.command == 'verify':
+        verify_calibration(args.calibration, args.test, args.output)
+    elif args.command == 'settle':
+        s = Scanner(dev=SerialDevice(args.port, interactive=False))
+        s.center()
+        measure_settle_profile(repeats=args.repeats, s=s, output=args.output)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    # with arguments, run one function without prompts, for example
+    # python calibration.py verify calibration_data.csv test_calibration.csv
+    if len(sys.argv) > 1:
+        cli()
+    else:
+        main()
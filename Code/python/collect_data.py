@@ -1,9 +1,16 @@
 from Scanner import Scanner
+from SerialDevice import SerialDevice
 import helpers
+import scan_io
+import scan_paths
 
+from collections import deque
+from pathlib import Path
 from numpy import mean
+import argparse
+import sys
 import pandas as pd
-from tqdm.auto import trange
+from tqdm.auto import tqdm
 
 pan_interval = 1
 tilt_interval = 1
@@ -11,28 +18,251 @@ pan_center = 90     # determined experimentally
 tilt_center = 82    # determined experimentally
 pan_radius = 24     # set based on how wide the thing being scanned is
 tilt_radius = 35    # set based on how tall the thing being scanned is 
+# the path planners, plus letting the scanner run the grid itself (stream) and
+# only filling in detail where the readings change (adaptive)
+scan_planners = list(scan_paths.PLANNERS) + ['stream', 'adaptive']
 
-def scan(s):
-    xs, ys, ds = [], [], []
-    print('starting scan')
-    s.delay(1000)
-    for pan_pos in trange(pan_center-pan_radius, pan_center+pan_radius,
-                                pan_interval, desc="pan progress"):
-        s.pan(pan_pos)
-        for tilt_pos in trange(tilt_center-tilt_radius, tilt_center+tilt_radius,
-                            tilt_interval, desc="tilt progress", leave=False):
-            s.tilt(tilt_pos)
-            dist = s.read_sensor()
-            xs.append(dist[0])
-            ys.append(dist[1])
-            ds.append(dist[2])
-    
-    return pd.DataFrame({'pan': xs, 'tilt': ys, 'voltage': ds})
+def scan_grid():
+    pans = range(pan_center-pan_radius, pan_center+pan_radius, pan_interval)
+    tilts = range(tilt_center-tilt_radius, tilt_center+tilt_radius,
+                    tilt_interval)
+    return pans, tilts
+
+def wait_for_servos(s):
+    # give the servos time to get where they're going before the first point.
+    # with a measured settle profile the scanner already waits long enough
+    if s.settle_profile is None:
+        s.delay(1000)
+
+def scan(s, planner='serpentine', writer=None):
+    pans, tilts = scan_grid()
+    path = scan_paths.PLANNERS[planner](pans, tilts)
+    if writer is not None and writer.done:
+        # resuming an interrupted scan, so skip what's already been saved
+        path = [point for point in path if point not in writer.done]
+        print('resuming scan, {} points already saved'.format(len(writer.done)))
+    estimate = scan_paths.estimate_time(path, (s.pan_angle, s.tilt_angle),
+                                        simultaneous=True,
+                                        profile=s.settle_profile)
+    print('starting {} scan of {} points, estimated servo travel time {:.0f} s'
+            .format(planner, len(path), estimate))
+    wait_for_servos(s)
+    # queue everything up and let the scanner work through it while replies
+    # are read back, rather than waiting on each command in turn. readings
+    # are saved (or collected) as soon as they come back
+    points = []
+    save = writer.append if writer is not None else points.append
+    readings = deque()
+    for pan_pos, tilt_pos in tqdm(path, desc="scan progress"):
+        readings.append(s.queue_move_and_read(pan_pos, tilt_pos, raw=True))
+        while readings and readings[0].done:
+            save(readings.popleft().result())
+    s.flush()
+    while readings:
+        save(readings.popleft().result())
+
+    if writer is not None:
+        return None
+    data = pd.DataFrame(points, columns=['pan', 'tilt', 'raw'])
+    # put the points back in raster order so the result doesn't depend on
+    # the path taken
+    return data.sort_values(['pan', 'tilt'], ignore_index=True)
+
+def stream_scan(s, settle=0, writer=None):
+    # let the scanner run the whole grid itself and stream readings back
+    pans, tilts = scan_grid()
+    if writer is not None:
+        # the scanner can only skip whole columns, so start at the first one
+        # that isn't finished and don't save points that already were
+        unfinished = [pan for pan in pans if any((pan, tilt) not in writer.done
+                                                    for tilt in tilts)]
+        if not unfinished:
+            return None
+        pans = range(unfinished[0], pans.stop, pans.step)
+    print('starting streamed scan of {} points'.format(len(pans)*len(tilts)))
+    wait_for_servos(s)
+    with tqdm(total=len(pans)*len(tilts), desc="scan progress") as progress:
+        if writer is None:
+            points = s.scan_array(pans, tilts, settle, progress)
+        else:
+            for point in s.stream_scan(pans, tilts, settle):
+                if point[:2] not in writer.done:
+                    writer.append(point)
+                progress.update()
+            return None
+    data = pd.DataFrame(points, columns=['pan', 'tilt', 'raw'])
+    return data.sort_values(['pan', 'tilt'], ignore_index=True)
+
+def adaptive_scan(s, threshold=20, coarse_step=4, min_step=1, budget=None,
+                    lut=None, writer=None):
+    # scan a coarse grid, then keep refining only where neighbouring points
+    # differ by more than the threshold. without a distance lookup table the
+    # threshold is in raw sensor units, with one it's in cm
+    pans, tilts = scan_grid()
+    planner = scan_paths.AdaptivePlanner(pans, tilts, threshold, coarse_step,
+                                            min_step, budget)
+    saved = {}
+    if writer is not None and writer.done:
+        # resuming an interrupted scan. the planner only depends on the
+        # readings, so feeding it the saved ones instead of scanning them
+        # again plans the rest of the scan the same way
+        writer.flush()
+        data = pd.read_csv(writer.path)
+        saved = {(pan, tilt): raw for pan, tilt, raw in
+                    zip(data['pan'], data['tilt'], data['raw'])}
+        print('resuming scan, {} points already saved'.format(len(saved)))
+    print('starting adaptive scan of up to {} points'.format(
+            budget or len(pans)*len(tilts)))
+    wait_for_servos(s)
+    points = []
+    with tqdm(total=budget, desc="scan progress") as progress:
+        batch = planner.next_batch((s.pan_angle, s.tilt_angle))
+        while batch:
+            readings = [s.queue_move_and_read(pan_pos, tilt_pos, raw=True)
+                        for pan_pos, tilt_pos in batch
+                        if (pan_pos, tilt_pos) not in saved]
+            for point in batch:
+                if point in saved:
+                    raw = saved[point]
+                    planner.add(point, lut[raw] if lut is not None else raw)
+                    progress.update()
+            for reading in readings:
+                pan, tilt, raw = reading.result()
+                planner.add((pan, tilt), lut[raw] if lut is not None else raw)
+                if writer is not None:
+                    writer.append((pan, tilt, raw))
+                else:
+                    points.append((pan, tilt, raw))
+                progress.update()
+            batch = planner.next_batch((s.pan_angle, s.tilt_angle))
+
+    if writer is not None:
+        return None
+    data = pd.DataFrame(points, columns=['pan', 'tilt', 'raw'])
+    return data.sort_values(['pan', 'tilt'], ignore_index=True)
+
+def choose_scan_path():
+    # ask where to save the scan, and whether to resume one that's there
+    while True:
+        path = Path(input('enter a file path ending in .csv to save your scan: '))
+        if not path.parent.is_dir():
+            print('invalid path! make sure the directory exists and is accessible.')
+        elif path.is_file():
+            if helpers.yesno_confirm('a file already exists at that location. '+\
+                                        'would you like to resume that scan?'):
+                return path
+            if helpers.yesno_confirm('would you like to replace it?'):
+                path.unlink()
+                return path
+        else:
+            return path
+
+def choose_planner():
+    # ask which order to scan the points in, and for adaptive scans how much
+    # detail to fill in
+    print('scan planners: {}'.format(', '.join(scan_planners)))
+    while True:
+        planner = input('enter a scan planner (leave empty for serpentine): ')
+        planner = planner.strip() or 'serpentine'
+        if planner in scan_planners:
+            break
+        print('invalid planner! choose one of the listed planners.')
+    options = {}
+    if planner == 'adaptive':
+        options['threshold'] = float(input('enter how much neighbouring raw '+\
+                                            'readings can differ before the '+\
+                                            'scan fills in between them: '))
+        budget = input('enter the most points to scan (leave empty for no '+\
+                        'limit): ').strip()
+        options['budget'] = int(budget) if budget else None
+    return planner, options
+
+def choose_settle_profile(s):
+    # upload servo settle times measured with calibration.py, so each move
+    # only waits as long as it needs to
+    if not helpers.yesno_confirm('would you like to load a settle profile?'):
+        return
+    load_settle_profile(s, helpers.choose_file('enter the path of the '+\
+                                                'settle profile csv: '))
+
+def load_settle_profile(s, path):
+    if s.upload_settle_profile(scan_paths.load_settle_profile(path)):
+        print('settle profile loaded')
+    else:
+        print('the scanner doesn\'t support settle profiles, update its '+\
+                'firmware to use them')
+
+def save_scan(s, path, planner='serpentine', **options):
+    # points are saved as they come in, so an interrupted scan can be resumed.
+    # options are passed on to adaptive_scan
+    with scan_io.ScanWriter(path) as writer:
+        if planner == 'stream':
+            stream_scan(s, writer=writer)
+        elif planner == 'adaptive':
+            adaptive_scan(s, writer=writer, **options)
+        else:
+            scan(s, planner, writer=writer)
+    scan_io.sort_scan(path)
+    print('scan saved to {}'.format(path))
 
 def main():
     s = Scanner()
-    data = scan(s)
-    helpers.save_csv(data)
+    choose_settle_profile(s)
+    planner, options = choose_planner()
+    save_scan(s, choose_scan_path(), planner, **options)
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='scan without any prompts. '
+                                        'an existing scan at the output path '
+                                        'is resumed')
+    parser.add_argument('output', help='csv to save the scan to')
+    parser.add_argument('--port', help='the scanner\'s serial port. found '
+                        'automatically if it isn\'t given')
+    parser.add_argument('--planner', default='serpentine',
+                        choices=scan_planners)
+    parser.add_argument('--threshold', type=float, default=20,
+                        help='how much neighbouring readings can differ '
+                        'before an adaptive scan fills in between them, in '
+                        'raw sensor units (or cm with --calibration)')
+    parser.add_argument('--budget', type=int,
+                        help='the most points an adaptive scan takes')
+    parser.add_argument('--calibration',
+                        help='calibration csv, to give an adaptive scan\'s '
+                        'threshold in cm')
+    parser.add_argument('--settle-profile',
+                        help='settle profile csv from calibration.py')
+    parser.add_argument('--replace', action='store_true',
+                        help='start over instead of resuming an existing scan')
+    parser.add_argument('--timing', metavar='PREFIX',
+                        help='time every command and save a report as '
+                        'PREFIX.json, PREFIX.csv and PREFIX.folded')
+    args = parser.parse_args(argv)
+
+    path = Path(args.output)
+    if args.replace and path.is_file():
+        path.unlink()
+    s = Scanner(dev=SerialDevice(args.port, interactive=False))
+    if args.settle_profile is not None:
+        load_settle_profile(s, args.settle_profile)
+    if args.timing is not None:
+        s.instrument()
+    options = {}
+    if args.planner == 'adaptive':
+        options = {'threshold': args.threshold, 'budget': args.budget}
+        if args.calibration is not None:
+            options['lut'] = helpers.distance_lut(
+                                helpers.calibration_fit(args.calibration))
+    save_scan(s, path, args.planner, **options)
+    if args.timing is not None:
+        timing = s.stop_timing()
+        timing.print_breakdown()
+        for report in timing.save(args.timing):
+            print('timing report saved to {}'.format(report))
 
 if __name__ == "__main__":
-    main()
+    # with arguments, scan without prompts, for example
+    # python collect_data.py --port /dev/ttyACM0 scan.csv
+    if len(sys.argv) > 1:
+        cli()
+    else:
+        main()
@@ -1,7 +1,16 @@
-from scipy.optimize import curve_fit
 from pathlib import Path
+import hashlib
+import io
+import json
 import numpy as np
-import pandas as pd
+# scipy and pandas take most of a second to import and a plain serial
+# session never needs them, so they're only imported where they're used
+
+ADC_MAX = 1023      # the arduino's analogRead range is 0-1023 for 0-5 V
+ADC_VOLTS = 5
+
+# calibration fits are saved here so they only have to be done once
+CALIBRATION_CACHE = Path.home() / '.pantilt' / 'calibration'
 
 def yesno_confirm(message: str) -> bool:
     '''
@@ -60,13 +69,17 @@ def exp_function(x, a, b, c, d):
     '''
     return a*np.exp(b*x) + c*np.exp(d*x)
 
-def save_csv(data):
+def save_csv(data, path=None):
     '''
     prompts the user to save a DataFrame as a csv file
 
     Args:
         data (DataFrame): the data to save as a csv
+        path: where to save it without asking. an existing file is replaced
     '''
+    if path is not None:
+        data.to_csv(path, index=False)
+        return
     while True:
         data_dir = Path(input('enter a file path ending in .csv to save your data: '))
         if not data_dir.parent.is_dir():
@@ -80,21 +93,36 @@ def save_csv(data):
             data.to_csv(data_dir, index=False)
             break
 
-def load_csv():
+def choose_file(message='enter a file path ending in .csv for your data: '):
     '''
-    prompts the user to load data from a csv into a DataFrame
+    prompts the user for the path of an existing file
+
+    Args:
+        message (str): the prompt to show
 
     Returns:
-        DataFrame: data constructed from the selected csv file
+        Path: the selected file
     '''
     while True:
-        data_dir = Path(input('enter a file path ending in .csv for your data: '))
+        data_dir = Path(input(message))
         if data_dir.is_file():
-            data = pd.read_csv(data_dir)
-            return data
+            return data_dir
         else:
             print('the specified file was not found!')
 
+def load_csv(path=None):
+    '''
+    prompts the user to load data from a csv into a DataFrame
+
+    Args:
+        path: the csv to load without asking
+
+    Returns:
+        DataFrame: data constructed from the selected csv file
+    '''
+    import pandas as pd
+    return pd.read_csv(choose_file() if path is None else path)
+
 def fit_data(data, xkey, ykey):
     '''
     fits data to a curve function and returns the constants found through doing so.
@@ -107,5 +135,101 @@ def fit_data(data, xkey, ykey):
     Returns:
         a list of constants from the equation. 
     '''
+    from scipy.optimize import curve_fit
     popt, pcov = curve_fit(exp_function, data[xkey], data[ykey], method='trf')
-    return popt
\ No newline at end of file
+    return popt
+
+def raw_to_voltage(raw):
+    '''
+    converts raw sensor readings to voltages, the same way the scanner does.
+
+    Args:
+        raw: raw sensor readings (0-1023)
+
+    Returns:
+        the voltages.
+    '''
+    return map(raw, 0, ADC_MAX, 0, ADC_VOLTS)
+
+def voltage_to_raw(voltage):
+    '''
+    recovers the raw sensor readings that voltages were calculated from.
+
+    Args:
+        voltage: voltages made from raw readings with raw_to_voltage
+
+    Returns:
+        np.ndarray: the raw readings as uint16.
+
+    Raises:
+        ValueError: if the voltages don't correspond to raw readings, in
+            which case converting them would lose information.
+    '''
+    voltage = np.asarray(voltage, dtype=float)
+    raw = np.rint(voltage * ADC_MAX / ADC_VOLTS)
+    if np.any(np.abs(raw_to_voltage(raw) - voltage) > 1e-9) or \
+            np.any((raw < 0) | (raw > ADC_MAX)):
+        raise ValueError('voltages don\'t match raw sensor readings')
+    return raw.astype(np.uint16)
+
+def raw_codes(scan):
+    '''
+    gets the raw sensor readings from a scan, whether it was saved with raw
+    readings or (like older scans) with voltages.
+
+    Args:
+        scan (DataFrame): the scan, with a raw or voltage column
+
+    Returns:
+        np.ndarray: the raw readings as uint16.
+    '''
+    if 'raw' in scan:
+        return scan['raw'].to_numpy(dtype=np.uint16)
+    return voltage_to_raw(scan['voltage'])
+
+def calibration_fit(path, xkey='Voltage', ykey='Distance'):
+    '''
+    fits a calibration csv like fit_data does, but saves the result so the
+    fit only has to be done once. saved fits are looked up by a hash of the
+    file's contents, so editing the file means it gets fit again.
+
+    Args:
+        path: the calibration csv
+        xkey (str): the key of the x axis to fit
+        ykey (str): the key of the y axis to fit
+
+    Returns:
+        np.ndarray: the constants from the equation.
+    '''
+    content = Path(path).read_bytes()
+    digest = hashlib.sha256(content)
+    digest.update('{}|{}'.format(xkey, ykey).encode())
+    cache_file = CALIBRATION_CACHE / '{}.json'.format(digest.hexdigest())
+    if cache_file.is_file():
+        with open(cache_file) as file:
+            return np.array(json.load(file)['params'])
+    import pandas as pd
+    params = fit_data(pd.read_csv(io.BytesIO(content)), xkey, ykey)
+    # a cache that can't be written just means fitting again next time
+    try:
+        CALIBRATION_CACHE.mkdir(parents=True, exist_ok=True)
+        with open(cache_file, 'w') as file:
+            json.dump({'source': str(path), 'xkey': xkey, 'ykey': ykey,
+                        'params': list(params)}, file)
+    except OSError:
+        pass
+    return params
+
+def distance_lut(params):
+    '''
+    builds a table of the distance for every possible raw sensor reading, so
+    converting a scan to distances is just indexing the table with its raw
+    readings.
+
+    Args:
+        params: voltage to distance constants from calibration_fit
+
+    Returns:
+        np.ndarray: the distance in cm for each raw reading from 0 to 1023.
+    '''
+    return exp_function(raw_to_voltage(np.arange(ADC_MAX + 1)), *params)
@@ -0,0 +1,147 @@
+'''
+turning scans into triangle meshes, and saving meshes as binary ply or stl.
+
+a scan is a regular grid of pan and tilt angles, so there's no need for a
+general surface reconstruction: neighbouring grid points are neighbours on
+the surface, unless their distances jump, which means one is on an edge and
+the other is on whatever is behind it. every step works on whole arrays, so
+meshing takes linear time and scans with millions of points are fine.
+'''
+from pathlib import Path
+import numpy as np
+
+# each ply face is the number of vertices (always 3) and their indices
+PLY_FACE = np.dtype([('count', 'u1'), ('vertices', '<i4', (3,))])
+# each stl triangle is a normal, three vertices and an unused attribute
+STL_TRIANGLE = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)),
+                            ('attribute', '<u2')])
+
+
+def grid_mesh(image, max_jump=0.1) -> tuple:
+    '''
+    mesh a range image by splitting each grid cell into two triangles. a
+    triangle is only made if its corners are all valid and none of its edges
+    cross a jump in depth. cells with a jump across one diagonal are split
+    along the other one instead if that works. the triangles face the
+    scanner.
+
+    Args:
+        image (RangeImage): the scan to mesh
+        max_jump (float): the biggest difference in distance between
+            neighbouring points that still counts as the same surface, as a
+            fraction of the nearer distance
+
+    Returns:
+        tuple: (np.ndarray: (n, 3) float32 vertices in cm, np.ndarray: (m, 3)
+            int32 indices of each triangle's vertices)
+    '''
+    x, y, z = image.cartesian()
+    valid = image.valid
+    vertices = np.stack([axis[valid] for axis in (x, y, z)],
+                        axis=1).astype(np.float32)
+    index = np.full(valid.shape, -1, dtype=np.int32)
+    index[valid] = np.arange(len(vertices), dtype=np.int32)
+
+    # the corners of every cell: a and b along the bottom (increasing pan),
+    # c and d along the top
+    a = (slice(None, -1), slice(None, -1))
+    b = (slice(None, -1), slice(1, None))
+    c = (slice(1, None), slice(None, -1))
+    d = (slice(1, None), slice(1, None))
+    depth = image.depth
+
+    def joined(p, q):
+        # invalid points are nan, which never compares as joined
+        with np.errstate(invalid='ignore'):
+            return np.abs(depth[p] - depth[q]) <= \
+                    max_jump*np.fmin(depth[p], depth[q])
+
+    ab, ac, bd, cd = joined(a, b), joined(a, c), joined(b, d), joined(c, d)
+    ad, bc = joined(a, d), joined(b, c)
+    # split along a-d where possible, otherwise along b-c
+    triangles = [((a, c, d), ac & cd & ad), ((a, d, b), ad & bd & ab),
+                    ((a, c, b), ~ad & ac & bc & ab),
+                    ((b, c, d), ~ad & bc & cd & bd)]
+    faces = np.concatenate([np.stack([index[corner][keep] for corner in corners],
+                                        axis=1)
+                            for corners, keep in triangles])
+    return vertices, faces
+
+
+def write_ply(path, vertices, faces, chunk_size=1 << 16) -> None:
+    '''
+    save a mesh as a binary ply file, a chunk at a time so the whole file
+    never has to be built in memory.
+
+    Args:
+        path: the file to write
+        vertices: (n, 3) vertex coordinates
+        faces: (m, 3) vertex indices of each triangle
+        chunk_size (int): how many vertices or faces to write at once
+    '''
+    header = ('ply\n'
+                'format binary_little_endian 1.0\n'
+                'element vertex {}\n'
+                'property float x\n'
+                'property float y\n'
+                'property float z\n'
+                'element face {}\n'
+                'property list uchar int vertex_indices\n'
+                'end_header\n').format(len(vertices), len(faces))
+    with open(path, 'wb') as file:
+        file.write(header.encode('ascii'))
+        for start in range(0, len(vertices), chunk_size):
+            file.write(np.asarray(vertices[start:start+chunk_size],
+                                    dtype='<f4').tobytes())
+        for start in range(0, len(faces), chunk_size):
+            chunk = faces[start:start+chunk_size]
+            records = np.empty(len(chunk), dtype=PLY_FACE)
+            records['count'] = 3
+            records['vertices'] = chunk
+            file.write(records.tobytes())
+
+
+def write_stl(path, vertices, faces, chunk_size=1 << 16) -> None:
+    '''
+    save a mesh as a binary stl file, a chunk at a time so the whole file
+    never has to be built in memory.
+
+    Args:
+        path: the file to write
+        vertices: (n, 3) vertex coordinates
+        faces: (m, 3) vertex indices of each triangle
+        chunk_size (int): how many triangles to write at once
+    '''
+    vertices = np.asarray(vertices, dtype=np.float32)
+    with open(path, 'wb') as file:
+        file.write(b'pan tilt scan'.ljust(80, b' '))
+        file.write(np.uint32(len(faces)).astype('<u4').tobytes())
+        for start in range(0, len(faces), chunk_size):
+            corners = vertices[faces[start:start+chunk_size]]
+            normals = np.cross(corners[:, 1] - corners[:, 0],
+                                corners[:, 2] - corners[:, 0])
+            lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                normals = np.where(lengths > 0, normals/lengths, 0)
+            records = np.zeros(len(corners), dtype=STL_TRIANGLE)
+            records['normal'] = normals
+            records['vertices'] = corners
+            file.write(records.tobytes())
+
+
+def write_mesh(path, vertices, faces) -> None:
+    '''
+    save a mesh as ply or stl, going by the file extension.
+
+    Args:
+        path: the file to write, ending in .ply or .stl
+        vertices: (n, 3) vertex coordinates
+        faces: (m, 3) vertex indices of each triangle
+    '''
+    suffix = Path(path).suffix.lower()
+    if suffix == '.ply':
+        write_ply(path, vertices, faces)
+    elif suffix == '.stl':
+        write_stl(path, vertices, faces)
+    else:
+        raise ValueError('meshes can only be saved as .ply or .stl')
@@ -0,0 +1,279 @@
+'''
+running several scanner heads at once, to cover an object from several
+sides in the time it takes to scan one.
+
+each head has its own serial port, scanner and scan path, and is driven by
+its own thread. the heads spend almost all their time waiting on their
+servos and serial ports, so the threads don't get in each other's way and
+the whole scan takes as long as the slowest head. every reading is tagged
+with the name of the head it came from and saved to one csv as it comes
+in, so like a single scan, an interrupted multi-head scan can be resumed.
+
+usage: python multi_scan.py scans.csv --head left /dev/ttyACM0
+            --head right /dev/ttyACM1 hilbert
+'''
+from Scanner import Scanner
+from SerialDevice import SerialDevice
+import collect_data
+import scan_io
+import scan_paths
+
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+import pandas as pd
+from serial.tools import list_ports
+from tqdm.auto import tqdm
+
+# the usual scan columns, then the name of the head each point came from
+MULTI_SCAN_COLUMNS = scan_io.SCAN_COLUMNS + ('head',)
+
+# sent by a head's thread when it's finished, with the error it stopped
+# on if it didn't finish its path
+_Finished = namedtuple('_Finished', ['head', 'seconds', 'error'])
+
+
+class Head:
+    '''
+    One scanner head and the points it should scan.
+
+    Args:
+        name (str): what to tag the head's points with
+        scanner (Scanner): the head's connected scanner
+        path: the (pan, tilt) points to scan, in the order to scan them
+    '''
+    def __init__(self, name: str, scanner: Scanner, path) -> None:
+        self.name = name
+        self.scanner = scanner
+        self.path = list(path)
+
+
+def connect_heads(ports: dict) -> dict:
+    '''
+    connect to several scanners at once, without any prompts. connecting
+    means syncing with and centering each one, which takes a while, so they
+    all do it at the same time. none of the ports are remembered for the
+    next single-head connection, since there's no telling which one it'd be.
+
+    Args:
+        ports (dict): the serial port of each head, by name
+
+    Returns:
+        dict: the connected Scanner for each head, by name.
+    '''
+    def connect(port):
+        return Scanner(dev=SerialDevice(port, interactive=False,
+                                        remember=False))
+
+    with ThreadPoolExecutor(len(ports) or 1) as pool:
+        scanners = {name: pool.submit(connect, port)
+                    for name, port in ports.items()}
+        return {name: scanner.result() for name, scanner in scanners.items()}
+
+
+def detect_ports() -> list:
+    '''
+    find the serial port of every connected arduino (or clone).
+
+    Returns:
+        list: the port names, like SerialDevice.autodetect_ports finds.
+    '''
+    return sorted(port.device for port in list_ports.comports()
+                    if (port.vid, port.pid) in SerialDevice.ARDUINO_HIDS)
+
+
+def scanned_points(path) -> dict:
+    '''
+    read the points already in a multi-head scan csv, for resuming it.
+
+    Returns:
+        dict: a set of the (pan, tilt) points each head has scanned, by name.
+    '''
+    path = Path(path)
+    if not path.is_file() or path.stat().st_size == 0:
+        return {}
+    # a partly written last line is cut off when the writer opens the file,
+    # so skip it here too
+    data = pd.read_csv(path, on_bad_lines='skip').dropna()
+    return {str(name): set(zip(group['pan'].astype(float),
+                                group['tilt'].astype(float)))
+            for name, group in data.groupby('head')}
+
+
+def _scan_head(head: Head, results: queue.Queue, done: set,
+                stop: threading.Event) -> None:
+    # runs in the head's thread. readings are queued up on the scanner the
+    # same way collect_data.scan does it, and handed back through results
+    start = time.perf_counter()
+    error = None
+    try:
+        s = head.scanner
+        collect_data.wait_for_servos(s)
+        readings = deque()
+        for pan_pos, tilt_pos in head.path:
+            if stop.is_set():
+                break
+            if (pan_pos, tilt_pos) in done:
+                continue
+            readings.append(s.queue_move_and_read(pan_pos, tilt_pos, raw=True))
+            while readings and readings[0].done:
+                results.put(readings.popleft().result()[:3] + (head.name,))
+        s.flush()
+        while readings:
+            results.put(readings.popleft().result()[:3] + (head.name,))
+    except Exception as exc:
+        error = exc
+    finally:
+        results.put(_Finished(head.name, time.perf_counter() - start, error))
+
+
+def multi_scan(heads, path) -> dict:
+    '''
+    scan with several heads at once, saving every point to one csv tagged
+    with the head it came from. points already in the file are skipped, so
+    an interrupted scan picks up where it left off. once everything's in,
+    the file is sorted by head, then pan, then tilt.
+
+    Args:
+        heads: the Heads to scan with, each with a different name
+        path: the csv to save the points to
+
+    Returns:
+        dict: (float: seconds the head took, Exception: the error it stopped
+            on, or None if it finished) for each head, by name.
+    '''
+    heads = list(heads)
+    done = scanned_points(path)
+    results = queue.Queue()
+    stop = threading.Event()
+    threads = [threading.Thread(target=_scan_head, daemon=True,
+                                args=(head, results, done.get(head.name, set()),
+                                        stop),
+                                name='head {}'.format(head.name))
+                for head in heads]
+    remaining = sum(len(head.path) for head in heads) - \
+                sum(len(points) for points in done.values())
+    finished = {}
+    # only this thread touches the file, the heads just hand over points
+    with scan_io.ScanWriter(path, MULTI_SCAN_COLUMNS) as writer, \
+            tqdm(total=remaining, desc='scan progress') as progress:
+        for thread in threads:
+            thread.start()
+        try:
+            while len(finished) < len(heads):
+                item = results.get()
+                if isinstance(item, _Finished):
+                    finished[item.head] = (item.seconds, item.error)
+                else:
+                    writer.append(item)
+                    progress.update()
+        finally:
+            # on ctrl+c let the heads stop after the commands they have in
+            # flight, and save what they send back before closing the file
+            stop.set()
+            for thread in threads:
+                thread.join()
+            while not results.empty():
+                item = results.get()
+                if not isinstance(item, _Finished):
+                    writer.append(item)
+
+    data = pd.read_csv(path)
+    data['head'] = data['head'].astype(str)
+    temp = Path(str(path) + '.tmp')
+    data.sort_values(['head', 'pan', 'tilt']).to_csv(temp, index=False)
+    os.replace(temp, path)
+    return finished
+
+
+def split_heads(path, output_dir=None) -> list:
+    '''
+    split a multi-head scan into a scan csv for each head, which can be
+    processed like any other scan, or lined up with registration.py.
+
+    Args:
+        path: the multi-head scan csv
+        output_dir: where to save the scans, next to the csv by default
+
+    Returns:
+        list: the path of each head's scan, named <scan>.<head>.csv.
+    '''
+    path = Path(path)
+    output_dir = path.parent if output_dir is None else Path(output_dir)
+    data = pd.read_csv(path)
+    paths = []
+    for name, group in data.groupby(data['head'].astype(str)):
+        head_path = output_dir / '{}.{}.csv'.format(path.stem, name)
+        group[list(scan_io.SCAN_COLUMNS)].to_csv(head_path, index=False)
+        paths.append(head_path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='scan with several heads '
+                                        'at once, without any prompts. an '
+                                        'existing scan at the output path is '
+                                        'resumed')
+    parser.add_argument('output', help='csv to save the tagged points to')
+    parser.add_argument('--head', nargs='+', action='append', default=[],
+                        metavar='ARG', dest='heads',
+                        help='NAME PORT [PLANNER [SETTLE_PROFILE]] for a '
+                        'head. every connected arduino is used if none are '
+                        'given')
+    parser.add_argument('--planner', default='serpentine',
+                        choices=scan_paths.PLANNERS,
+                        help='planner for heads that don\'t give one')
+    parser.add_argument('--replace', action='store_true',
+                        help='start over instead of resuming an existing scan')
+    parser.add_argument('--split', action='store_true',
+                        help='also save a scan csv for each head')
+    args = parser.parse_args(argv)
+
+    heads = args.heads or [['head{}'.format(number), port]
+                            for number, port in enumerate(detect_ports())]
+    if not heads:
+        parser.error('no arduinos found, give each head with --head')
+    for head in heads:
+        if not 2 <= len(head) <= 4:
+            parser.error('--head takes a name, a port, and optionally a '
+                            'planner and a settle profile')
+        if len(head) > 2 and head[2] not in scan_paths.PLANNERS:
+            parser.error('unknown planner {}'.format(head[2]))
+    if len(set(head[0] for head in heads)) < len(heads):
+        parser.error('each head needs a different name')
+
+    path = Path(args.output)
+    if args.replace and path.is_file():
+        path.unlink()
+    scanners = connect_heads({head[0]: head[1] for head in heads})
+    pans, tilts = collect_data.scan_grid()
+    plan = []
+    for name, port, *options in heads:
+        planner = options[0] if options else args.planner
+        if len(options) > 1:
+            collect_data.load_settle_profile(scanners[name], options[1])
+        plan.append(Head(name, scanners[name],
+                            scan_paths.PLANNERS[planner](pans, tilts)))
+        print('{}: {} scan on {}'.format(name, planner, port))
+
+    start = time.perf_counter()
+    finished = multi_scan(plan, path)
+    print('scan saved to {} in {:.1f} s'.format(path,
+                                                time.perf_counter() - start))
+    for name, (seconds, error) in finished.items():
+        print('{}: {:.1f} s{}'.format(name, seconds,
+                    '' if error is None else ', stopped: {!r}'.format(error)))
+    if args.split:
+        for head_path in split_heads(path):
+            print('saved {}'.format(head_path))
+    return 1 if any(error for _, error in finished.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
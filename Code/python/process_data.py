@@ -1,31 +1,53 @@
 import helpers
+import scan_io
+from RangeImage import RangeImage
+from PointCloud import PointCloud
+from VoxelPyramid import VoxelPyramid
+import mesh
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import argparse
+import csv
+import os
+import sys
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
 PAN_CENTER = 90
 TILT_CENTER = 82
+POINT_BUDGET = 20000    # most points to draw at once in the 3d view
+RASTER_POINTS = 20000   # 2d views with more points than this are drawn as images
+# what batch processing can save each scan as, and the ending of each file
+OUTPUT_FORMATS = {'ply': '.ply', 'stl': '.stl', 'points': '.points.ply',
+                    'xyz': '.xyz.csv'}
 
 def main():
     print('choose calibration data:')
-    calib_data = helpers.load_csv()
+    calib_path = helpers.choose_file()
     print('choose scan data:')
-    scan_data = helpers.load_csv()
-    # fit calibration data to exponential function
-    fit_params = helpers.fit_data(calib_data, 'Voltage', 'Distance')
-    # convert voltages from scan data to distances in cm
-    dists = helpers.exp_function(scan_data['voltage'], *fit_params)
-    # transform the data to cartesian coordinates after translating
-    # (rotating?) the center angle to be 0, 0
-    xs, ys, zs = helpers.sph2cart(
-        np.deg2rad(PAN_CENTER-scan_data['pan']), 
-        np.deg2rad(scan_data['tilt']-TILT_CENTER), dists)
-    # flip the y axis, not really sure why this is necessary but the
-    # scan is backwards if this isn't done
-    ys *= -1
-    # throw it in a dataframe so it's easier to use
-    transformed_data = pd.DataFrame({'x':xs, 'y':ys, 'z':zs}, index=None) 
-    
+    scan_data = scan_io.load_scan(helpers.choose_file(
+                    'enter a file path ending in .csv or .scan for your data: '))
+    # fit calibration data to exponential function (or reuse an earlier fit)
+    # and make a table of the distance for each raw reading
+    lut = helpers.distance_lut(helpers.calibration_fit(calib_path))
+    # convert raw readings from scan data to distances in cm, laid out as a
+    # grid of pan and tilt angles, then transform the grid to cartesian
+    # coordinates (with the center angle at 0, 0) for plotting
+    image = RangeImage.from_scan(scan_data, lut, PAN_CENTER, TILT_CENTER)
+    if helpers.yesno_confirm('would you like to smooth out noisy readings?'):
+        image = image.median_filter()
+    cloud = PointCloud.from_range_image(image)
+    if helpers.yesno_confirm('would you like to remove outliers from the plots?'):
+        cloud = cloud.remove_statistical_outliers()
+    # sort the points by distance once, so each range asked for below can be
+    # looked up from the full scan without going through every point
+    index = cloud.index()
+    pyramid = None      # levels of detail for the 3d view, made when needed
+    # optional limits across (y) and up (z), set with plot type 5
+    side_limits = [None, None]
+    up_limits = [None, None]
+
     # plot generation menu
     done = False
     while not done:
@@ -33,14 +55,17 @@ def main():
                                 'to include in the plot: '))
         max_dist = float(input('enter the maximum distance in cm '+\
                                 'to include in the plot: '))
-        # get rid of points not in the specified range
-        transformed_data = transformed_data[transformed_data.x > min_dist]
-        transformed_data = transformed_data[transformed_data.x < max_dist]
+        # only show points in the specified range
+        low = (min_dist, side_limits[0], up_limits[0])
+        high = (max_dist, side_limits[1], up_limits[1])
+        data = index.box(low, high)
         print('plot types:')
         print('0: 2D front view')
         print('1: 2D top-down view')
         print('2: 3D view')
         print('3: top-down single line view')
+        print('4: export a mesh (.ply or .stl)')
+        print('5: limit the plots to a box')
         mode = input('select a plot type, or "DONE" to exit: ').strip()
         if mode.upper() == 'DONE':
             done = True
@@ -49,62 +74,286 @@ def main():
         else:
             mode = int(mode)
             if mode == 0:
-                plot_front_view(transformed_data)
+                plot_front_view(data)
             elif mode == 1:
-                plot_top_view(transformed_data)
+                plot_top_view(data)
             elif mode == 2:
-                plot3d(transformed_data)
+                if pyramid is None:
+                    pyramid = VoxelPyramid(cloud)
+                plot3d(pyramid, low, high)
             elif mode == 3:
                 # top down view is funky since we're getting it from the
-                # 3d scan data take only the center angle data from the
-                # scan, then filter based on the input min and max, then
-                # send it to the plotting function
-                single_line = scan_data[scan_data.tilt == TILT_CENTER]
-                xs, ys, zs = helpers.sph2cart(
-                        np.deg2rad(PAN_CENTER-single_line['pan']),
-                        np.deg2rad(single_line['tilt']-TILT_CENTER), dists)
-                single_line_transformed = pd.DataFrame({'x':xs, 'y':ys, 'z':zs},
-                                    index=None)
-                single_line_transformed = single_line_transformed[
-                                    single_line_transformed.x > min_dist]
-                single_line_transformed = single_line_transformed[
-                                    single_line_transformed.x < max_dist]
-                plot_top_view(single_line_transformed)
-                # plot3d(single_line_transformed)
-
-def plot_front_view(data):
+                # 3d scan data, so take only the row at the center tilt
+                # angle and plot that
+                line = image.row(TILT_CENTER).box(low, high)
+                plot_top_view(line)
+                # plot3d(line)
+            elif mode == 4:
+                export_mesh(image.box(low, high))
+            elif mode == 5:
+                side_limits[:] = choose_limits('side to side (y)')
+                up_limits[:] = choose_limits('up and down (z)')
+
+def choose_limits(direction):
+    # ask for the range of a direction to plot, where blank means no limit
+    limits = []
+    for end in ('minimum', 'maximum'):
+        while True:
+            value = input('enter the {} {} in cm to include in the plot, or '
+                            'leave it blank for no limit: '.format(end,
+                            direction)).strip()
+            try:
+                limits.append(float(value) if value else None)
+                break
+            except ValueError:
+                print('invalid input!')
+    return limits
+
+def export_mesh(image):
+    # connect neighbouring points into triangles and save them for use in
+    # other programs
+    vertices, faces = mesh.grid_mesh(image)
+    while True:
+        path = Path(input('enter a file path ending in .ply or .stl to save '+\
+                            'the mesh: '))
+        if not path.parent.is_dir():
+            print('invalid path! make sure the directory exists and is accessible.')
+        elif path.suffix.lower() not in ('.ply', '.stl'):
+            print('the file has to end in .ply or .stl!')
+        elif not path.is_file() or helpers.yesno_confirm('a file already '+\
+                    'exists at that location. would you like to replace it?'):
+            mesh.write_mesh(path, vertices, faces)
+            print('saved {} triangles to {}'.format(len(faces), path))
+            return
+
+def process_scan(scan_path, output_dir, lut, output_format='ply',
+                    min_dist=None, max_dist=None, smooth=False,
+                    remove_outliers=False) -> Path:
+    '''
+    convert a scan to distances and save it, without asking anything, so
+    whole directories of scans can be processed at once.
+
+    Args:
+        scan_path: the scan to process (.csv or .scan)
+        output_dir: the directory to save the result in, named after the scan
+        lut (np.ndarray): the distance for each raw reading, from
+            helpers.distance_lut
+        output_format (str): one of OUTPUT_FORMATS. ply and stl save a mesh,
+            points saves just the points as a ply and xyz saves them as a csv
+        min_dist: the smallest distance in cm to keep, or None for no limit
+        max_dist: the largest distance in cm to keep, or None for no limit
+        smooth (bool): median filter the readings first
+        remove_outliers (bool): remove outlying points. meshes are made from
+            the grid of readings, so this only applies to the points formats
+
+    Returns:
+        Path: the file that was saved.
+    '''
+    image = RangeImage.from_scan(scan_io.load_scan(scan_path), lut,
+                                    PAN_CENTER, TILT_CENTER)
+    if smooth:
+        image = image.median_filter()
+    image = image.within(min_dist, max_dist)
+    path = Path(output_dir) / (Path(scan_path).stem +
+                                OUTPUT_FORMATS[output_format])
+    if output_format in ('ply', 'stl'):
+        mesh.write_mesh(path, *mesh.grid_mesh(image))
+        return path
+    cloud = PointCloud.from_range_image(image)
+    if remove_outliers:
+        cloud = cloud.remove_statistical_outliers()
+    if output_format == 'points':
+        mesh.write_ply(path, cloud.xyz, np.empty((0, 3), dtype=np.int32))
+    else:
+        pd.DataFrame(cloud.xyz, columns=['x', 'y', 'z']).to_csv(path,
+                                                                index=False)
+    return path
+
+def is_scan_csv(path) -> bool:
+    # whether a csv holds a scan, going by its header, rather than being a
+    # calibration or something this script saved (like a .xyz.csv)
+    path = Path(path)
+    if path.name.lower().endswith(tuple(OUTPUT_FORMATS.values())):
+        return False
+    with open(path, newline='', errors='replace') as file:
+        header = tuple(next(csv.reader(file), ()))
+    return header in (scan_io.SCAN_COLUMNS, ('pan', 'tilt', 'voltage'))
+
+def find_scans(paths, exclude=()) -> list:
+    # the scans to process, with directories standing for every scan in them.
+    # anything else in a directory (and the files in exclude) is skipped
+    exclude = {Path(path).resolve() for path in exclude}
+    found = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            found.extend(sorted(file for file in path.iterdir()
+                                if file.resolve() not in exclude and
+                                (file.suffix.lower() == '.scan' or
+                                    file.suffix.lower() == '.csv' and
+                                    is_scan_csv(file))))
+        elif path.resolve() not in exclude:
+            found.append(path)
+    return found
+
+def batch(paths, output_dir, lut, workers=None, **options) -> int:
+    '''
+    process many scans at once with process_scan, spread across a pool of
+    processes. the distance table is worked out once and handed to each of
+    them, so the calibration is only fit once however many scans there are.
+    a scan that can't be processed is reported and skipped.
+
+    Args:
+        paths: the scans to process
+        output_dir: the directory to save the results in
+        lut (np.ndarray): the distance for each raw reading
+        workers (int): how many processes to use, one per cpu by default
+        options: anything else to pass on to process_scan
+
+    Returns:
+        int: how many scans couldn't be processed.
+    '''
+    failed = 0
+    with ProcessPoolExecutor(workers) as pool:
+        jobs = {pool.submit(process_scan, path, output_dir, lut, **options): path
+                for path in paths}
+        for job in as_completed(jobs):
+            try:
+                print('{} -> {}'.format(jobs[job], job.result()))
+            except Exception as error:
+                failed += 1
+                print('{} failed: {!r}'.format(jobs[job], error))
+    return failed
+
+def cli(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='convert, filter and export '
+                                        'scans without any prompts')
+    parser.add_argument('scans', nargs='+',
+                        help='scan files (.csv or .scan), or directories of them')
+    parser.add_argument('--calibration', required=True,
+                        help='calibration csv to convert readings with')
+    parser.add_argument('--output', default='.',
+                        help='directory to save the results in')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='ply',
+                        dest='output_format')
+    parser.add_argument('--min-dist', type=float,
+                        help='smallest distance in cm to keep')
+    parser.add_argument('--max-dist', type=float,
+                        help='largest distance in cm to keep')
+    parser.add_argument('--smooth', action='store_true',
+                        help='median filter the readings')
+    parser.add_argument('--remove-outliers', action='store_true',
+                        help='remove outlying points (points formats only)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='processes to use')
+    args = parser.parse_args(argv)
+
+    output_dir = Path(args.output)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    lut = helpers.distance_lut(helpers.calibration_fit(args.calibration))
+    scans = find_scans(args.scans, exclude=[args.calibration])
+    failed = batch(scans, output_dir, lut, args.workers,
+                    output_format=args.output_format, min_dist=args.min_dist,
+                    max_dist=args.max_dist, smooth=args.smooth,
+                    remove_outliers=args.remove_outliers)
+    return 1 if failed else 0
+
+def rasterize(u, v, values=None, resolution=None):
+    # bin points into a grid of pixels, keeping the smallest value in each
+    # pixel, or counting the points if there aren't any values. by default
+    # there are about as many pixels as points, up to 400 across
+    if resolution is None:
+        resolution = int(np.clip(np.sqrt(len(u)), 50, 400))
+    pixel = max(np.ptp(u), np.ptp(v), 1e-9) / resolution
+    cols = ((u - u.min()) / pixel).astype(int)
+    rows = ((v - v.min()) / pixel).astype(int)
+    width, height = cols.max() + 1, rows.max() + 1
+    flat = rows*width + cols
+    if values is None:
+        image = np.bincount(flat, minlength=width*height).astype(float)
+        image[image == 0] = np.nan
+    else:
+        image = np.full(width*height, np.inf)
+        np.minimum.at(image, flat, values)
+        image[np.isinf(image)] = np.nan
+    extent = (u.min(), u.min() + width*pixel, v.min(), v.min() + height*pixel)
+    return image.reshape(height, width), extent
+
+def plot_front_view(data, raster=None):
+    x, y, z = data.points()
     # the 2d front view isn't backwards, so flip the y axis again
-    plt.scatter(-1*data.y, data.z)
+    if raster is None:
+        raster = len(x) > RASTER_POINTS
+    if raster:
+        # draw the nearest distance in each pixel instead of every point
+        image, extent = rasterize(-1*y, z, x)
+        plt.imshow(image, origin='lower', extent=extent, cmap='plasma')
+        plt.colorbar(label='X (cm)')
+    else:
+        plt.scatter(-1*y, z)
     plt.axis('equal')
     # plt.title('Scanner output in 2D')
     plt.xlabel('Y (cm)')
     plt.ylabel('Z (cm)')
     plt.show()
 
-def plot_top_view(data):
-    plt.scatter(data.y, data.x)
+def plot_top_view(data, raster=None):
+    x, y, z = data.points()
+    if raster is None:
+        raster = len(x) > RASTER_POINTS
+    if raster:
+        # draw how many points land in each pixel instead of every point
+        image, extent = rasterize(y, x)
+        plt.imshow(image, origin='lower', extent=extent, cmap='viridis')
+        plt.colorbar(label='points')
+    else:
+        plt.scatter(y, x)
     plt.axis('equal')
     # plt.title('Scanner output in 2D')
     plt.xlabel('y (cm)')
     plt.ylabel('x (cm)')
     plt.show()
 
-def plot3d(data):
+def plot3d(data, low=(None, None, None), high=(None, None, None),
+            budget=POINT_BUDGET):
+    # draw at most budget points, from the most detailed level of the
+    # pyramid that fits. zooming in redraws the view with more detail
+    pyramid = data if isinstance(data, VoxelPyramid) else \
+                VoxelPyramid(PointCloud(np.stack(data.points(), axis=1)))
     ax = plt.axes(projection='3d')
-    # colormap doesn't work like this, idk i hate matplotlib
-    ax.scatter(data.x, data.y, data.z, marker='.', cmap='plasma')
-    # Create cubic bounding box to simulate equal aspect ratio
-    # from https://stackoverflow.com/a/13701747
-    max_range = np.array([data.x.max()-data.x.min(),
-        data.y.max()-data.y.min(), data.z.max()-data.z.min()]).max()
-    Xb = 0.5*max_range*np.mgrid[-1:2:2,-1:2:2,-1:2:2][0].flatten()\
-            + 0.5*(data.x.max()+data.x.min())
-    Yb = 0.5*max_range*np.mgrid[-1:2:2,-1:2:2,-1:2:2][1].flatten()\
-            + 0.5*(data.y.max()+data.y.min())
-    Zb = 0.5*max_range*np.mgrid[-1:2:2,-1:2:2,-1:2:2][2].flatten()\
-            + 0.5*(data.z.max()+data.z.min())
-    for xb, yb, zb in zip(Xb, Yb, Zb):
-        ax.plot([xb], [yb], [zb], 'w')
+    xyz, colors = pyramid.view(low, high, budget)
+    if len(xyz) == 0:
+        print('no points to plot!')
+        plt.close()
+        return
+    # make the view a cube so the scan isn't stretched
+    center = (xyz.max(axis=0) + xyz.min(axis=0)) / 2
+    half = np.ptp(xyz, axis=0).max() / 2
+    ax.set_xlim3d(center[0] - half, center[0] + half)
+    ax.set_ylim3d(center[1] - half, center[1] + half)
+    ax.set_zlim3d(center[2] - half, center[2] + half)
+    ax.set_box_aspect((1, 1, 1))
+    ax.set_autoscale_on(False)
+    drawn = {'points': ax.scatter(*xyz.T, marker='.', c=colors),
+                'limits': None}
+
+    def refresh(event=None):
+        limits = (ax.get_xlim3d(), ax.get_ylim3d(), ax.get_zlim3d())
+        if limits == drawn['limits']:
+            return      # just rotated, the same points are still right
+        drawn['limits'] = limits
+        # the view, but never past the limits asked for
+        view_low = [limit[0] if bound is None else max(limit[0], bound)
+                    for limit, bound in zip(limits, low)]
+        view_high = [limit[1] if bound is None else min(limit[1], bound)
+                        for limit, bound in zip(limits, high)]
+        xyz, colors = pyramid.view(view_low, view_high, budget)
+        drawn['points'].remove()
+        drawn['points'] = ax.scatter(*xyz.T, marker='.', c=colors)
+        ax.figure.canvas.draw_idle()
+
+    refresh()
+    ax.figure.canvas.mpl_connect('button_release_event', refresh)
+    ax.figure.canvas.mpl_connect('scroll_event', refresh)
 
     # ax.set_title('Scanner output while scanning O')
     ax.set_xlabel('X (cm)')
@@ -113,5 +362,9 @@ def plot3d(data):
     plt.show()
 
 if __name__ == '__main__':
+    # with arguments, process scans in batch, for example
+    # python process_data.py --calibration calibration_data.csv scans/
+    if len(sys.argv) > 1:
+        sys.exit(cli())
     main()
     
\ No newline at end of file
@@ -0,0 +1,254 @@
+'''
+lining up scans taken from different sides of an object and merging them
+into one point cloud.
+
+each scan gets a rough guess of where the scanner was when it was taken
+(its pose), which is refined with point-to-plane ICP: every point of the new
+scan is matched with the nearest point of the scans already lined up, and
+the scan is moved to bring the matches together, over and over. matching
+starts on heavily downsampled clouds and works down to finer ones, so the
+early passes are cheap and the later ones only have small corrections left.
+
+each scan is lined up against everything before it, and the result is saved
+by a hash of the scan, its pose guess and everything it was lined up
+against. adding another view to a set of scans only has to line up the new
+one.
+'''
+from PointCloud import PointCloud
+from RangeImage import RangeImage
+import helpers
+import mesh
+import scan_io
+
+from pathlib import Path
+import hashlib
+import json
+import numpy as np
+
+# registered transforms are saved here so they only have to be worked out once
+REGISTRATION_CACHE = Path.home() / '.pantilt' / 'registration'
+
+
+def pose_matrix(x=0, y=0, z=0, yaw=0, pitch=0, roll=0) -> np.ndarray:
+    '''
+    build the transform for a scanner pose.
+
+    Args:
+        x, y, z: where the scanner was in cm
+        yaw: rotation around the vertical (z) axis in degrees
+        pitch: rotation around the sideways (y) axis in degrees
+        roll: rotation around the forward (x) axis in degrees
+
+    Returns:
+        np.ndarray: 4x4 matrix taking points from the scan's coordinates to
+            the shared coordinates.
+    '''
+    yaw, pitch, roll = np.deg2rad([yaw, pitch, roll])
+    cz, sz = np.cos(yaw), np.sin(yaw)
+    cy, sy = np.cos(pitch), np.sin(pitch)
+    cx, sx = np.cos(roll), np.sin(roll)
+    matrix = np.eye(4)
+    matrix[:3, :3] = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]]) @ \
+                        np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]]) @ \
+                        np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    matrix[:3, 3] = x, y, z
+    return matrix
+
+
+def transform(cloud: PointCloud, matrix) -> PointCloud:
+    '''
+    move a point cloud (and turn its normals) by a 4x4 transform.
+    '''
+    rotation, translation = matrix[:3, :3], matrix[:3, 3]
+    normals = None if cloud.normals is None else cloud.normals @ rotation.T
+    return PointCloud(cloud.xyz @ rotation.T + translation, normals)
+
+
+def _rotation(angles) -> np.ndarray:
+    # rotation matrix for a rotation vector (rodrigues' formula)
+    theta = np.linalg.norm(angles)
+    if theta < 1e-12:
+        return np.eye(3)
+    k = angles / theta
+    cross = np.array([[0, -k[2], k[1]], [k[2], 0, -k[0]], [-k[1], k[0], 0]])
+    return np.eye(3) + np.sin(theta)*cross + (1 - np.cos(theta))*cross @ cross
+
+
+def icp(source: PointCloud, target: PointCloud, initial=None,
+        voxel_sizes=(4, 2, 1), iterations=30, tolerance=1e-5) -> tuple:
+    '''
+    line a point cloud up with another using point-to-plane ICP, starting
+    with both downsampled into big voxels and working down to small ones.
+    matches further apart than a few voxels are ignored, so parts of the
+    scans that don't overlap don't pull them out of line.
+
+    Args:
+        source (PointCloud): the cloud to move
+        target (PointCloud): the cloud to line it up with
+        initial: 4x4 starting guess for the transform, identity by default
+        voxel_sizes: voxel size in cm for each pass, coarsest first
+        iterations (int): the most iterations for each pass
+        tolerance (float): stop a pass once a step moves less than this
+            (radians or cm)
+
+    Returns:
+        tuple: (np.ndarray: 4x4 transform taking source to target,
+            float: rms point-to-plane distance of the matches in cm)
+    '''
+    matrix = np.eye(4) if initial is None else np.array(initial, dtype=float)
+    error = np.inf
+    for size in voxel_sizes:
+        moving = source.voxel_downsample(size)
+        fixed = target.voxel_downsample(size).estimate_normals()
+        max_distance = 3*size
+        for _ in range(iterations):
+            points = transform(moving, matrix).xyz
+            distances, index = fixed.tree.query(points, workers=-1,
+                                                distance_upper_bound=max_distance)
+            matched = np.isfinite(distances)
+            if matched.sum() < 6:
+                break
+            p = points[matched]
+            q = fixed.xyz[index[matched]]
+            n = fixed.normals[index[matched]]
+            # linearize the rotation and solve for the small move that best
+            # brings each point onto its match's tangent plane
+            residuals = np.einsum('ij,ij->i', p - q, n)
+            jacobian = np.hstack([np.cross(p, n), n])
+            step = np.linalg.lstsq(jacobian, -residuals, rcond=None)[0]
+            update = np.eye(4)
+            update[:3, :3] = _rotation(step[:3])
+            update[:3, 3] = step[3:]
+            matrix = update @ matrix
+            error = np.sqrt(np.mean(residuals**2))
+            if np.linalg.norm(step) < tolerance:
+                break
+    return matrix, error
+
+
+def merge(clouds, voxel_size=0.5) -> PointCloud:
+    '''
+    combine lined up clouds into one. where scans overlap they'd double up
+    the points, so everything within a voxel is merged into one point.
+
+    Args:
+        clouds: the PointClouds, already in shared coordinates
+        voxel_size (float): how close points have to be to be merged, in cm
+
+    Returns:
+        PointCloud: the merged cloud.
+    '''
+    return PointCloud(np.concatenate([cloud.xyz for cloud in clouds])) \
+            .voxel_downsample(voxel_size)
+
+
+def load_cloud(path, lut) -> PointCloud:
+    '''
+    load a scan (csv or .scan) as a point cloud in the scanner's coordinates.
+    '''
+    return PointCloud.from_range_image(
+                RangeImage.from_scan(scan_io.load_scan(path), lut))
+
+
+def _cache_key(path, pose, lut, voxel_sizes, previous: str) -> str:
+    # depends on the scan, its pose guess, the calibration, how it was lined
+    # up and everything it was lined up against
+    digest = hashlib.sha256(Path(path).read_bytes())
+    digest.update(np.asarray(pose, dtype='<f8').tobytes())
+    digest.update(np.asarray(lut, dtype='<f8').tobytes())
+    digest.update(repr(tuple(voxel_sizes)).encode())
+    digest.update(previous.encode())
+    return digest.hexdigest()
+
+
+def register_scans(paths, poses, lut, voxel_sizes=(4, 2, 1),
+                    cache=REGISTRATION_CACHE) -> list:
+    '''
+    line up a set of scans. the first scan stays where its pose puts it, and
+    every scan after that is lined up against all of the ones before it.
+    results are saved in the cache and reused when nothing they depend on
+    has changed.
+
+    Args:
+        paths: the scan files
+        poses: a rough 4x4 pose guess for each scan, see pose_matrix
+        lut (np.ndarray): the distance for each raw reading, from
+            helpers.distance_lut
+        voxel_sizes: voxel size in cm for each ICP pass, coarsest first
+        cache: the directory to save transforms in, or None to not save them
+
+    Returns:
+        list: (np.ndarray: 4x4 transform, PointCloud: the scan in shared
+            coordinates) for each scan.
+    '''
+    results = []
+    key = ''
+    for path, pose in zip(paths, poses):
+        key = _cache_key(path, pose, lut, voxel_sizes, key)
+        cloud = load_cloud(path, lut)
+        cache_file = None if cache is None else Path(cache) / '{}.json'.format(key)
+        if cache_file is not None and cache_file.is_file():
+            with open(cache_file) as file:
+                matrix = np.array(json.load(file)['transform'])
+        elif not results:
+            matrix = np.asarray(pose, dtype=float)
+        else:
+            target = PointCloud(np.concatenate([placed.xyz
+                                                for _, placed in results]))
+            matrix, error = icp(cloud, target, pose, voxel_sizes)
+            print('{}: lined up to within {:.2f} cm'.format(path, error))
+        if cache_file is not None and not cache_file.is_file():
+            # a cache that can't be written just means registering again
+            try:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                with open(cache_file, 'w') as file:
+                    json.dump({'source': str(path),
+                                'transform': matrix.tolist()}, file)
+            except OSError:
+                pass
+        results.append((matrix, transform(cloud, matrix)))
+    return results
+
+
+def choose_pose() -> np.ndarray:
+    while True:
+        values = input('enter a rough guess of where the scanner was as '+\
+                        '"x y z yaw" (cm and degrees), or leave it blank if '+\
+                        'it didn\'t move: ').split()
+        try:
+            return pose_matrix(*[float(value) for value in values][:4])
+        except (TypeError, ValueError):
+            print('invalid input!')
+
+
+def main():
+    print('choose calibration data:')
+    lut = helpers.distance_lut(helpers.calibration_fit(helpers.choose_file()))
+    paths, poses = [], []
+    while True:
+        path = input('enter the path of a scan to add (.csv or .scan), or '+\
+                        '"DONE" when finished: ').strip()
+        if path.upper() == 'DONE':
+            if len(paths) >= 2:
+                break
+            print('choose at least two scans!')
+        elif not Path(path).is_file():
+            print('the specified file was not found!')
+        else:
+            paths.append(Path(path))
+            poses.append(choose_pose())
+    merged = merge(cloud for _, cloud in register_scans(paths, poses, lut))
+    while True:
+        path = Path(input('enter a file path ending in .ply to save the '+\
+                            'merged cloud: '))
+        if not path.parent.is_dir():
+            print('invalid path! make sure the directory exists and is accessible.')
+        elif not path.is_file() or helpers.yesno_confirm('a file already '+\
+                    'exists at that location. would you like to replace it?'):
+            mesh.write_ply(path, merged.xyz, np.empty((0, 3), dtype=np.int32))
+            print('saved {} points to {}'.format(len(merged), path))
+            break
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+'''
+reading and writing scan files.
+
+scans are saved as csv while they're running, and can be converted to a
+compact binary format for processing. a binary scan file is a header, a json
+metadata block and three columns: pan and tilt as int16 and the raw sensor
+reading as uint16. the columns are opened with np.memmap, so opening a scan
+doesn't read it and only the parts used are ever loaded.
+'''
+from pathlib import Path
+import csv
+import json
+import os
+import struct
+import sys
+import time
+import numpy as np
+import pandas as pd
+import helpers
+
+SCAN_COLUMNS = ('pan', 'tilt', 'raw')
+
+SCAN_MAGIC = b'PTSC'
+SCAN_VERSION = 1
+# magic, version, pan center, tilt center, pan step, tilt step, number of
+# points, length of the json metadata that follows
+SCAN_HEADER = struct.Struct('<4sHhhhhII')
+# the columns start on an 8 byte boundary after the metadata
+SCAN_ALIGNMENT = 8
+
+
+class ScanWriter:
+    '''
+    appends scan points to a csv while the scan is running, so a crash only
+    loses the last few points instead of the whole scan. if the file already
+    exists the points in it are kept, and the scan can pick up where it left
+    off by skipping the points in done. an existing file has to have the
+    same columns.
+
+    Args:
+        path: the csv file to write to
+        columns: the column names, used when starting a new file
+        chunk_size (int): how many points to collect before writing them
+        fsync_interval (float): how often in seconds to make sure what's been
+            written has actually reached the disk
+    '''
+    def __init__(self, path, columns=SCAN_COLUMNS, chunk_size=64,
+                    fsync_interval=5.0) -> None:
+        self.path = Path(path)
+        self.columns = tuple(columns)
+        self.chunk_size = chunk_size
+        self.fsync_interval = fsync_interval
+        self.done = set()       # (pan, tilt) of every point in the file
+        self._chunk = []
+        if self.path.is_file() and self.path.stat().st_size > 0 and \
+                self._recover():
+            self._file = open(self.path, 'a', newline='')
+        else:
+            self._file = open(self.path, 'w', newline='')
+            self._file.write(','.join(self.columns) + '\n')
+        self._last_fsync = time.monotonic()
+
+    def _recover(self) -> bool:
+        '''
+        read back the points already in the file, and cut off a partly
+        written last line if the previous scan was interrupted mid-write.
+
+        Returns:
+            bool: False if not even the header was finished, so the file
+                has to be started over.
+        '''
+        with open(self.path, 'rb+') as file:
+            data = file.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                file.truncate(end)
+        if end == 0:
+            return False
+        lines = data[:end].decode().splitlines()
+        reader = csv.reader(lines)
+        columns = tuple(next(reader))
+        if columns != self.columns:
+            raise ValueError('{} has columns {}, expected {}'.format(
+                                self.path, columns, self.columns))
+        pan, tilt = self.columns.index('pan'), self.columns.index('tilt')
+        for row in reader:
+            self.done.add((float(row[pan]), float(row[tilt])))
+        return True
+
+    def __enter__(self) -> 'ScanWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def append(self, point) -> None:
+        '''
+        add a point to the file. points are written in chunks, so this
+        usually doesn't touch the disk.
+
+        Args:
+            point: the point's values, in the same order as the columns
+        '''
+        self._chunk.append(','.join(str(value) for value in point) + '\n')
+        self.done.add((float(point[0]), float(point[1])))
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self, sync: bool = False) -> None:
+        '''
+        write out any points that haven't been written yet.
+
+        Args:
+            sync (bool): make sure they've reached the disk even if the
+                fsync interval hasn't passed
+        '''
+        if self._chunk:
+            self._file.write(''.join(self._chunk))
+            self._chunk.clear()
+        self._file.flush()
+        if sync or time.monotonic() - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = time.monotonic()
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self.flush(sync=True)
+            self._file.close()
+
+
+def sort_scan(path) -> None:
+    '''
+    rewrite a scan csv in raster order (sorted by pan, then tilt), so it
+    looks the same no matter what order the points were scanned in. the file
+    is replaced in one step, so it's never left half written.
+
+    Args:
+        path: the csv file to sort
+    '''
+    path = Path(path)
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        pan, tilt = header.index('pan'), header.index('tilt')
+        rows = sorted(reader, key=lambda row: (float(row[pan]),
+                                                float(row[tilt])))
+    temp = path.with_name(path.name + '.tmp')
+    with open(temp, 'w', newline='') as file:
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp, path)
+
+
+class ScanFile:
+    '''
+    a binary scan file opened with np.memmap. pan, tilt and raw are arrays
+    backed by the file, so nothing is read until it's used.
+
+    Args:
+        path: the scan file to open
+        mode (str): 'r' to read, 'r+' to also be able to modify the points
+    '''
+    def __init__(self, path, mode='r') -> None:
+        self.path = Path(path)
+        with open(self.path, 'rb') as file:
+            header = file.read(SCAN_HEADER.size)
+            magic, version, self.pan_center, self.tilt_center, \
+                self.pan_step, self.tilt_step, count, metadata_size = \
+                SCAN_HEADER.unpack(header)
+            if magic != SCAN_MAGIC:
+                raise ValueError('{} is not a scan file'.format(path))
+            if version != SCAN_VERSION:
+                raise ValueError('{} is scan file version {}, expected {}'
+                                    .format(path, version, SCAN_VERSION))
+            self.metadata = json.loads(file.read(metadata_size) or b'{}')
+        offset = _columns_offset(metadata_size)
+        self.pan = np.memmap(self.path, np.int16, mode, offset, (count,))
+        self.tilt = np.memmap(self.path, np.int16, mode, offset + 2*count,
+                                (count,))
+        self.raw = np.memmap(self.path, np.uint16, mode, offset + 4*count,
+                                (count,))
+
+    def __len__(self) -> int:
+        return len(self.raw)
+
+    @property
+    def voltage(self) -> np.ndarray:
+        return helpers.raw_to_voltage(self.raw)
+
+    def to_dataframe(self, raw=False) -> pd.DataFrame:
+        '''
+        load the scan into a DataFrame in the same form as a scan csv.
+
+        Args:
+            raw (bool): give raw sensor readings instead of voltages, like
+                newer scan csvs
+
+        Returns:
+            DataFrame: the scan's pan, tilt and voltage (or raw) columns.
+        '''
+        if raw:
+            return pd.DataFrame({'pan': self.pan, 'tilt': self.tilt,
+                                    'raw': self.raw})
+        return pd.DataFrame({'pan': self.pan.astype(float),
+                                'tilt': self.tilt.astype(float),
+                                'voltage': self.voltage})
+
+
+def _columns_offset(metadata_size: int) -> int:
+    end = SCAN_HEADER.size + metadata_size
+    return -(-end // SCAN_ALIGNMENT) * SCAN_ALIGNMENT
+
+
+def write_scan_file(path, pan, tilt, raw, pan_center=90, tilt_center=82,
+                    pan_step=1, tilt_step=1, metadata=None) -> None:
+    '''
+    save scan points as a binary scan file.
+
+    Args:
+        path: the file to write
+        pan: pan angle of each point
+        tilt: tilt angle of each point
+        raw: raw sensor reading (0-1023) of each point
+        pan_center: the pan angle facing the middle of the scan
+        tilt_center: the tilt angle facing the middle of the scan
+        pan_step: the pan interval the scan was taken at
+        tilt_step: the tilt interval the scan was taken at
+        metadata (dict): anything else worth keeping with the scan, like
+            which calibration goes with it. must be json serializable
+    '''
+    pan = np.asarray(pan, dtype=np.int16)
+    tilt = np.asarray(tilt, dtype=np.int16)
+    raw = np.asarray(raw, dtype=np.uint16)
+    encoded = json.dumps(metadata or {}).encode()
+    with open(path, 'wb') as file:
+        file.write(SCAN_HEADER.pack(SCAN_MAGIC, SCAN_VERSION, pan_center,
+                                    tilt_center, pan_step, tilt_step,
+                                    len(raw), len(encoded)))
+        file.write(encoded)
+        file.write(bytes(_columns_offset(len(encoded)) - file.tell()))
+        for column in (pan, tilt, raw):
+            file.write(column.astype(column.dtype.newbyteorder('<')).tobytes())
+
+
+def _grid_step(angles) -> int:
+    steps = np.diff(np.unique(angles))
+    return int(steps.min()) if len(steps) else 1
+
+
+def csv_to_scan_file(csv_path, scan_path, pan_center=90, tilt_center=82,
+                        metadata=None) -> None:
+    '''
+    convert a scan csv to a binary scan file. the step sizes are worked out
+    from the angles in the scan. csvs with either raw or voltage columns can
+    be converted, as long as the voltages came from raw readings. which one
+    the csv had is saved in the metadata as 'column', so converting back
+    gives the same columns.
+
+    Args:
+        csv_path: the scan csv to read
+        scan_path: the scan file to write
+        pan_center: the pan angle facing the middle of the scan
+        tilt_center: the tilt angle facing the middle of the scan
+        metadata (dict): extra metadata to save with the scan
+    '''
+    data = pd.read_csv(csv_path)
+    pan, tilt = data['pan'].to_numpy(), data['tilt'].to_numpy()
+    if np.any(pan != np.rint(pan)) or np.any(tilt != np.rint(tilt)):
+        raise ValueError('scan angles must be whole degrees')
+    metadata = dict(metadata or {},
+                    column='raw' if 'raw' in data else 'voltage')
+    write_scan_file(scan_path, pan, tilt, helpers.raw_codes(data),
+                    pan_center, tilt_center, _grid_step(pan), _grid_step(tilt),
+                    metadata)
+
+
+def scan_file_to_csv(scan_path, csv_path) -> None:
+    '''
+    convert a binary scan file back to a scan csv, with the raw or voltage
+    column the scan was converted from (raw if it doesn't say), so a raw
+    scan can still be resumed with ScanWriter.
+
+    Args:
+        scan_path: the scan file to read
+        csv_path: the scan csv to write
+    '''
+    scan = ScanFile(scan_path)
+    raw = scan.metadata.get('column', 'raw') == 'raw'
+    scan.to_dataframe(raw=raw).to_csv(csv_path, index=False)
+
+
+def load_scan(path):
+    '''
+    load a scan from either a csv or a binary scan file. a scan file is
+    just opened, not read, and RangeImage.from_scan works on its memmapped
+    columns directly.
+
+    Args:
+        path: the scan to load
+
+    Returns:
+        DataFrame with the csv's pan and tilt columns and its raw (or for
+            older csvs voltage) column, or the opened ScanFile.
+    '''
+    path = Path(path)
+    if path.suffix.lower() == '.csv':
+        return pd.read_csv(path)
+    return ScanFile(path)
+
+
+if __name__ == '__main__':
+    # convert between formats based on the file extensions, for example
+    # python scan_io.py o_data.csv o_data.scan
+    if len(sys.argv) != 3:
+        print('usage: python scan_io.py <input> <output>')
+        sys.exit(1)
+    source, destination = Path(sys.argv[1]), Path(sys.argv[2])
+    if source.suffix.lower() == '.csv':
+        csv_to_scan_file(source, destination)
+    else:
+        scan_file_to_csv(source, destination)
@@ -0,0 +1,344 @@
+'''
+scan path planners. each planner takes the pan and tilt angles making up a
+scan grid and returns the (pan, tilt) points in the order they should be
+visited. every planner visits every point of the grid exactly once, so the
+order only changes how long the servos spend travelling.
+'''
+
+import csv
+
+MSEC_PER_DEG = 20   # must match MSEC_PER_DEG in communication.ino
+AXES = ('pan', 'tilt')
+
+
+def raster(pans, tilts) -> list:
+    '''
+    sweep tilt from bottom to top for every pan angle, jumping back to the
+    bottom at the start of each column.
+
+    Args:
+        pans: the pan angles to visit
+        tilts: the tilt angles to visit
+
+    Returns:
+        list: (pan, tilt) tuples in the order they should be scanned.
+    '''
+    return [(pan, tilt) for pan in pans for tilt in tilts]
+
+
+def serpentine(pans, tilts) -> list:
+    '''
+    sweep tilt up one column and back down the next (boustrophedon order),
+    so moving to the next column only costs one pan step.
+
+    Args:
+        pans: the pan angles to visit
+        tilts: the tilt angles to visit
+
+    Returns:
+        list: (pan, tilt) tuples in the order they should be scanned.
+    '''
+    tilts = list(tilts)
+    path = []
+    for column, pan in enumerate(pans):
+        column_tilts = tilts if column % 2 == 0 else reversed(tilts)
+        path.extend((pan, tilt) for tilt in column_tilts)
+    return path
+
+
+def hilbert(pans, tilts) -> list:
+    '''
+    visit the grid along a hilbert curve. consecutive points are neighbours
+    wherever the grid fills the curve, which keeps every move short.
+
+    Args:
+        pans: the pan angles to visit
+        tilts: the tilt angles to visit
+
+    Returns:
+        list: (pan, tilt) tuples in the order they should be scanned.
+    '''
+    pans, tilts = list(pans), list(tilts)
+    # the curve covers a square with a power of two side, so walk the
+    # smallest one that contains the grid and skip points outside of it
+    side = 1
+    while side < max(len(pans), len(tilts)):
+        side *= 2
+    path = []
+    for d in range(side*side):
+        x, y = _hilbert_point(side, d)
+        if x < len(pans) and y < len(tilts):
+            path.append((pans[x], tilts[y]))
+    return path
+
+
+def _hilbert_point(side: int, d: int) -> tuple:
+    '''
+    convert a distance along a hilbert curve to grid coordinates.
+    from https://en.wikipedia.org/wiki/Hilbert_curve
+
+    Args:
+        side (int): the side length of the curve's square, a power of two
+        d (int): the distance along the curve
+
+    Returns:
+        tuple: the (x, y) grid coordinates of the point.
+    '''
+    x, y = 0, 0
+    s = 1
+    while s < side:
+        rx = 1 & (d // 2)
+        ry = 1 & (d ^ rx)
+        if ry == 0:
+            if rx == 1:
+                x, y = s-1-x, s-1-y
+            x, y = y, x
+        x += s*rx
+        y += s*ry
+        d //= 4
+        s *= 2
+    return x, y
+
+
+PLANNERS = {'raster': raster, 'serpentine': serpentine, 'hilbert': hilbert}
+
+
+def settle_time(profile, axis: str, delta) -> float:
+    '''
+    how long a move waits, the same way the firmware works it out. the time
+    is interpolated between the points of the axis's settle profile, and
+    past the last point each extra degree takes MSEC_PER_DEG. without a
+    profile every degree takes MSEC_PER_DEG.
+
+    Args:
+        profile (dict): settle profile, mapping 'pan' and 'tilt' to lists of
+            (step size in degrees, wait in msec) sorted by step size, or None
+        axis (str): 'pan' or 'tilt'
+        delta: how far the axis moves in degrees
+
+    Returns:
+        float: the wait in milliseconds.
+    '''
+    delta = abs(delta)
+    if delta == 0:
+        return 0
+    prev_deg, prev_ms = 0, 0
+    for deg, ms in (profile or {}).get(axis, []):
+        if delta <= deg:
+            return prev_ms + (ms - prev_ms) * (delta - prev_deg) // (deg - prev_deg)
+        prev_deg, prev_ms = deg, ms
+    return prev_ms + (delta - prev_deg) * MSEC_PER_DEG
+
+
+def load_settle_profile(path) -> dict:
+    '''
+    load a settle profile saved by calibration.measure_settle_profile.
+
+    Args:
+        path: csv with Axis, Step and Settle (msec) columns
+
+    Returns:
+        dict: the settle profile, see settle_time.
+    '''
+    profile = {axis: [] for axis in AXES}
+    with open(path, newline='') as file:
+        for row in csv.DictReader(file):
+            profile[row['Axis']].append((int(row['Step']), int(row['Settle'])))
+    for points in profile.values():
+        points.sort()
+    return profile
+
+
+def estimate_time(path, start=(0, 0), msec_per_deg=MSEC_PER_DEG,
+                    msec_per_command=0, simultaneous=False,
+                    profile=None) -> float:
+    '''
+    estimate how long a scan will take using the firmware's timing model,
+    where a move blocks for abs(delta)*MSEC_PER_DEG, or for the time from a
+    settle profile if one was uploaded. with separate pan and tilt commands
+    the waits add up, while a POINT command moves both servos at once and
+    only waits for the longer move.
+
+    Args:
+        path: the (pan, tilt) points to be scanned, in order
+        start (tuple): the (pan, tilt) the scanner is at before the scan
+        msec_per_deg: servo travel time per degree in milliseconds
+        msec_per_command: fixed overhead of each command sent, for
+            the serial round trip and sampling
+        simultaneous (bool): whether each point is a single POINT command
+        profile (dict): the settle profile in use, see settle_time. replaces
+            msec_per_deg when given
+
+    Returns:
+        float: the estimated scan time in seconds.
+    '''
+    def wait(axis, delta):
+        if profile is not None:
+            return settle_time(profile, axis, delta)
+        return abs(delta)*msec_per_deg
+
+    msec = 0
+    pan, tilt = start
+    for next_pan, next_tilt in path:
+        if simultaneous:
+            msec += max(wait('pan', next_pan-pan), wait('tilt', next_tilt-tilt))
+        else:
+            if next_pan != pan:
+                msec += wait('pan', next_pan-pan) + msec_per_command
+            if next_tilt != tilt:
+                msec += wait('tilt', next_tilt-tilt) + msec_per_command
+        msec += msec_per_command    # the sensor reading
+        pan, tilt = next_pan, next_tilt
+    return msec/1000
+
+
+def serpentine_order(points, start=(0, 0)) -> list:
+    '''
+    put an arbitrary set of points in serpentine order: column by column
+    along pan, sweeping tilt up one column and down the next. the sweep
+    starts from whichever end of the pan range is closer to the start.
+
+    Args:
+        points: the (pan, tilt) points to order
+        start (tuple): the (pan, tilt) the scanner is at
+
+    Returns:
+        list: the points in the order they should be scanned.
+    '''
+    columns = {}
+    for pan, tilt in points:
+        columns.setdefault(pan, []).append(tilt)
+    pans = sorted(columns)
+    if pans and abs(pans[-1] - start[0]) < abs(pans[0] - start[0]):
+        pans.reverse()
+    path = []
+    upward = True
+    for pan in pans:
+        path.extend((pan, tilt) for tilt in sorted(columns[pan],
+                                                    reverse=not upward))
+        upward = not upward
+    return path
+
+
+class AdaptivePlanner:
+    '''
+    plans a coarse-to-fine scan. the grid is first scanned every coarse_step
+    points, then any cell whose corners differ by more than the threshold is
+    split in half along each axis and its new corners are scanned, over and
+    over until the cells are min_step wide or the point budget runs out.
+    flat areas and empty background only ever get the coarse pass.
+
+    the planner only decides what to scan: next_batch gives the points to
+    scan next, and add takes back the value measured at each one.
+
+    Args:
+        pans: the pan angles of the full resolution grid
+        tilts: the tilt angles of the full resolution grid
+        threshold: how much the corners of a cell can differ before it's
+            split, in the same units as the values added
+        coarse_step (int): grid points between samples in the first pass
+        min_step (int): the smallest cell size, in grid points
+        budget (int): the most points to scan, or None for no limit
+    '''
+    def __init__(self, pans, tilts, threshold, coarse_step=4, min_step=1,
+                    budget=None) -> None:
+        self.pans = list(pans)
+        self.tilts = list(tilts)
+        self.threshold = threshold
+        self.min_step = max(1, min_step)
+        self.budget = budget
+        self.values = {}        # measured value at each (pan, tilt)
+        self.planned = 0        # points handed out so far
+        # cells are (first pan, last pan, first tilt, last tilt) as indices
+        # into the grid, and only the ones that might still be split are kept
+        pan_edges = AdaptivePlanner._coarse(len(self.pans), coarse_step)
+        tilt_edges = AdaptivePlanner._coarse(len(self.tilts), coarse_step)
+        self._cells = [(pan_edges[i], pan_edges[i+1],
+                        tilt_edges[j], tilt_edges[j+1])
+                        for i in range(len(pan_edges) - 1)
+                        for j in range(len(tilt_edges) - 1)]
+        self._first = [(i, j) for i in pan_edges for j in tilt_edges]
+
+    @staticmethod
+    def _coarse(length: int, step: int) -> list:
+        # every step-th index, always including the last one
+        edges = list(range(0, length, max(1, step)))
+        if edges[-1] != length - 1:
+            edges.append(length - 1)
+        return edges
+
+    def _point(self, index: tuple) -> tuple:
+        return self.pans[index[0]], self.tilts[index[1]]
+
+    def add(self, point: tuple, value) -> None:
+        '''
+        record the value measured at a point.
+
+        Args:
+            point (tuple): the (pan, tilt) that was scanned
+            value: what was measured there
+        '''
+        self.values[point] = value
+
+    def _contrast(self, cell: tuple) -> float:
+        corners = [self.values.get(self._point((i, j))) for i in cell[:2]
+                    for j in cell[2:]]
+        if None in corners:
+            return 0
+        return max(corners) - min(corners)
+
+    def _split(self, cell: tuple) -> list:
+        # halve the cell along each axis that's still big enough
+        pa, pb, ta, tb = cell
+        pan_ranges, tilt_ranges = [(pa, pb)], [(ta, tb)]
+        if pb - pa >= 2*self.min_step:
+            pm = (pa + pb) // 2
+            pan_ranges = [(pa, pm), (pm, pb)]
+        if tb - ta >= 2*self.min_step:
+            tm = (ta + tb) // 2
+            tilt_ranges = [(ta, tm), (tm, tb)]
+        if len(pan_ranges) == len(tilt_ranges) == 1:
+            return []
+        return [pans + tilts for pans in pan_ranges for tilts in tilt_ranges]
+
+    def next_batch(self, start=(0, 0)) -> list:
+        '''
+        work out the next points to scan, using every value added so far.
+
+        Args:
+            start (tuple): the (pan, tilt) the scanner is at, to order the
+                batch from
+
+        Returns:
+            list: (pan, tilt) points in the order they should be scanned, or
+                an empty list once the scan is finished.
+        '''
+        if self._first is not None:
+            wanted = [self._point(index) for index in self._first]
+            self._first = None
+            if self.budget is not None:
+                wanted = wanted[:self.budget]
+            self.planned += len(wanted)
+            return serpentine_order(wanted, start)
+        # split the most uneven cells first, so a limited budget is spent
+        # where it matters most
+        candidates = sorted(((self._contrast(cell), cell)
+                                for cell in self._cells), reverse=True)
+        wanted = set()
+        next_cells = []
+        for contrast, cell in candidates:
+            if contrast <= self.threshold:
+                break
+            children = self._split(cell)
+            new_points = {self._point((i, j)) for child in children
+                            for i in child[:2] for j in child[2:]}
+            new_points -= self.values.keys()
+            new_points -= wanted
+            if self.budget is not None and \
+                    self.planned + len(wanted) + len(new_points) > self.budget:
+                break
+            wanted |= new_points
+            next_cells.extend(children)
+        self._cells = next_cells
+        self.planned += len(wanted)
+        return serpentine_order(wanted, start)
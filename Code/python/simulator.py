@@ -0,0 +1,581 @@
+'''
+software stand-in for the scanner, so scans can be run and timed without the
+arduino. SimulatedSerial behaves like a pyserial port with the firmware from
+communication.ino on the other end of it, including servo travel time, the min
+filter over SENSOR_SAMPLES readings, the 64 byte receive buffer, the queue
+commands are decoded into while the firmware is busy and the time it takes
+bytes to cross the serial link. bytes sent while the two ends are at different
+baud rates arrive as garbage, and above max_baud the link drops the odd bit,
+so baud rate negotiation can be tried out. the servos move on their own clock
+and ring for a moment at the end of each move, so a reading taken before a
+move has settled sees the wrong spot, like the real sensor does.
+
+SerialDevice opens one when given a port like
+sim://o_data.csv?time_scale=0.1&noise=2
+where the path is a scan csv used as the scene and the query sets any of the
+SimulatedSerial options.
+'''
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qsl
+from collections import deque
+import csv
+import random
+import re
+import struct
+import threading
+import time
+
+SCHEME = 'sim://'
+
+# these mirror the defines in communication.ino
+SENSOR_SAMPLES = 10
+MSEC_PER_DEG = 20
+RX_BUFFER_SIZE = 64
+FRAME = struct.Struct('<BBhhHB')
+FRAME_SYNC = 0xA5
+FRAME_READING = ord('R')
+FRAME_READY = ord('K')
+FRAME_ERROR = ord('E')
+FRAME_STATS = ord('Q')
+MAX_SAMPLES = 32
+MIN_SAMPLES = 3
+SAMPLE_MIN = 0
+SAMPLE_MEDIAN = 1
+SAMPLE_MEAN = 2
+PAN_AXIS = 0
+TILT_AXIS = 1
+PROFILE_POINTS = 16
+BAUD_DEFAULT = 115200
+BAUD_TIMEOUT = 1000
+COMMAND_QUEUE = 4
+COMMAND_SIZE = 64
+
+MSEC_PER_SAMPLE = 0.104     # how long an ADC conversion takes on an uno
+# how the simulated servos actually move: travel time per degree, then a
+# short time where they overshoot by a degree before settling
+SERVO_MSEC_PER_DEG = 17
+SERVO_RING_MSEC = 40
+
+
+def is_simulated(port) -> bool:
+    '''
+    check whether a port refers to the simulator.
+
+    Args:
+        port: a port name or ListPortInfo
+
+    Returns:
+        bool: True if the port is a sim:// url.
+    '''
+    return isinstance(port, str) and port.startswith(SCHEME)
+
+
+class Scene:
+    '''
+    what the simulated sensor sees: a raw reading for each (pan, tilt), and a
+    background reading everywhere else.
+    '''
+    def __init__(self, readings=None, background=60) -> None:
+        self.readings = readings if readings is not None else {}
+        self.background = background
+
+    @classmethod
+    def from_csv(cls, path, background=60) -> 'Scene':
+        '''
+        build a scene from a scan csv with pan, tilt and raw (or voltage)
+        columns.
+
+        Args:
+            path: the csv to load
+            background (int): raw reading for angles the scan doesn't cover
+
+        Returns:
+            Scene: the scene.
+        '''
+        readings = {}
+        with open(path, newline='') as file:
+            for row in csv.DictReader(file):
+                key = (round(float(row['pan'])), round(float(row['tilt'])))
+                if 'raw' in row:
+                    readings[key] = int(row['raw'])
+                else:
+                    readings[key] = round(float(row['voltage'])*1023/5)
+        return cls(readings, background)
+
+    def reading(self, pan: int, tilt: int) -> int:
+        return self.readings.get((pan, tilt), self.background)
+
+
+class SimulatedSerial:
+    '''
+    a pyserial-like port connected to a simulated scanner. only the parts of
+    the pyserial interface that SerialDevice uses are provided.
+
+    Args:
+        port (str): sim:// url, see the module docstring
+        baudrate (int): the simulated link speed, used to time transfers
+        timeout (float): read timeout in seconds, like pyserial
+        scene: a Scene, or a path to a scan csv to build one from
+        time_scale (float): multiplies every firmware delay, so scans can be
+            run faster than real time. 1 is real time.
+        noise (float): standard deviation of each raw sample
+        latency (float): usb transfer latency in seconds, each way
+        boot_time (float): time between opening the port and the firmware
+            sending its first 'ready', like the arduino's reset on connect
+        max_baud (int): the fastest baud rate the link works reliably at.
+            faster rates corrupt about one byte in a hundred
+        seed: seed for the sensor noise
+    '''
+    def __init__(self, port=None, baudrate=115200, timeout=None, scene=None,
+                    time_scale=1.0, noise=2.0, latency=0.001, boot_time=0.0,
+                    max_baud=2000000, seed=None) -> None:
+        self.baudrate = baudrate    # the host's end of the link
+        self.max_baud = max_baud
+        self.timeout = timeout
+        self.scene = scene
+        self.time_scale = time_scale
+        self.noise = noise
+        self.latency = latency
+        self.boot_time = boot_time
+        self.is_open = False
+        self.overruns = 0   # bytes lost to a full receive buffer
+        self.port = port
+        self._random = random.Random(seed)
+        self._link_random = random.Random(seed)  # for corrupting bytes
+        self._device_baud = BAUD_DEFAULT    # the firmware's end of the link
+        self._lock = threading.Condition()
+        self._to_device = deque()   # (arrival time, byte) on the way in
+        self._to_host = deque()     # (arrival time, bytes) on the way out
+        self._tx_clock = 0          # when the outgoing link is next free
+        self._thread = None
+
+    def _configure(self) -> None:
+        '''
+        apply the options given in the query of a sim:// url.
+        '''
+        if not is_simulated(self.port):
+            return
+        url = urlsplit(self.port)
+        path = (url.netloc + url.path).strip('/')
+        for key, value in parse_qsl(url.query):
+            if key == 'seed':
+                self._random.seed(int(value))
+            elif key in ('time_scale', 'noise', 'latency', 'boot_time'):
+                setattr(self, key, float(value))
+            elif key == 'max_baud':
+                self.max_baud = int(value)
+        if path:
+            csv_path = Path(path)
+            if not csv_path.is_absolute() and not csv_path.exists():
+                csv_path = Path(__file__).parent / csv_path
+            self.scene = csv_path
+        if self.scene is None:
+            self.scene = Path(__file__).parent / 'o_data.csv'
+
+    def open(self) -> None:
+        self._configure()
+        if not isinstance(self.scene, Scene):
+            self.scene = Scene.from_csv(self.scene)
+        self.is_open = True
+        self._thread = threading.Thread(target=self._firmware, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        with self._lock:
+            self.is_open = False
+            self._lock.notify_all()
+        if self._thread is not None and \
+                self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def in_waiting(self) -> int:
+        with self._lock:
+            now = time.perf_counter()
+            return sum(len(data) for arrival, data in self._to_host
+                        if arrival <= now)
+
+    def readinto(self, buffer) -> int:
+        '''
+        read whatever has arrived into a buffer, waiting up to the timeout for
+        at least one byte.
+        '''
+        deadline = None if self.timeout is None else \
+                    time.perf_counter() + self.timeout
+        with self._lock:
+            while True:
+                now = time.perf_counter()
+                if self._to_host and self._to_host[0][0] <= now:
+                    break
+                if not self.is_open or deadline is not None and now >= deadline:
+                    return 0
+                # sleep until the timeout or the next bytes arrive
+                waits = [self._to_host[0][0] - now] if self._to_host else []
+                if deadline is not None:
+                    waits.append(deadline - now)
+                self._lock.wait(min(waits) if waits else None)
+            count = 0
+            while count < len(buffer) and self._to_host and \
+                    self._to_host[0][0] <= now:
+                arrival, data = self._to_host.popleft()
+                taken = min(len(data), len(buffer) - count)
+                buffer[count:count+taken] = data[:taken]
+                if taken < len(data):
+                    self._to_host.appendleft((arrival, data[taken:]))
+                count += taken
+            return count
+
+    def read(self, size=1) -> bytes:
+        buffer = bytearray(size)
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def write(self, data) -> int:
+        '''
+        send bytes to the simulated firmware. they arrive one by one at the
+        speed of the link.
+        '''
+        with self._lock:
+            arrival = time.perf_counter() + self.latency
+            byte_time = 10/self.baudrate    # 8 data bits, start and stop bits
+            for i, byte in enumerate(self._garble(bytes(data))):
+                self._to_device.append((arrival + (i+1)*byte_time, byte))
+            self._lock.notify_all()
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def _garble(self, data: bytes) -> bytes:
+        '''
+        what bytes turn into on the way across the link. called with the
+        lock held.
+        '''
+        if self.baudrate != self._device_baud:
+            # the receiver samples the bits at the wrong times
+            return bytes(self._link_random.randrange(256) for _ in data)
+        if self.baudrate > self.max_baud:
+            return bytes(byte ^ 0x10 if self._link_random.random() < 0.01
+                            else byte for byte in data)
+        return data
+
+    # everything below runs on the firmware thread
+
+    def _send(self, data: bytes) -> None:
+        '''
+        queue bytes for the host, timed by the speed of the link.
+        '''
+        with self._lock:
+            now = time.perf_counter()
+            self._tx_clock = max(self._tx_clock, now) + \
+                                len(data)*10/self._device_baud
+            self._to_host.append((self._tx_clock + self.latency,
+                                    self._garble(data)))
+            self._lock.notify_all()
+
+    def _println(self, text) -> None:
+        if self.binary_mode:
+            return
+        self._send('{}\r\n'.format(text).encode())
+
+    def _send_frame(self, kind: int, pan: int, tilt: int, reading: int) -> None:
+        frame = bytearray(FRAME.pack(FRAME_SYNC, kind, pan, tilt, reading, 0))
+        frame[-1] = sum(frame[1:-1]) & 0xFF
+        self._send(bytes(frame))
+
+    def _delay(self, msec: float) -> None:
+        if msec > 0:
+            time.sleep(msec/1000*self.time_scale)
+
+    def _firmware(self) -> None:
+        '''
+        the simulated sketch: setup, then loop reading commands until the
+        port is closed.
+        '''
+        self.pan_deg = 0
+        self.tilt_deg = 0
+        self.binary_mode = False
+        self.profiles = ([], [])    # settle profile of each axis
+        # (from, to, start time) of each servo's latest move
+        self._servos = [(0, 0, 0.0), (0, 0, 0.0)]
+        received = self._received = deque()     # the arduino's receive buffer
+        commands = self._commands = deque()     # decoded, waiting their turn
+        self._line = bytearray()
+        self._device_baud = BAUD_DEFAULT
+        self._baud_previous = 0
+        self._baud_switched = 0.0
+        time.sleep(self.boot_time)
+        self._println('ready')
+        while True:
+            if self._baud_previous and time.perf_counter() > \
+                    self._baud_switched + BAUD_TIMEOUT/1000:
+                # the host never confirmed the new rate, so go back
+                self._set_baud(self._baud_previous)
+                self._baud_previous = 0
+            with self._lock:
+                # bytes that arrived while the firmware was busy went into
+                # the receive buffer, or were lost if it was already full.
+                # the sketch decodes them as they come in for as long as its
+                # command queue has room
+                now = time.perf_counter()
+                while self._to_device and self._to_device[0][0] <= now:
+                    byte = self._to_device.popleft()[1]
+                    if len(received) < RX_BUFFER_SIZE - 1:
+                        received.append(byte)
+                    else:
+                        self.overruns += 1
+                    self._decode_input()
+                self._decode_input()
+                if not commands:
+                    if not self.is_open:
+                        return
+                    waits = [self._to_device[0][0] - now] if self._to_device \
+                            else []
+                    if self._baud_previous:
+                        waits.append(self._baud_switched + BAUD_TIMEOUT/1000
+                                        - now)
+                    self._lock.wait(max(min(waits), 0) if waits else None)
+                    continue
+                command = commands.popleft()
+            self._parse_command(command)
+
+    def _decode_input(self) -> None:
+        '''
+        move received bytes into the line being built, queueing each
+        finished line like read_input in the firmware. lines longer than
+        COMMAND_SIZE are queued empty, which is an unknown command. called
+        with the lock held.
+        '''
+        while self._received and len(self._commands) < COMMAND_QUEUE:
+            byte = self._received.popleft()
+            if byte == ord('\r'):
+                line = self._line
+                self._commands.append(line.decode('latin-1')
+                                        if len(line) <= COMMAND_SIZE else '')
+                self._line = bytearray()
+            elif len(self._line) <= COMMAND_SIZE:
+                self._line.append(byte)
+
+    def _parse_command(self, command: str) -> None:
+        if command == 'READSENSOR':
+            self._send_reading()
+        elif command.startswith('READSENSOR|'):
+            self._send_reading(*_parse_args(command[11:], 3)[0], stats=True)
+        elif command.startswith('POINT|'):
+            args, given = _parse_args(command[6:], 5)
+            new_pan, new_tilt = args[:2]
+            wait = max(self.settle_time(PAN_AXIS, self.pan_deg-new_pan),
+                       self.settle_time(TILT_AXIS, self.tilt_deg-new_tilt))
+            self._move(new_pan, new_tilt)
+            self._delay(wait)
+            if given > 2:
+                self._send_reading(*args[2:], stats=True)
+            else:
+                self._send_reading()
+        elif command.startswith('SCAN|'):
+            self._run_scan(*_parse_args(command[5:], 7)[0])
+        elif command.startswith('PAN|'):
+            (new_deg, wait), given = _parse_args(command[4:], 2)
+            if given < 2:
+                wait = self.settle_time(PAN_AXIS, self.pan_deg-new_deg)
+            self._move(new_deg, self.tilt_deg)
+            self._delay(wait)
+        elif command.startswith('TILT|'):
+            (new_deg, wait), given = _parse_args(command[5:], 2)
+            if given < 2:
+                wait = self.settle_time(TILT_AXIS, self.tilt_deg-new_deg)
+            self._move(self.pan_deg, new_deg)
+            self._delay(wait)
+        elif command.startswith('SETTLE|'):
+            axis, deg, msec = _parse_args(command[7:], 3)[0]
+            self.set_profile_point(TILT_AXIS if axis == TILT_AXIS else PAN_AXIS,
+                                   deg, msec)
+        elif command.startswith('BINARY|'):
+            new_mode = _to_int(command[7:]) != 0
+            self._send_ready()
+            self.binary_mode = new_mode
+            return
+        elif command.startswith('BAUD|'):
+            new_rate = _to_int(command[5:])
+            self._send_ready()
+            if new_rate > 0:
+                if not self._baud_previous:
+                    self._baud_previous = self._device_baud
+                self._set_baud(new_rate)
+                self._baud_switched = time.perf_counter()
+            return
+        elif command == 'BAUDOK':
+            self._baud_previous = 0
+        elif command.startswith('ECHO|'):
+            payload = command[5:]
+            checksum = sum(payload.encode('latin-1')) & 0xFFFF
+            self._println('{}|{}'.format(payload, checksum))
+        elif command == 'PING':
+            self.binary_mode = False
+            self._println('pong')
+        elif command.startswith('DELAY|'):
+            self._delay(_to_int(command[6:]))
+        else:
+            if self.binary_mode:
+                self._send_frame(FRAME_ERROR, self.pan_deg, self.tilt_deg, 0)
+            self._println('unknown command!')
+        self._send_ready()
+
+    def settle_time(self, axis: int, delta: int) -> int:
+        '''
+        how long to wait after moving an axis, interpolated from its settle
+        profile like settle_time in the firmware.
+        '''
+        delta = abs(delta)
+        prev_deg, prev_ms = 0, 0
+        for deg, ms in self.profiles[axis]:
+            if delta <= deg:
+                return prev_ms + (ms - prev_ms)*(delta - prev_deg)//(deg - prev_deg)
+            prev_deg, prev_ms = deg, ms
+        return prev_ms + (delta - prev_deg)*MSEC_PER_DEG
+
+    def set_profile_point(self, axis: int, deg: int, msec: int) -> None:
+        '''
+        add a point to an axis's settle profile, replacing the time for a
+        step size that's already there. a step size of 0 clears the profile.
+        '''
+        profile = self.profiles[axis]
+        if deg <= 0:
+            profile.clear()
+            return
+        steps = [point[0] for point in profile]
+        if deg in steps:
+            profile[steps.index(deg)] = (deg, msec)
+        elif len(profile) < PROFILE_POINTS:
+            profile.append((deg, msec))
+            profile.sort()
+
+    def _move(self, pan: int, tilt: int) -> None:
+        '''
+        start the servos moving, from wherever they physically are.
+        '''
+        now = time.perf_counter()
+        for axis, deg in ((PAN_AXIS, pan), (TILT_AXIS, tilt)):
+            if deg != self._servos[axis][1]:
+                self._servos[axis] = (self._position(axis, now), deg, now)
+        self.pan_deg, self.tilt_deg = pan, tilt
+
+    def _position(self, axis: int, now: float) -> int:
+        '''
+        where a servo physically is at a given time.
+        '''
+        start, end, start_time = self._servos[axis]
+        elapsed = (now - start_time)*1000/self.time_scale
+        travel = abs(end - start)*SERVO_MSEC_PER_DEG
+        if elapsed < travel:
+            return round(start + (end - start)*elapsed/travel)
+        if elapsed < travel + SERVO_RING_MSEC:
+            return end + (1 if end > start else -1)
+        return end
+
+    def _set_baud(self, rate: int) -> None:
+        '''
+        change the firmware's link speed once everything it's sent has gone
+        out, like Serial.flush, end and begin. ending the port empties its
+        receive buffer, so anything half received is dropped.
+        '''
+        time.sleep(max(self._tx_clock - time.perf_counter(), 0))
+        with self._lock:
+            self._device_baud = rate
+            self._received.clear()
+            self._line.clear()
+
+    def _send_ready(self) -> None:
+        if self.binary_mode:
+            self._send_frame(FRAME_READY, self.pan_deg, self.tilt_deg, 0)
+        self._println('ready')
+
+    def _run_scan(self, pan_start, pan_end, pan_step, tilt_start, tilt_end,
+                    tilt_step, settle) -> None:
+        if pan_step <= 0 or tilt_step <= 0:
+            return
+        tilts = list(range(tilt_start, tilt_end, tilt_step))
+        for column, pan in enumerate(range(pan_start, pan_end, pan_step)):
+            for tilt in tilts if column % 2 == 0 else reversed(tilts):
+                wait = max(self.settle_time(PAN_AXIS, self.pan_deg-pan),
+                           self.settle_time(TILT_AXIS, self.tilt_deg-tilt))
+                self._move(pan, tilt)
+                self._delay(wait + settle)
+                reading = self._sample_sensor()[0]
+                if self.binary_mode:
+                    self._send_frame(FRAME_READING, pan, tilt, reading)
+                else:
+                    self._println('S{},{},{}'.format(pan, tilt, reading))
+
+    def _sample_sensor(self, count=SENSOR_SAMPLES, mode=SAMPLE_MIN,
+                        tolerance=0) -> tuple:
+        '''
+        take up to count samples like take_sample in the firmware.
+
+        Returns:
+            tuple: (int: the reading, int: min, int: median, int: spread)
+        '''
+        now = time.perf_counter()
+        true_reading = self.scene.reading(self._position(PAN_AXIS, now),
+                                          self._position(TILT_AXIS, now))
+        if count <= 0:
+            count = SENSOR_SAMPLES
+        count = min(count, MAX_SAMPLES)
+        samples = []
+        while len(samples) < count:
+            samples.append(min(max(round(self._random.gauss(true_reading,
+                                                            self.noise)), 0),
+                               1023))
+            samples.sort()
+            if tolerance > 0 and len(samples) >= MIN_SAMPLES and \
+                    samples[-1] - samples[0] <= tolerance:
+                break
+        # the ADC runs continuously, and the conversion already under way
+        # when sampling starts is skipped
+        self._delay((len(samples) + 1)*MSEC_PER_SAMPLE)
+        taken = len(samples)
+        median = (samples[(taken-1)//2] + samples[taken//2])//2
+        stats = (samples[0], median, samples[-1] - samples[0])
+        if mode == SAMPLE_MEDIAN:
+            return (median,) + stats
+        if mode == SAMPLE_MEAN:
+            return ((sum(samples) + taken//2)//taken,) + stats
+        return (samples[0],) + stats
+
+    def _send_reading(self, count=SENSOR_SAMPLES, mode=SAMPLE_MIN, tolerance=0,
+                        stats=False) -> None:
+        reading, low, median, spread = self._sample_sensor(count, mode,
+                                                           tolerance)
+        if self.binary_mode:
+            if stats:
+                self._send_frame(FRAME_STATS, low, median, spread)
+            self._send_frame(FRAME_READING, self.pan_deg, self.tilt_deg, reading)
+            return
+        self._println('X{}'.format(self.pan_deg))
+        self._println('Y{}'.format(self.tilt_deg))
+        self._println('Z{}'.format(reading))
+        if stats:
+            self._println('Q{},{},{}'.format(low, median, spread))
+
+
+def _to_int(text: str) -> int:
+    '''
+    parse the leading integer of a string the way arduino's String.toInt
+    does, giving 0 if there isn't one.
+    '''
+    match = re.match(r'\s*([-+]?\d+)', text)
+    return int(match.group(1)) if match else 0
+
+
+def _parse_args(text: str, count: int) -> tuple:
+    '''
+    split |-separated integer arguments like parse_args in the firmware.
+    missing arguments are 0.
+
+    Returns:
+        tuple: (list: the arguments, int: how many were actually given)
+    '''
+    args = text.split('|')[:count]
+    given = len(args)
+    args += [''] * (count - len(args))
+    return [_to_int(arg) for arg in args], given